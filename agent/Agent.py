@@ -1,13 +1,18 @@
 import torch as T
 import numpy as np
 
-from ReplayBuffer import PrioritizedReplayBuffer, EpisodeReplayBuffer
-from Network import DeepQNetwork
+from ReplayBuffer import PrioritizedReplayBuffer, SequenceReplayBuffer, SharedReplayBuffer, EpisodeReplayBuffer, \
+    BatchPrefetcher, fill_synthetic
+from Network import DeepQNetwork, TargetNetworkUpdater
+from Distributed import all_reduce_gradients, broadcast_buffers
 
 
 class Agent:
     def __init__(self, gamma, epsilon, lr, input_dims, batch_size, n_actions,
-                 max_mem_size=100000, eps_end=0.005, eps_dec=9e-5, sequence_length=5):
+                 max_mem_size=100000, eps_end=0.005, eps_dec=9e-5, sequence_length=5, fused_learn=False,
+                 mixed_precision=False, target_tau=None, distributed=False, replay="prioritized", burn_in=8,
+                 deduplicate_frames=False, replay_path=None, observation_dtype="float32", shared_replay=None,
+                 attach_replay=False):
         self.gamma = gamma
         self.epsilon = epsilon
         self.eps_min = eps_end
@@ -16,14 +21,27 @@ class Agent:
         self.mem_size = max_mem_size
         self.batch_size = batch_size
         self.sequence_length = sequence_length
+        self.input_dims = input_dims
         self.learn_length = 10
 
+        # Average gradients with the other learner ranks in the process group every step
+        self.distributed = distributed
+
+        # Evaluate current and next states in one pass over a `sequence_length + 1` window when learning
+        self.fused_learn = fused_learn
+
         self.action_space = [i for i in range(n_actions)]
         self.mem_cntr = 0
 
-        self.Q_eval = DeepQNetwork(lr=lr, feature_count=input_dims, hidden_dims=256, n_actions=n_actions)
-        self.Q_target = DeepQNetwork(lr=lr, feature_count=input_dims, hidden_dims=256, n_actions=n_actions)
+        self.Q_eval = DeepQNetwork(lr=lr, feature_count=input_dims, hidden_dims=256, n_actions=n_actions,
+                                   mixed_precision=mixed_precision)
+        self.Q_target = DeepQNetwork(lr=lr, feature_count=input_dims, hidden_dims=256, n_actions=n_actions,
+                                     mixed_precision=mixed_precision)
         self.Q_target.freeze()
+
+        # With tau set, the target network tracks Q_eval with a soft update after every learn step
+        self.target_tau = target_tau
+        self.target_updater = TargetNetworkUpdater(self.Q_eval, self.Q_target)
         self.update_target_network()
 
         self.state_memory = np.zeros((self.mem_size, self.sequence_length, input_dims), dtype=np.float32)
@@ -40,7 +58,44 @@ class Agent:
         self.hidden_state = None
         self.cell_state = None
 
-        self.replay_buffer = PrioritizedReplayBuffer(self.mem_size)
+        # Sequence replay burns in from stored states one frame per step, so actors feeding it have to advance their
+        # recurrent state the same way: only the newest frame of the window, on every step, random ones included
+        self.frame_by_frame = replay == "sequence"
+
+        # Sequence replay stores one recurrent state per sequence and burns in the rest when sampling
+        self.replay = replay
+        self.burn_in = burn_in
+        self.deduplicate_frames = deduplicate_frames
+        if shared_replay is not None and attach_replay:
+            # Another process owns and fills the buffer, its settings come with it
+            self.replay_buffer = SharedReplayBuffer.attach(shared_replay, timeout=None)
+        elif shared_replay is not None:
+            self.replay_buffer = SharedReplayBuffer(shared_replay, self.mem_size, deduplicate_frames=deduplicate_frames,
+                                                    observation_dtype=observation_dtype)
+        elif replay == "sequence":
+            self.replay_buffer = SequenceReplayBuffer(self.mem_size, self.sequence_length, burn_in=burn_in)
+        else:
+            self.replay_buffer = PrioritizedReplayBuffer(self.mem_size, deduplicate_frames=deduplicate_frames,
+                                                         path=replay_path, observation_dtype=observation_dtype)
+
+        self.prefetcher = None
+
+    def start_prefetching(self, depth=2, pin_memory=False):
+        """
+        Samples batches ahead on a background thread. Burn-in for sequence replay still runs in `sample_batch`, on
+            the current weights.
+        """
+        self.prefetcher = BatchPrefetcher(self.replay_buffer, self.batch_size, depth=depth, pin_memory=pin_memory)
+
+    def stop_prefetching(self):
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+
+    def fill_synthetic(self, transitions, seed=0):
+        recurrent_shape = (self.Q_eval.num_layers, 1, self.Q_eval.lstm_units)
+        fill_synthetic(self.replay_buffer, transitions, self.sequence_length, self.input_dims, len(self.action_space),
+                       recurrent_shape, seed)
 
     def start_new_episode(self):
         if self.hidden_state is not None:
@@ -55,26 +110,37 @@ class Agent:
         self.cell_state = T.zeros(self.Q_eval.num_layers, 1, self.Q_eval.lstm_units).to(self.Q_eval.device)
 
     def update_target_network(self):
-        self.Q_target.load_state_dict(self.Q_eval.state_dict())
+        self.target_updater.hard_update()
 
     def store_transition(self, state_sequence, action, reward, next_state_sequence, done):
         # FIXME: Storing the hidden and cell states for each state is wasteful.
         self.replay_buffer.add(state_sequence, action, reward, next_state_sequence, done,)
 
+    def evaluate(self, observation_sequence):
+        """
+        Runs the observations through Q_eval from the current recurrent state and keeps the state it ends in.
+        """
+        obs = np.array([observation_sequence])
+        state_sequence = T.tensor(obs, dtype=T.float).to(self.Q_eval.device)
+
+        self.Q_eval.eval()
+        with T.no_grad():
+            if self.hidden_state is None or self.cell_state is None:
+                actions, (self.hidden_state, self.cell_state) = self.Q_eval(state_sequence)
+            else:
+                actions, (self.hidden_state, self.cell_state) = self.Q_eval(state_sequence, hidden_state=self.hidden_state,
+                                                                            cell_state=self.cell_state)
+
+        return actions[0]
+
     def choose_action(self, observation_sequence):
+        if self.frame_by_frame:
+            actions = self.evaluate(observation_sequence[-1:])
+
         if np.random.random() > self.epsilon:
-            obs = np.array([observation_sequence])
-            state_sequence = T.tensor(obs, dtype=T.float).to(self.Q_eval.device)
-
-            self.Q_eval.eval()
-            with T.no_grad():
-                if self.hidden_state is None or self.cell_state is None:
-                    actions, (self.hidden_state, self.cell_state) = self.Q_eval(state_sequence)
-                else:
-                    actions, (self.hidden_state, self.cell_state) = self.Q_eval(state_sequence, hidden_state=self.hidden_state,
-                                                                                cell_state=self.cell_state)
-
-            actions = actions[0]
+            if not self.frame_by_frame:
+                actions = self.evaluate(observation_sequence)
+
             action = T.argmax(actions).item()
         else:
             # Only choose actions that lead right
@@ -82,24 +148,85 @@ class Agent:
 
         return action
 
+    def fused_forward(self, states, next_states, hidden_states, cell_states, next_hidden_states, next_cell_states):
+        # Next state sequences are the state sequences shifted by one observation, so one extra frame is enough
+        window = T.cat((states, next_states[:, -1:]), dim=1)
+
+        return self.Q_eval.forward_pair(window, hidden_states, cell_states, next_hidden_states, next_cell_states)
+
+    def sample_batch(self, batch_size):
+        if self.prefetcher is not None and batch_size == self.prefetcher.batch_size:
+            batch = self.prefetcher.get()
+        else:
+            batch = self.replay_buffer.sample(batch_size, beta=0.4)
+
+        if not isinstance(self.replay_buffer, SequenceReplayBuffer):
+            return batch
+
+        (states, actions, rewards, next_states, dones, indices, weights,
+         burn_in_frames, burn_in_lengths, hidden_states, cell_states) = batch
+
+        # Initial states for the state windows come from burning in from the sequence snapshot, the next state windows
+        # start one frame later
+        hidden_states, cell_states = self.Q_eval.burn_in(burn_in_frames, burn_in_lengths, hidden_states, cell_states)
+        next_hidden_states, next_cell_states = self.Q_eval.burn_in(states[:, :1], T.ones_like(burn_in_lengths),
+                                                                   hidden_states, cell_states)
+
+        return (states, actions, rewards, next_states, dones, indices, weights,
+                hidden_states, cell_states, next_hidden_states, next_cell_states)
+
+    def td_errors(self, states, actions, rewards, next_states, dones, hidden_states, cell_states, next_hidden_states,
+                  next_cell_states):
+        """
+        Absolute TD errors of a batch under the current networks, the same targets `learn` uses, without training.
+            Batch normalization uses the batch's statistics like in `learn`, which also moves its running averages.
+        """
+        self.Q_eval.train()
+
+        with T.no_grad():
+            q_values, _ = self.Q_eval(states, hidden_state=hidden_states, cell_state=cell_states)
+            q_next, _ = self.Q_eval(next_states, hidden_state=next_hidden_states, cell_state=next_cell_states)
+            q_target_next, _ = self.Q_target(next_states, hidden_state=next_hidden_states, cell_state=next_cell_states)
+
+        q_eval = q_values.gather(1, actions.unsqueeze(-1)).squeeze(-1)
+
+        max_next_actions = T.argmax(q_next, dim=1)
+        max_q_next = q_target_next.gather(1, max_next_actions.unsqueeze(-1)).squeeze(-1)
+        max_q_next[dones] = 0.0
+
+        return abs(rewards + self.gamma * max_q_next - q_eval).cpu().numpy()
+
+    def can_learn(self, num_batches=1):
+        """
+        Whether `learn` would train rather than return early. Distributed learners all have to agree on it before
+            learning, since a rank that skips the step never joins the gradient all-reduce the others wait in.
+        """
+        return len(self.replay_buffer) >= self.batch_size * num_batches
+
     def learn(self, num_batches=1, terminal_learn=False, average_reward=0.0):
         batch_size = self.batch_size * num_batches
 
-        if len(self.replay_buffer.buffer) < batch_size:
+        if not self.can_learn(num_batches):
             return 0
 
         self.Q_eval.train()
         self.Q_eval.optimizer.zero_grad()
 
         (states, actions, rewards, next_states, dones, indices, weights,
-         hidden_states, cell_states, next_hidden_states, next_cell_states) = self.replay_buffer.sample(batch_size, beta=0.4)
+         hidden_states, cell_states, next_hidden_states, next_cell_states) = self.sample_batch(batch_size)
+
+        if self.fused_learn:
+            q_values, q_next = self.fused_forward(states, next_states, hidden_states, cell_states,
+                                                  next_hidden_states, next_cell_states)
+        else:
+            # Forward pass for current and next state batches
+            q_values, _ = self.Q_eval(states, hidden_state=hidden_states, cell_state=cell_states)
+            q_next, _ = self.Q_eval(next_states, hidden_state=next_hidden_states, cell_state=next_cell_states)
 
-        # Forward pass for current and next state batches
-        _actions, _ = self.Q_eval(states, hidden_state=hidden_states, cell_state=cell_states)
-        q_eval = _actions.gather(1, actions.unsqueeze(-1)).squeeze(-1)
+        q_eval = q_values.gather(1, actions.unsqueeze(-1)).squeeze(-1)
 
-        q_next, _ = self.Q_eval(next_states, hidden_state=next_hidden_states, cell_state=next_cell_states)
-        q_target_next, _ = self.Q_target(next_states, hidden_state=next_hidden_states, cell_state=next_cell_states)
+        with T.no_grad():
+            q_target_next, _ = self.Q_target(next_states, hidden_state=next_hidden_states, cell_state=next_cell_states)
 
         max_next_actions = T.argmax(q_next, dim=1)
         max_q_next = q_target_next.gather(1, max_next_actions.unsqueeze(-1)).squeeze(-1)
@@ -110,15 +237,28 @@ class Agent:
 
         td_error = abs(q_target - q_eval).detach().cpu().numpy()
 
-        self.replay_buffer.update_priorities(indices, td_error + 1e-5)
+        # Prefetched batches have their priorities updated in order on the prefetch thread
+        if self.prefetcher is not None and batch_size == self.prefetcher.batch_size:
+            self.prefetcher.update_priorities(indices, td_error + 1e-5)
+        else:
+            self.replay_buffer.update_priorities(indices, td_error + 1e-5)
 
         loss = self.Q_eval.loss(q_target, q_eval)
         loss.backward()
 
+        if self.distributed:
+            all_reduce_gradients(self.Q_eval)
+
         T.nn.utils.clip_grad_norm_(self.Q_eval.parameters(), max_norm=0.5)
 
         self.Q_eval.optimizer.step()
 
+        if self.distributed:
+            broadcast_buffers(self.Q_eval)
+
+        if self.target_tau is not None:
+            self.target_updater.soft_update(self.target_tau)
+
         if terminal_learn:
             self.Q_eval.scheduler.step(average_reward)
 
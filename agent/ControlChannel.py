@@ -0,0 +1,116 @@
+import json
+
+from redis import Redis
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+
+
+class ConfigPublisher:
+    """
+    Publishes the configuration workers run with as versioned snapshots.
+
+    The latest snapshot is stored in Redis for workers that connect later, and every new one is pushed whole over a
+        pub/sub channel, so subscribed workers never have to ask for it.
+    """
+    def __init__(self, redis: Redis, prefix="config"):
+        self.redis = redis
+        self.prefix = prefix
+
+        snapshot = redis.get(f"{prefix}:snapshot")
+        self.snapshot = json.loads(snapshot) if snapshot is not None else {"version": 0}
+
+    def publish(self, **values):
+        """
+        Merges `values` into the snapshot and publishes it, if anything changed. Returns the snapshot's version.
+        """
+        if all(self.snapshot.get(key) == value for key, value in values.items()):
+            return self.snapshot["version"]
+
+        self.snapshot = {**self.snapshot, **values, "version": self.snapshot["version"] + 1}
+        data = json.dumps(self.snapshot)
+
+        pipeline = self.redis.pipeline()
+        pipeline.set(f"{self.prefix}:snapshot", data)
+        pipeline.publish(f"{self.prefix}:updates", data)
+        pipeline.execute()
+
+        return self.snapshot["version"]
+
+
+class ConfigSubscriber:
+    """
+    Keeps the latest snapshot from a `ConfigPublisher`. Snapshots arrive over pub/sub and are read without a round trip
+        to Redis. Only when subscribing, and after the connection was lost and pushed snapshots may have been missed,
+        is the stored one fetched.
+
+    `validate` is called with the configuration a snapshot would result in, and raises ValueError to reject it. A
+        rejected snapshot isn't applied, the configuration stays at the last good version until a newer one arrives.
+    """
+    def __init__(self, redis: Redis, prefix="config", defaults=None, validate=None):
+        self.redis = redis
+        self.prefix = prefix
+        self.validate = validate
+
+        self.config = dict(defaults or {})
+        self.version = 0
+
+        self.pubsub = None
+        self.stale = True
+        self.fetches = 0
+        self.poll()
+
+    def subscribe(self):
+        if self.pubsub is not None:
+            self.pubsub.close()
+
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(f"{self.prefix}:updates")
+
+    def apply(self, snapshot):
+        if snapshot["version"] <= self.version:
+            return False
+
+        config = {**self.config, **snapshot}
+        if self.validate is not None:
+            try:
+                self.validate(config)
+            except ValueError as e:
+                print(f"Ignoring configuration version {snapshot['version']}: {e}")
+                return False
+
+        self.config = config
+        self.version = snapshot["version"]
+
+        return True
+
+    def fetch(self):
+        snapshot = self.redis.get(f"{self.prefix}:snapshot")
+        self.fetches += 1
+        self.stale = False
+
+        return snapshot is not None and self.apply(json.loads(snapshot))
+
+    def poll(self):
+        """
+        Applies snapshots pushed since the last call. Returns True if the configuration changed.
+        """
+        changed = False
+        try:
+            # Subscribed before fetching, so a snapshot published in between is still pushed
+            if self.stale:
+                self.subscribe()
+                changed = self.fetch()
+
+            while True:
+                message = self.pubsub.get_message()
+                if message is None:
+                    break
+
+                if message["type"] == "message":
+                    changed = self.apply(json.loads(message["data"])) or changed
+        except (RedisConnectionError, RedisTimeoutError) as e:
+            # Subscribed again and the snapshot fetched once Redis is back
+            if not self.stale:
+                print(f"Lost connection to the configuration channel ({e}), keeping version {self.version}")
+            self.stale = True
+
+        return changed
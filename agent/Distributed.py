@@ -0,0 +1,77 @@
+import zlib
+
+import torch
+import torch.distributed as dist
+
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+
+def init_distributed(rank, world_size, master_addr="localhost", master_port=29500):
+    dist.init_process_group("gloo", init_method=f"tcp://{master_addr}:{master_port}", rank=rank, world_size=world_size)
+
+    print(f"Learner rank {rank}/{world_size} joined process group at {master_addr}:{master_port}")
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def shard_for(worker_name, world_size):
+    # crc32 rather than hash(), which is salted differently in every process
+    return zlib.crc32(worker_name.encode()) % world_size
+
+
+def broadcast_training_state(agent, src=0):
+    """
+    Makes every rank start from the same weights, optimizer state and epsilon as rank `src`. Without the optimizer
+        state, identical averaged gradients would still move the ranks' weights apart.
+    """
+    state = [{
+        "model": agent.Q_eval.state_dict(),
+        "optimizer": agent.Q_eval.optimizer.state_dict(),
+        "epsilon": agent.epsilon,
+    } if dist.get_rank() == src else None]
+
+    dist.broadcast_object_list(state, src=src)
+
+    if dist.get_rank() != src:
+        agent.Q_eval.load_state_dict(state[0]["model"])
+        agent.Q_eval.optimizer.load_state_dict(state[0]["optimizer"])
+        agent.epsilon = state[0]["epsilon"]
+
+    agent.update_target_network()
+
+
+def all_reduce_gradients(module):
+    """
+    Averages gradients over all ranks. Gradients are flattened into one buffer so each step is a single all-reduce.
+    """
+    gradients = [parameter.grad for parameter in module.parameters() if parameter.grad is not None]
+
+    flat = _flatten_dense_tensors(gradients)
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+
+    for gradient, synced in zip(gradients, _unflatten_dense_tensors(flat, gradients)):
+        gradient.copy_(synced)
+
+
+def broadcast_buffers(module, src=0):
+    # Batch norm statistics come from each rank's own batches, rank `src` decides what every rank keeps
+    buffers = [buffer for buffer in module.buffers() if buffer.is_floating_point()]
+
+    flat = _flatten_dense_tensors(buffers)
+    dist.broadcast(flat, src=src)
+
+    for buffer, synced in zip(buffers, _unflatten_dense_tensors(flat, buffers)):
+        buffer.copy_(synced)
+
+
+def all_ranks_ready(ready):
+    """
+    True only when every rank is ready, so ranks enter collective learn steps together or not at all.
+    """
+    flag = torch.tensor([1 if ready else 0], dtype=torch.int32)
+    dist.all_reduce(flag, op=dist.ReduceOp.MIN)
+
+    return bool(flag.item())
@@ -0,0 +1,585 @@
+import pickle
+import time
+
+import numpy as np
+
+from collections import namedtuple, deque
+from threading import Lock
+
+from ReplayBuffer import TransitionMessage
+
+from redis.exceptions import ResponseError, ConnectionError as RedisConnectionError, \
+    TimeoutError as RedisTimeoutError
+
+
+# Transitions of one worker, in order, with the time.time() each was produced at. Pickled, which is how workers
+# published them before the binary format, still accepted by the node.
+TransitionBatchMessage = namedtuple('TransitionBatchMessage', ('transitions', 'worker_name', 'timestamps'))
+
+
+# Binary experience messages, all little-endian:
+#   header, worker name (UTF-8), `count` records, `count` new observations (float32), the first observation of every
+#   episode started in the message (float32), and `snapshots` recurrent states (hidden then cell, float32, float16 in
+#   version 1).
+# Workers send each observation once, the node rebuilds the windows from the observations of each worker's stream.
+WIRE_MAGIC = b"RCXP"
+WIRE_VERSION = 2
+
+MESSAGE_HEADER = np.dtype([
+    ("magic", "S4"), ("version", "<u1"), ("reserved", "<u1"), ("name_length", "<u2"), ("count", "<u2"),
+    ("starts", "<u2"), ("snapshots", "<u2"), ("features", "<u2"), ("window", "<u2"), ("recurrent_layers", "<u2"),
+    ("recurrent_units", "<u2"),
+])
+
+TRANSITION_RECORD = np.dtype([
+    ("episode", "<u4"), ("step", "<u4"), ("action", "<u2"), ("flags", "<u1"), ("done", "<u1"), ("reward", "<f4"),
+    ("timestamp", "<f8"),
+])
+
+# Record flags
+EPISODE_START = 1  # First step of an episode, its first observation is in the message
+RECURRENT_SNAPSHOT = 2  # The recurrent state after this step is in the message
+
+
+class ExperiencePublisher:
+    """
+    Collects a worker's transitions and adds them to the experience stream together: once `max_transitions` are
+        waiting, once the oldest has waited `max_delay` seconds, or at the end of an episode. A publish is one message
+        and one round trip to Redis per batch instead of per step.
+
+    Messages carry each new observation once instead of two windows, and by default every step's recurrent state.
+        With a `recurrent_interval` above 1, only the steps at `recurrent_phase` of every interval of an episode carry
+        theirs and the node reuses the last one it got for the steps in between, which is only exact for the
+        snapshots of sequence replay, see `SequenceReplayBuffer.recurrent_schedule`. With 0 no step carries one.
+
+    The stream keeps at most about `max_length` messages. Every publish also returns how many messages the slowest
+        reader hasn't processed yet, and once that backlog passes `max_backlog` the publisher blocks until it's down to
+        half. The game only advances when the worker steps it, so waiting doesn't cost the worker anything but time.
+        Another `transport`, like a local shared-memory lane, can take the place of the stream.
+    """
+    def __init__(self, redis, worker_name, stream="replay_buffer", max_transitions=32, max_delay=0.5,
+                 window=8, recurrent_interval=1, recurrent_phase=0, max_length=20000, max_backlog=5000,
+                 transport=None):
+        self.transport = transport if transport is not None else \
+            StreamTransport(redis, stream, max_length, max_backlog)
+        self.worker_name = worker_name
+        self.name = worker_name.encode()
+        self.stream = stream
+        self.max_transitions = max_transitions
+        self.max_delay = max_delay
+        self.window = window
+        self.recurrent_interval = recurrent_interval
+        self.recurrent_phase = recurrent_phase
+        self.max_backlog = max_backlog
+
+        self.episode = -1
+        self.step = 0
+        self.first_observation = None
+        self.recurrent_shape = (0, 0)
+
+        self.records = []
+        self.observations = []
+        self.starts = []
+        self.snapshots = []
+
+        self.messages = 0
+        self.bytes = 0
+        self.backlog = 0
+        self.throttled_time = 0.0
+
+    def start_episode(self, observation):
+        self.episode += 1
+        self.step = 0
+        self.first_observation = np.asarray(observation, dtype=np.float32)
+
+    def add(self, observation, action, reward, done, hidden_state=None, cell_state=None):
+        """
+        Adds the step that led to `observation`. Recurrent states are the agent's after choosing `action`.
+        """
+        flags = 0
+        if self.step == 0:
+            flags |= EPISODE_START
+            self.starts.append(self.first_observation)
+
+        if hidden_state is not None:
+            hidden_state = hidden_state.detach().squeeze(1).cpu().numpy()
+            cell_state = cell_state.detach().squeeze(1).cpu().numpy()
+            self.recurrent_shape = hidden_state.shape
+
+            if self.recurrent_interval > 0 and self.step % self.recurrent_interval == self.recurrent_phase:
+                flags |= RECURRENT_SNAPSHOT
+                self.snapshots.append(np.stack((hidden_state, cell_state)))
+
+        self.records.append((self.episode, self.step, action, flags, done, reward, time.time()))
+        self.observations.append(observation)
+        self.step += 1
+
+        if done or len(self.records) >= self.max_transitions or \
+                time.time() - self.records[0][-1] >= self.max_delay:
+            self.flush()
+
+    def encode(self):
+        features = len(self.observations[0])
+        layers, units = self.recurrent_shape
+
+        header = np.zeros((), dtype=MESSAGE_HEADER)
+        header["magic"] = WIRE_MAGIC
+        header["version"] = WIRE_VERSION
+        header["name_length"] = len(self.name)
+        header["count"] = len(self.records)
+        header["starts"] = len(self.starts)
+        header["snapshots"] = len(self.snapshots)
+        header["features"] = features
+        header["window"] = self.window
+        header["recurrent_layers"] = layers
+        header["recurrent_units"] = units
+
+        return b"".join((
+            header.tobytes(),
+            self.name,
+            np.array(self.records, dtype=TRANSITION_RECORD).tobytes(),
+            np.asarray(self.observations, dtype="<f4").tobytes(),
+            np.asarray(self.starts, dtype="<f4").reshape(-1, features).tobytes(),
+            np.asarray(self.snapshots, dtype="<f4").reshape(-1, 2, layers, units).tobytes(),
+        ))
+
+    def flush(self):
+        if not self.records:
+            return
+
+        data = self.encode()
+
+        backlog = self.transport.send(data)
+        if backlog is None:
+            # Only a local transport refuses messages, when its ring is full
+            start_time = time.time()
+            while backlog is None:
+                time.sleep(0.001)
+                backlog = self.transport.send(data)
+            self.throttled_time += time.time() - start_time
+
+        self.messages += 1
+        self.bytes += len(data)
+        self.backlog = backlog
+
+        self.records = []
+        self.observations = []
+        self.starts = []
+        self.snapshots = []
+
+        if self.backlog > self.max_backlog:
+            self.wait_for_readers()
+
+    def wait_for_readers(self):
+        print(f"Node is {self.backlog} messages behind, waiting for it to catch up")
+
+        start_time = time.time()
+        while self.backlog > self.max_backlog // 2:
+            time.sleep(0.1)
+            self.backlog = self.transport.backlog()
+
+        self.throttled_time += time.time() - start_time
+
+
+class StreamTransport:
+    """
+    Sends experience messages to a Redis stream of about `max_length` messages.
+
+    The backlog of a consumer group is its lag plus its pending messages. Redis before 7 doesn't report the lag, and
+        Redis 7 stops once trimming passes a lagging group. The entries after the group's last delivered one are
+        counted instead, up to `max_backlog` + 1, since beyond it publishers wait either way. The stream's length is no
+        substitute, acknowledging doesn't shrink it and a reader that caught up would keep publishers waiting.
+    """
+    def __init__(self, redis, stream="replay_buffer", max_length=20000, max_backlog=5000):
+        self.redis = redis
+        self.stream = stream
+        self.max_length = max_length
+        self.max_backlog = max_backlog
+
+    def send(self, data):
+        """
+        Adds a message and returns the backlog of the slowest reader, in the same round trip.
+        """
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.xadd(self.stream, {"data": data}, maxlen=self.max_length, approximate=True)
+        pipeline.xlen(self.stream)
+        pipeline.xinfo_groups(self.stream)
+        _, length, groups = pipeline.execute()
+
+        return self.groups_backlog(length, groups)
+
+    def backlog(self):
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.xlen(self.stream)
+        pipeline.xinfo_groups(self.stream)
+
+        return self.groups_backlog(*pipeline.execute())
+
+    def groups_backlog(self, length, groups):
+        """
+        Messages the slowest consumer group hasn't processed: not delivered yet plus delivered but not acknowledged.
+            Until a group exists that's everything in the stream.
+        """
+        if not groups:
+            return length
+
+        return max((group["lag"] if group.get("lag") is not None else self.undelivered(group["last-delivered-id"])) +
+                   group["pending"] for group in groups)
+
+    def undelivered(self, last_delivered_id):
+        # The range includes the last delivered entry itself, unless it was trimmed
+        count = None if self.max_backlog == float("inf") else int(self.max_backlog) + 2
+        entries = self.redis.xrange(self.stream, min=last_delivered_id, max="+", count=count)
+
+        return sum(1 for entry_id, _ in entries if entry_id != last_delivered_id)
+
+
+def remove_stale_groups(redis, stream, keep):
+    """
+    Deletes the consumer groups of `stream` not in `keep`, like those of a renamed group or of a run with more ranks.
+        Workers wait for the slowest group, and one nobody reads anymore would hold them back forever. Returns the
+        names of the deleted groups.
+    """
+    try:
+        groups = redis.xinfo_groups(stream)
+    except ResponseError:
+        # Nothing to clean up before the stream exists
+        return []
+
+    stale = []
+    for group in groups:
+        name = group["name"].decode() if isinstance(group["name"], bytes) else group["name"]
+        if name not in keep:
+            redis.xgroup_destroy(stream, name)
+            stale.append(name)
+
+    return stale
+
+
+class ExperienceStream:
+    """
+    Reads experience messages from a Redis stream as one consumer of a consumer group.
+
+    Redis remembers what the group was last given and what this consumer hasn't acknowledged. When a consumer starts
+        again under the same name, it first gets back what it was given but never acknowledged, then continues where
+        the group left off, so nothing sent while it was away or lost in a crash is skipped.
+    """
+    def __init__(self, redis, stream="replay_buffer", group="learner", consumer="node", count=64, block=0.1):
+        self.redis = redis
+        self.stream = stream
+        self.group = group
+        self.consumer = consumer
+        self.count = count
+        self.block = block
+
+        self.recovering = True
+        self.recovered_id = "0"
+        self.created = False
+
+    def create_group(self):
+        # Starting from the beginning of the stream also takes what workers sent before the first node started
+        try:
+            self.redis.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+        self.created = True
+
+    def read(self):
+        """
+        Returns up to `count` messages as [(id, data)], waiting up to `block` seconds for new ones.
+        """
+        if not self.created:
+            self.create_group()
+
+        # An ID gets this consumer's unacknowledged messages after it, ">" new ones
+        position = self.recovered_id if self.recovering else ">"
+        response = self.redis.xreadgroup(self.group, self.consumer, {self.stream: position}, count=self.count,
+                                         block=None if self.recovering else int(self.block * 1000))
+
+        entries = response[0][1] if response else []
+        if self.recovering:
+            if entries:
+                self.recovered_id = entries[-1][0]
+            if len(entries) < self.count:
+                self.recovering = False
+
+        # Entries trimmed from the stream before they were acknowledged come back without fields
+        messages = [(message_id, fields[b"data"]) for message_id, fields in entries if fields]
+
+        trimmed = [message_id for message_id, fields in entries if not fields]
+        if trimmed:
+            print(f"{len(trimmed)} experience messages were trimmed from the stream before they were processed")
+            self.ack(trimmed)
+
+        return messages
+
+    def ack(self, message_ids):
+        if message_ids:
+            self.redis.xack(self.stream, self.group, *message_ids)
+
+    def reconnected(self):
+        """
+        Call after a lost connection, messages delivered but not acknowledged before it are read again.
+        """
+        self.recovering = True
+        self.recovered_id = "0"
+        self.created = False
+
+
+def consume_stream(stream: ExperienceStream, handle, stop=None):
+    """
+    Calls `handle(data)` for every message of `stream`, until the `stop` event is set. Messages are acknowledged once
+        handled, a message that fails would fail the same way every time, so it's acknowledged and dropped. A lost
+        connection to Redis is retried with a growing delay, after which unacknowledged messages are read again.
+    """
+    reconnect_delay = 1.0
+
+    while stop is None or not stop.is_set():
+        try:
+            messages = stream.read()
+
+            for message_id, data in messages:
+                try:
+                    handle(data)
+                except Exception as e:
+                    print(f"Dropping experience message {message_id}: {e!r}")
+
+            stream.ack([message_id for message_id, _ in messages])
+            reconnect_delay = 1.0
+
+        except (RedisConnectionError, RedisTimeoutError) as e:
+            print(f"Lost connection to Redis ({e}), reconnecting in {reconnect_delay:.0f}s...")
+            time.sleep(reconnect_delay)
+            reconnect_delay = min(reconnect_delay * 2, 30.0)
+
+            stream.reconnected()
+
+
+def message_worker_name(data):
+    """
+    The worker name of a binary message without decoding the rest, None for pickled messages.
+    """
+    if not data.startswith(WIRE_MAGIC):
+        return None
+
+    header = np.frombuffer(data, dtype=MESSAGE_HEADER, count=1)[0]
+    offset = MESSAGE_HEADER.itemsize
+
+    return data[offset:offset + int(header["name_length"])].decode()
+
+
+class ExperienceDecoder:
+    """
+    Decodes experience messages into the arrays `add_batch` takes, rebuilding every worker's observation windows
+        and recurrent states from the steps it sent before. A stream with a missing or repeated step can't be rebuilt,
+        its transitions are dropped until the worker starts a new episode.
+    """
+    def __init__(self):
+        self.streams = {}
+        self.dropped = 0
+
+    def decode(self, data):
+        """
+        Returns (worker_name, (states, actions, rewards, next_states, dones, next_hidden_states, next_cell_states),
+            timestamps). Pickled messages are decoded too, their timestamps can be None.
+        """
+        if not data.startswith(WIRE_MAGIC):
+            worker_name, transitions, timestamps = decode_message(data)
+            return worker_name, batch_arrays(transitions), timestamps
+
+        header = np.frombuffer(data, dtype=MESSAGE_HEADER, count=1)[0]
+        if header["version"] not in (1, WIRE_VERSION):
+            raise ValueError(f"Unsupported experience message version {header['version']}")
+
+        # Workers from before version 2 send recurrent states as float16
+        snapshot_dtype = np.dtype("<f2") if header["version"] == 1 else np.dtype("<f4")
+
+        count, starts, snapshots = int(header["count"]), int(header["starts"]), int(header["snapshots"])
+        features, window = int(header["features"]), int(header["window"])
+        recurrent_shape = (int(header["recurrent_layers"]), int(header["recurrent_units"]))
+
+        offset = MESSAGE_HEADER.itemsize
+        worker_name = data[offset:offset + int(header["name_length"])].decode()
+        offset += int(header["name_length"])
+
+        sections = []
+        for dtype, shape in ((TRANSITION_RECORD, (count,)), (np.dtype("<f4"), (count, features)),
+                             (np.dtype("<f4"), (starts, features)),
+                             (snapshot_dtype, (snapshots, 2) + recurrent_shape)):
+            size = int(np.prod(shape))
+            if offset + size * dtype.itemsize > len(data):
+                raise ValueError(f"Experience message from {worker_name} is truncated")
+
+            sections.append(np.frombuffer(data, dtype=dtype, count=size, offset=offset).reshape(shape))
+            offset += size * dtype.itemsize
+
+        if offset != len(data):
+            raise ValueError(f"Experience message from {worker_name} has {len(data) - offset} unexpected bytes")
+
+        records, observations, first_observations, recurrent_states = sections
+        batch, timestamps = self.rebuild(worker_name, records, observations, first_observations, recurrent_states,
+                                         window)
+
+        return worker_name, batch, timestamps
+
+    def rebuild(self, worker_name, records, observations, first_observations, recurrent_states, window):
+        count, features = observations.shape
+        recurrent_shape = recurrent_states.shape[2:]
+
+        states = np.empty((count, window, features), dtype=np.float32)
+        next_states = np.empty((count, window, features), dtype=np.float32)
+        hidden_states = np.empty((count,) + recurrent_shape, dtype=np.float32)
+        cell_states = np.empty((count,) + recurrent_shape, dtype=np.float32)
+        kept = np.zeros(count, dtype=bool)
+
+        stream = self.streams.get(worker_name)
+        start_index = 0
+        snapshot_index = 0
+        for i, record in enumerate(records):
+            flags = int(record["flags"])
+
+            if flags & EPISODE_START:
+                # Same zero-padded first window the worker acts on
+                stream = {
+                    "episode": int(record["episode"]),
+                    "step": 0,
+                    "window": np.zeros((window, features), dtype=np.float32),
+                    "hidden_state": np.zeros(recurrent_shape, dtype=np.float32),
+                    "cell_state": np.zeros(recurrent_shape, dtype=np.float32),
+                }
+                stream["window"][-1] = first_observations[start_index]
+                start_index += 1
+
+            if flags & RECURRENT_SNAPSHOT:
+                snapshot = recurrent_states[snapshot_index]
+                snapshot_index += 1
+            else:
+                snapshot = None
+
+            if stream is None or stream["episode"] != record["episode"] or stream["step"] != record["step"]:
+                stream = None
+                self.dropped += 1
+                continue
+
+            if snapshot is not None:
+                stream["hidden_state"] = snapshot[0].astype(np.float32)
+                stream["cell_state"] = snapshot[1].astype(np.float32)
+
+            states[i] = stream["window"]
+            next_states[i, :-1] = stream["window"][1:]
+            next_states[i, -1] = observations[i]
+            hidden_states[i] = stream["hidden_state"]
+            cell_states[i] = stream["cell_state"]
+            kept[i] = True
+
+            stream["window"] = next_states[i]
+            stream["step"] += 1
+
+            if record["done"]:
+                stream = None
+
+        if stream is None:
+            self.streams.pop(worker_name, None)
+        else:
+            stream["window"] = stream["window"].copy()
+            self.streams[worker_name] = stream
+
+        if not kept.all():
+            states, next_states = states[kept], next_states[kept]
+            hidden_states, cell_states = hidden_states[kept], cell_states[kept]
+            records = records[kept]
+
+        return (states, records["action"].astype(np.int64), records["reward"].astype(np.float32), next_states,
+                records["done"].astype(bool), hidden_states, cell_states), records["timestamp"]
+
+
+def decode_message(data):
+    """
+    Returns (worker_name, transitions, timestamps) for a pickled batch, or a single transition from a worker that
+        publishes every step. Single transitions have no timestamps.
+    """
+    message = pickle.loads(data)
+
+    if isinstance(message, TransitionBatchMessage):
+        return message.worker_name, message.transitions, message.timestamps
+
+    if isinstance(message, TransitionMessage):
+        return message.worker_name, [message.transition], None
+
+    raise ValueError(f"Unknown experience message {type(message).__name__}")
+
+
+def batch_arrays(transitions):
+    """
+    Stacks transitions into the arrays `add_batch` takes, recurrent states without their batch dimension of 1.
+    """
+    return (
+        np.stack([transition.state for transition in transitions]),
+        np.array([transition.action for transition in transitions]),
+        np.array([transition.reward for transition in transitions], dtype=np.float32),
+        np.stack([transition.next_state for transition in transitions]),
+        np.array([transition.done for transition in transitions], dtype=bool),
+        np.stack([transition.hidden_state.detach().squeeze(1).cpu().numpy() for transition in transitions]),
+        np.stack([transition.cell_state.detach().squeeze(1).cpu().numpy() for transition in transitions]),
+    )
+
+
+class IngestionStats:
+    """
+    Counts what arrives at the node and how long transitions took from the worker to the replay buffer, where the
+        learner can sample them. Latencies compare clocks of different machines, so they're only as accurate as the
+        clocks are synchronized.
+    """
+    def __init__(self, max_latencies=100000):
+        self.lock = Lock()
+
+        self.messages = 0
+        self.transitions = 0
+        self.bytes = 0
+        self.latencies = deque(maxlen=max_latencies)
+        self.last_report_time = time.time()
+
+    def received(self, transitions, size, messages=1):
+        with self.lock:
+            self.messages += messages
+            self.transitions += transitions
+            self.bytes += size
+
+    def visible(self, timestamps):
+        """
+        Records transitions produced at `timestamps` becoming visible to the learner now.
+        """
+        if timestamps is None or len(timestamps) == 0:
+            return
+
+        latencies = time.time() - np.asarray(timestamps, dtype=np.float64)
+        with self.lock:
+            self.latencies.extend(latencies.tolist())
+
+    def report(self):
+        """
+        Rates and latency percentiles since the last report.
+        """
+        with self.lock:
+            elapsed = max(1e-9, time.time() - self.last_report_time)
+            latencies = np.array(self.latencies, dtype=np.float64)
+
+            report = {
+                "messages_per_second": self.messages / elapsed,
+                "transitions_per_second": self.transitions / elapsed,
+                "bytes_per_second": self.bytes / elapsed,
+                "bytes_per_transition": self.bytes / max(1, self.transitions),
+                "latency_mean_ms": latencies.mean() * 1000 if len(latencies) else 0.0,
+                "latency_p50_ms": np.percentile(latencies, 50) * 1000 if len(latencies) else 0.0,
+                "latency_p99_ms": np.percentile(latencies, 99) * 1000 if len(latencies) else 0.0,
+            }
+
+            self.messages = 0
+            self.transitions = 0
+            self.bytes = 0
+            self.latencies.clear()
+            self.last_report_time = time.time()
+
+        return report
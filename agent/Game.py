@@ -2,6 +2,7 @@ import ctypes
 import ctypes.wintypes as wintypes
 import psutil
 import struct
+import time
 
 import numpy as np
 
@@ -143,6 +144,9 @@ class Game:
         self.last_frame_count = 0
         self.must_restart = False
 
+        # Seconds spent waiting for the emulator to finish frames
+        self.frame_wait_time = 0.0
+
     def open_process(self):
         return self.process.open_process()
 
@@ -252,15 +256,18 @@ class Game:
         frame_count = self.get_current_frame_count()
 
         if blocking:
+            start_time = time.perf_counter()
             while frame_count == self.last_frame_count:
                 if self.must_restart:
                     self.process.open_process()
                     self.must_restart = False
+                    self.frame_wait_time += time.perf_counter() - start_time
 
                     return False
 
                 frame_count = self.get_current_frame_count()
 
+            self.frame_wait_time += time.perf_counter() - start_time
             self.last_frame_count = frame_count
 
         self.process.write_int(self.frame_progress_address, frame_count)
@@ -0,0 +1,238 @@
+import os
+import time
+
+import numpy as np
+import torch
+
+from Experience import ExperienceDecoder, ExperienceStream, consume_stream, message_worker_name, decode_message
+from SharedArrays import create_shared_array, attach_shared_array, release_segments
+from Distributed import shard_for
+from Topology import pin_current_process
+from LocalTransport import TransitionRing, TransitionLane, LaneReader
+
+
+class DecodedBatchRing:
+    """
+    Ring of decoded transition batches in shared memory, written by one decoder process and read by the learner.
+        Each slot holds up to `slot_size` transitions of one worker as the arrays `add_batch` takes, so the learner
+        only copies them into the replay buffer.
+
+    There is exactly one writer and one reader. The writer fills a slot before it moves the write counter past it, and
+        the reader is done with a slot before it moves the read counter, so neither needs a lock.
+    """
+    name_length = 64
+
+    def __init__(self, name, slots, slot_size, window, features, recurrent_shape, create=True):
+        self.name = name
+        self.slots = slots
+        self.slot_size = slot_size
+        self.create = create
+
+        recurrent_shape = tuple(recurrent_shape)
+        fields = {
+            # write, read
+            "counters": ((2,), np.int64),
+            "counts": ((slots,), np.int64),
+            "sizes": ((slots,), np.int64),
+            "names": ((slots, self.name_length), np.uint8),
+            "states": ((slots, slot_size, window, features), np.float32),
+            "actions": ((slots, slot_size), np.int64),
+            "rewards": ((slots, slot_size), np.float32),
+            "next_states": ((slots, slot_size, window, features), np.float32),
+            "dones": ((slots, slot_size), bool),
+            "hidden_states": ((slots, slot_size) + recurrent_shape, np.float32),
+            "cell_states": ((slots, slot_size) + recurrent_shape, np.float32),
+            "timestamps": ((slots, slot_size), np.float64),
+        }
+
+        self.segments = []
+        self.arrays = {}
+        for field, (shape, dtype) in fields.items():
+            if create:
+                segment, array = create_shared_array(f"{name}_{field}", shape, dtype)
+            else:
+                segment, array = attach_shared_array(f"{name}_{field}", shape, dtype)
+
+            self.segments.append(segment)
+            self.arrays[field] = array
+
+        self.counters = self.arrays["counters"]
+        self.full_waits = 0
+
+    def settings(self):
+        """
+        Arguments that attach another process to this ring.
+        """
+        shape = self.arrays["states"].shape
+        return (self.name, self.slots, self.slot_size, shape[2], shape[3], self.arrays["hidden_states"].shape[2:])
+
+    def __len__(self):
+        return int(self.counters[0] - self.counters[1])
+
+    def put(self, worker_name, batch, timestamps, size):
+        """
+        Writes a decoded batch, over several slots if it's larger than one, waiting while the ring is full. `size` is
+            the message's size in bytes, counted with the first slot.
+        """
+        count = len(batch[1])
+        name = np.frombuffer(worker_name.encode()[:self.name_length], dtype=np.uint8)
+        if timestamps is None:
+            timestamps = np.full(count, np.nan)
+
+        for start in range(0, max(count, 1), self.slot_size):
+            end = min(start + self.slot_size, count)
+
+            while self.counters[0] - self.counters[1] >= self.slots:
+                self.full_waits += 1
+                time.sleep(0.001)
+
+            slot = int(self.counters[0] % self.slots)
+            arrays = self.arrays
+
+            arrays["counts"][slot] = end - start
+            arrays["sizes"][slot] = size if start == 0 else 0
+            arrays["names"][slot] = 0
+            arrays["names"][slot, :len(name)] = name
+
+            for field, values in zip(("states", "actions", "rewards", "next_states", "dones", "hidden_states",
+                                      "cell_states"), batch):
+                arrays[field][slot, :end - start] = values[start:end]
+            arrays["timestamps"][slot, :end - start] = timestamps[start:end]
+
+            self.counters[0] += 1
+
+    def get(self):
+        """
+        Returns (worker_name, batch, timestamps, size) for the oldest slot, or None when the ring is empty. The arrays
+            are views of the slot, valid until `release`.
+        """
+        if self.counters[1] >= self.counters[0]:
+            return None
+
+        slot = int(self.counters[1] % self.slots)
+        arrays = self.arrays
+        count = int(arrays["counts"][slot])
+
+        worker_name = arrays["names"][slot].tobytes().rstrip(b"\0").decode()
+        batch = tuple(arrays[field][slot, :count] for field in (
+            "states", "actions", "rewards", "next_states", "dones", "hidden_states", "cell_states"))
+        timestamps = arrays["timestamps"][slot, :count]
+
+        return worker_name, batch, timestamps[~np.isnan(timestamps)], int(arrays["sizes"][slot])
+
+    def release(self):
+        self.counters[1] += 1
+
+    def close(self):
+        self.arrays = None
+        self.counters = None
+        release_segments(self.segments, unlink=self.create)
+
+
+def run_decoder(index, decoders, input_ring, ring_settings, cpus=None):
+    """
+    Main function of a decoder process. Decodes the messages in its share of the lanes of the `input_ring`
+        `TransitionRing` and writes them to its own ring. A lane only ever carries the messages of one worker at a
+        time, in order, so each worker's messages are decoded in order by one process.
+    """
+    pin_current_process(cpus, f"decoder {index}")
+
+    # Decoding is NumPy work on one batch at a time, more threads would only compete with the learner
+    torch.set_num_threads(1)
+
+    stream = LaneReader(TransitionRing.attach(input_ring), owns=lambda lane: lane % decoders == index)
+    ring = DecodedBatchRing(*ring_settings, create=False)
+    decoder = ExperienceDecoder()
+
+    def handle(data):
+        worker_name, batch, timestamps = decoder.decode(data)
+        ring.put(worker_name, batch, timestamps, len(data))
+
+    consume_stream(stream, handle)
+
+
+def fan_out(stream: ExperienceStream, input_ring: TransitionRing, shard=None, stop=None):
+    """
+    Reads the experience stream once for all decoder processes and hands each message to the lane of the
+        `input_ring` of the decoder that owns its worker, until the `stop` event is set. Only the worker's name is read
+        from a message here. With a `shard`, messages of other ranks' workers are skipped.
+
+    A message is acknowledged once it's in a lane, a full lane holds up reading until its decoder catches up.
+    """
+    rank, world_size = shard if shard is not None else (0, 1)
+    lanes = [TransitionLane(input_ring, lane) for lane in range(input_ring.lanes)]
+
+    def handle(data):
+        worker_name = message_worker_name(data)
+        if worker_name is None:
+            worker_name = decode_message(data)[0]
+
+        if shard_for(worker_name, world_size) != rank:
+            return
+
+        # Workers of this rank are spread evenly over its decoders
+        lane = lanes[shard_for(worker_name, world_size * len(lanes)) // world_size]
+        while lane.send(data) is None:
+            if stop is not None and stop.is_set():
+                return
+            time.sleep(0.001)
+
+    consume_stream(stream, handle, stop)
+
+
+def collect_decoded(rings, replay_buffer, staging, ingestion_stats, ingest, stop=None):
+    """
+    Moves decoded batches from the decoder processes' rings into the replay buffer, or the staging buffer, with
+        `ingest(replay_buffer, staging, ingestion_stats, worker_name, batch, timestamps)`, until the `stop` event is
+        set.
+    """
+    while stop is None or not stop.is_set():
+        collected = 0
+        for ring in rings:
+            while True:
+                item = ring.get()
+                if item is None:
+                    break
+
+                worker_name, batch, timestamps, size = item
+
+                # Staging keeps references to the rows, the slot is about to be reused
+                if staging is not None:
+                    batch = tuple(np.array(values) for values in batch)
+
+                ingestion_stats.received(len(batch[1]), size, messages=int(size > 0))
+                ingest(replay_buffer, staging, ingestion_stats, worker_name, batch, timestamps.copy())
+                ring.release()
+                collected += 1
+
+        if collected == 0:
+            time.sleep(0.001)
+
+
+def start_decoders(count, window, features, recurrent_shape, slots=64, slot_size=64, cpus=None, local_transport=None):
+    """
+    Starts `count` decoder processes, each with its own ring. They read the lanes of the `local_transport`
+        `TransitionRing`, or without one, of a ring that `fan_out` fills from the experience stream. Returns the rings,
+        the processes and the ring to fan out to, None with a local transport.
+    """
+    context = torch.multiprocessing.get_context("spawn")
+
+    input_ring = None
+    if local_transport is None:
+        input_ring = TransitionRing(f"undecoded_{os.getpid()}", lanes=count, slots=32, slot_size=1 << 19)
+
+    rings = []
+    processes = []
+    for index in range(count):
+        ring = DecodedBatchRing(f"decoded_{os.getpid()}_{index}", slots, slot_size, window, features,
+                                recurrent_shape)
+
+        process = context.Process(target=run_decoder, args=(
+            index, count, input_ring.name if input_ring is not None else local_transport, ring.settings(), cpus),
+            daemon=True)
+        process.start()
+
+        rings.append(ring)
+        processes.append(process)
+
+    return rings, processes, input_ring
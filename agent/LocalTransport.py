@@ -0,0 +1,309 @@
+import ctypes
+import os
+import time
+
+import numpy as np
+import torch
+
+from SharedArrays import create_shared_array, attach_shared_array, release_segments, SharedDescription, ProcessLock
+
+
+if os.name == "nt":
+    from ctypes import wintypes
+
+    kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    kernel32.OpenProcess.argtypes = (wintypes.DWORD, wintypes.BOOL, wintypes.DWORD)
+    kernel32.OpenProcess.restype = wintypes.HANDLE
+    kernel32.GetExitCodeProcess.argtypes = (wintypes.HANDLE, ctypes.POINTER(wintypes.DWORD))
+    kernel32.CloseHandle.argtypes = (wintypes.HANDLE,)
+
+    PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+    ERROR_ACCESS_DENIED = 5
+    STILL_ACTIVE = 259
+
+
+def process_alive(pid):
+    """
+    Whether the process is running, without signalling it. On Windows os.kill(pid, 0) would terminate it, so the
+        process is opened and its exit code checked instead.
+    """
+    if os.name == "nt":
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            # Processes of other users exist but can't be opened
+            return ctypes.get_last_error() == ERROR_ACCESS_DENIED
+
+        try:
+            exit_code = wintypes.DWORD()
+            return bool(kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))) and \
+                exit_code.value == STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+class TransitionRing:
+    """
+    Experience messages from the workers on this machine to the node, in shared memory instead of through Redis.
+
+    Every worker claims a lane of its own once, under a file lock, and from then on is the only writer of that lane
+        while the node is the only reader. A lane is a ring of `slots` fixed-size slots with a write and a read counter,
+        the writer fills a slot before moving the write counter past it and the reader is done with it before moving
+        the read counter, so sending and receiving never take a lock. Lanes of workers that exited are reused.
+
+    Works on POSIX systems and on Windows, where the workers run, but only between processes on the same machine.
+    """
+    # owner pid, write counter, read counter
+    OWNER, WRITE, READ = 0, 1, 2
+
+    def __init__(self, name, lanes=32, slots=16, slot_size=1 << 18, create=True):
+        self.name = name
+        self.lanes = lanes
+        self.slots = slots
+        self.slot_size = slot_size
+        self.create = create
+
+        make = create_shared_array if create else attach_shared_array
+        segment, self.counters = make(f"{name}_counters", (lanes, 3), np.int64)
+        self.segments = [segment]
+        segment, self.sizes = make(f"{name}_sizes", (lanes, slots), np.int64)
+        self.segments.append(segment)
+        segment, self.data = make(f"{name}_data", (lanes, slots, slot_size), np.uint8)
+        self.segments.append(segment)
+
+        if create:
+            self.description = SharedDescription(f"{name}_description", create=True)
+            self.description.write({"lanes": lanes, "slots": slots, "slot_size": slot_size, "node": os.getpid()})
+            self.node = os.getpid()
+
+        self.lock = ProcessLock(name)
+
+    @classmethod
+    def attach(cls, name, timeout=30.0):
+        description, settings = SharedDescription.wait(f"{name}_description", "slot_size", timeout)
+
+        ring = cls(name, settings["lanes"], settings["slots"], settings["slot_size"], create=False)
+        ring.description = description
+        ring.node = settings["node"]
+
+        return ring
+
+    def claim_lane(self):
+        with self.lock:
+            for lane in range(self.lanes):
+                owner = int(self.counters[lane, self.OWNER])
+                if owner == 0 or not process_alive(owner):
+                    self.counters[lane, self.OWNER] = os.getpid()
+                    return TransitionLane(self, lane)
+
+        raise RuntimeError(f"All {self.lanes} lanes of {self.name} are taken, start the node with more")
+
+    def close(self):
+        self.counters = self.sizes = self.data = None
+        release_segments(self.segments + [self.description.segment], unlink=self.create)
+        self.lock.close()
+
+
+class TransitionLane:
+    """
+    A worker's end of a `TransitionRing`, sends messages the way the Redis stream does for `ExperiencePublisher`.
+    """
+    def __init__(self, ring: TransitionRing, lane):
+        self.ring = ring
+        self.lane = lane
+
+    def send(self, data):
+        """
+        Writes one message. Returns the messages the node hasn't read yet, or None when the lane is full.
+        """
+        ring = self.ring
+        if len(data) > ring.slot_size:
+            raise ValueError(f"Message of {len(data)} bytes doesn't fit in a {ring.slot_size} byte slot, publish "
+                             f"fewer transitions at a time")
+
+        counters = ring.counters[self.lane]
+        write, read = int(counters[ring.WRITE]), int(counters[ring.READ])
+        if write - read >= ring.slots:
+            # The segment of a node that exited is never read again
+            if not process_alive(ring.node):
+                raise RuntimeError(f"The node that created {ring.name} exited, restart the worker with the node")
+            return None
+
+        slot = write % ring.slots
+        ring.data[self.lane, slot, :len(data)] = np.frombuffer(data, dtype=np.uint8)
+        ring.sizes[self.lane, slot] = len(data)
+        counters[ring.WRITE] = write + 1
+
+        return write + 1 - read
+
+    def backlog(self):
+        counters = self.ring.counters[self.lane]
+        return int(counters[self.ring.WRITE] - counters[self.ring.READ])
+
+    def release(self):
+        self.ring.counters[self.lane, self.ring.OWNER] = 0
+
+
+class LaneReader:
+    """
+    The node's end of a `TransitionRing`, read like an `ExperienceStream`. Reads the lanes for which `owns(lane)` is
+        true, all of them by default.
+    """
+    def __init__(self, ring: TransitionRing, owns=None, count=64, block=0.1):
+        self.ring = ring
+        self.lanes = [lane for lane in range(ring.lanes) if owns is None or owns(lane)]
+        self.count = count
+        self.block = block
+
+        self.next = {lane: int(ring.counters[lane, ring.READ]) for lane in self.lanes}
+
+    def read(self):
+        ring = self.ring
+        deadline = time.time() + self.block
+
+        messages = []
+        while True:
+            for lane in self.lanes:
+                position = self.next[lane]
+                write = int(ring.counters[lane, ring.WRITE])
+                while position < write and len(messages) < self.count:
+                    slot = position % ring.slots
+                    messages.append(((lane, position), ring.data[lane, slot, :ring.sizes[lane, slot]].tobytes()))
+                    position += 1
+
+                self.next[lane] = position
+
+            if messages or time.time() > deadline:
+                return messages
+
+            time.sleep(0.001)
+
+    def ack(self, message_ids):
+        # Slots are given back in order, up to the last acknowledged message of each lane
+        for lane, position in message_ids:
+            self.ring.counters[lane, self.ring.READ] = max(int(self.ring.counters[lane, self.ring.READ]), position + 1)
+
+    def reconnected(self):
+        pass
+
+
+class SharedWeights:
+    """
+    Model weights in shared memory for workers on the same machine as the node, at full precision and without
+        copies through Redis. The segment is laid out for the state dict it was created with.
+
+    Updates are guarded by a sequence number that is odd while weights are written. A reader that sees it change
+        while it copies, or odd to begin with, copies again.
+    """
+    def __init__(self, name, state_dict=None):
+        self.name = name
+        self.create = state_dict is not None
+
+        if self.create:
+            layout = []
+            offset = 0
+            for tensor_name, tensor in state_dict.items():
+                nbytes = tensor.numel() * tensor.element_size()
+                layout.append({"name": tensor_name, "shape": list(tensor.shape),
+                               "dtype": str(tensor.detach().cpu().numpy().dtype), "offset": offset, "size": nbytes})
+
+                # Every tensor starts aligned for any dtype
+                offset += (nbytes + 7) // 8 * 8
+
+            # sequence, version
+            self.header_segment, self.header = create_shared_array(f"{name}_header", (2,), np.int64)
+            self.segment, self.buffer = create_shared_array(f"{name}_buffer", (max(1, offset),), np.uint8)
+
+            self.description = SharedDescription(f"{name}_description", create=True)
+            self.description.write({"tensors": layout, "size": offset})
+        else:
+            self.description, document = SharedDescription.wait(f"{name}_description", "tensors")
+            layout = document["tensors"]
+
+            self.header_segment, self.header = attach_shared_array(f"{name}_header", (2,), np.int64)
+            self.segment, self.buffer = attach_shared_array(f"{name}_buffer", (max(1, document["size"]),), np.uint8)
+
+        self.views = {
+            tensor["name"]: self.buffer[tensor["offset"]:tensor["offset"] + tensor["size"]].view(tensor["dtype"])
+            .reshape(tensor["shape"]) for tensor in layout
+        }
+
+    def close(self):
+        self.views = self.buffer = self.header = None
+        release_segments([self.header_segment, self.segment, self.description.segment], unlink=self.create)
+
+
+class SharedWeightPublisher(SharedWeights):
+    """
+    Writes weights for `SharedWeightSubscriber`s, in place of a `WeightPublisher`.
+    """
+    def __init__(self, name, state_dict):
+        super().__init__(name, state_dict)
+
+        self.version = 0
+        self.last_bytes = 0
+        self.last_raw_bytes = 0
+        self.last_changed = 0
+
+    def publish(self, state_dict):
+        self.header[0] += 1
+        for tensor_name, tensor in state_dict.items():
+            self.views[tensor_name][...] = tensor.detach().cpu().numpy()
+        self.version += 1
+        self.header[1] = self.version
+        self.header[0] += 1
+
+        self.last_bytes = self.last_raw_bytes = self.buffer.nbytes
+        self.last_changed = len(self.views)
+
+        return self.version
+
+
+class SharedWeightSubscriber(SharedWeights):
+    """
+    Loads weights from a `SharedWeightPublisher`, in place of a `WeightSubscriber`.
+    """
+    def __init__(self, name):
+        super().__init__(name)
+
+        self.version = 0
+        self.last_bytes = 0
+        self.last_latency = 0.0
+
+    def poll(self):
+        version = int(self.header[1])
+        return version if version > self.version else None
+
+    def update(self, model: torch.nn.Module):
+        if self.poll() is None:
+            return False
+
+        start_time = time.perf_counter()
+        state = model.state_dict()
+        with torch.no_grad():
+            while True:
+                sequence = int(self.header[0])
+                if sequence % 2 == 1:
+                    time.sleep(0.0001)
+                    continue
+
+                version = int(self.header[1])
+                for tensor_name, view in self.views.items():
+                    state[tensor_name].copy_(torch.from_numpy(view.copy()))
+
+                if int(self.header[0]) == sequence:
+                    break
+
+        self.version = version
+        self.last_bytes = self.buffer.nbytes
+        self.last_latency = time.perf_counter() - start_time
+
+        return True
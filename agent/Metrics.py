@@ -0,0 +1,317 @@
+import json
+import math
+import time
+
+from bisect import bisect_left, insort
+from collections import deque
+
+import numpy as np
+
+from redis import Redis
+
+
+class RollingWindow:
+    """
+    The last `size` episodes, with their count, mean, percentiles and reward component means kept up to date as
+        episodes come and go. Scores are also kept sorted, so every query is a lookup instead of a pass over the
+        window.
+    """
+    def __init__(self, size=100):
+        self.size = size
+
+        self.episodes = deque()
+        self.sorted_scores = []
+        self.score_sum = 0.0
+        self.component_sums = {}
+        self.additions = 0
+
+        self.last_update = time.time()
+
+    def __len__(self):
+        return len(self.episodes)
+
+    def add(self, score, components=None):
+        components = components or {}
+
+        self.episodes.append((score, components))
+        insort(self.sorted_scores, score)
+        self.score_sum += score
+        for name, value in components.items():
+            self.component_sums[name] = self.component_sums.get(name, 0.0) + value
+
+        if len(self.episodes) > self.size:
+            old_score, old_components = self.episodes.popleft()
+
+            del self.sorted_scores[bisect_left(self.sorted_scores, old_score)]
+            self.score_sum -= old_score
+            for name, value in old_components.items():
+                self.component_sums[name] -= value
+
+        # Adding and subtracting leaves rounding errors behind, once per window the sums start over from the episodes
+        self.additions += 1
+        if self.additions % self.size == 0:
+            self.score_sum = math.fsum(score for score, _ in self.episodes)
+            self.component_sums = {name: math.fsum(episode.get(name, 0.0) for _, episode in self.episodes)
+                                   for name in self.component_sums}
+
+        self.last_update = time.time()
+
+    def mean(self):
+        return self.score_sum / len(self.episodes) if self.episodes else 0.0
+
+    def percentile(self, q):
+        """
+        Nearest-rank percentile of the scores, `q` from 0 to 100.
+        """
+        if not self.sorted_scores:
+            return 0.0
+
+        return self.sorted_scores[min(len(self.sorted_scores) - 1, int(q / 100 * len(self.sorted_scores)))]
+
+    def component_means(self):
+        return {name: total / len(self.episodes) for name, total in self.component_sums.items()} \
+            if self.episodes else {}
+
+    def summary(self):
+        return {
+            "count": len(self.episodes),
+            "mean": self.mean(),
+            "p10": self.percentile(10),
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "max": self.sorted_scores[-1] if self.sorted_scores else 0.0,
+        }
+
+
+def publish_episode(redis: Redis, worker_name, score, steps, reward_components=None, stream="metrics:episodes",
+                    max_length=10000):
+    """
+    Reports a finished episode. The stream keeps about `max_length` episodes, older ones are trimmed.
+    """
+    redis.xadd(stream, {
+        "worker": worker_name,
+        "score": score,
+        "steps": steps,
+        "components": json.dumps(reward_components or {}),
+    }, maxlen=max_length, approximate=True)
+
+
+class EpisodeMetrics:
+    """
+    Rolling episode statistics of the whole fleet and of every worker, fed from the episodes workers report with
+        `publish_episode`. Each `update` only reads the episodes reported since the last one. Workers that haven't
+        reported anything for `worker_timeout` seconds are forgotten.
+    """
+    def __init__(self, redis: Redis, stream="metrics:episodes", window=100, worker_window=20, worker_timeout=600):
+        self.redis = redis
+        self.stream = stream
+        self.worker_window = worker_window
+        self.worker_timeout = worker_timeout
+
+        self.episodes = RollingWindow(window)
+        self.workers = {}
+        self.steps = 0
+
+        # Starts from the most recent episodes, so a restarted node has full windows right away
+        recent = redis.xrevrange(stream, count=window)
+        self.last_id = recent[0][0] if recent else "0"
+        for _, fields in reversed(recent):
+            self.add(fields)
+
+    def add(self, fields):
+        worker_name = fields[b"worker"].decode()
+        score = float(fields[b"score"])
+        components = json.loads(fields[b"components"])
+
+        self.episodes.add(score, components)
+        self.steps += int(fields[b"steps"])
+
+        worker = self.workers.get(worker_name)
+        if worker is None:
+            worker = self.workers[worker_name] = RollingWindow(self.worker_window)
+        worker.add(score, components)
+
+    def update(self):
+        """
+        Reads the episodes reported since the last update. Returns how many there were.
+        """
+        count = 0
+        while True:
+            response = self.redis.xread({self.stream: self.last_id}, count=1000)
+            entries = response[0][1] if response else []
+            if not entries:
+                break
+
+            for _, fields in entries:
+                self.add(fields)
+
+            self.last_id = entries[-1][0]
+            count += len(entries)
+
+        now = time.time()
+        for worker_name in [name for name, worker in self.workers.items()
+                            if now - worker.last_update > self.worker_timeout]:
+            del self.workers[worker_name]
+
+        return count
+
+    def worker_means(self):
+        return {worker_name: worker.mean() for worker_name, worker in self.workers.items()}
+
+
+class WorkerTelemetry:
+    """
+    Measures a worker's environment steps and sends them to the node as a heartbeat every `interval` seconds: steps
+        per second, the time steps spent waiting for emulator frames, the 99th percentile step time, and the worker's
+        episodes, model version, watchdog restarts and level. Every heartbeat covers the steps since the last one, and
+        carries the time it was sent.
+    """
+    def __init__(self, redis: Redis, worker_name, interval=10.0, stream="metrics:heartbeats", max_length=10000):
+        self.redis = redis
+        self.worker_name = worker_name
+        self.interval = interval
+        self.stream = stream
+        self.max_length = max_length
+
+        self.step_times = []
+        self.frame_wait_time = 0.0
+        self.last_heartbeat = time.time()
+
+    def step(self, duration, frame_wait_time):
+        """
+        Records one environment step that took `duration` seconds, `frame_wait_time` of which waiting for frames.
+        """
+        self.step_times.append(duration)
+        self.frame_wait_time += frame_wait_time
+
+    def due(self):
+        return time.time() - self.last_heartbeat >= self.interval
+
+    def heartbeat(self, episodes, model_version, restarts, level):
+        now = time.time()
+        elapsed = max(now - self.last_heartbeat, 1e-6)
+        steps = len(self.step_times)
+
+        self.redis.xadd(self.stream, {
+            "worker": self.worker_name,
+            "time": now,
+            "steps_per_second": steps / elapsed,
+            "frame_wait_ms": self.frame_wait_time / steps * 1000 if steps else 0.0,
+            "step_p99_ms": float(np.percentile(self.step_times, 99)) * 1000 if steps else 0.0,
+            "episodes": episodes,
+            "model_version": model_version,
+            "restarts": restarts,
+            "level": level,
+        }, maxlen=self.max_length, approximate=True)
+
+        self.step_times = []
+        self.frame_wait_time = 0.0
+        self.last_heartbeat = now
+
+
+class FleetTelemetry:
+    """
+    The latest heartbeat of every worker, from `WorkerTelemetry`, and the fleet they add up to. Each `update` only
+        reads the heartbeats sent since the last one.
+
+    A worker is a straggler when its steps per second are below `straggler_ratio` of the fleet's median, when it runs
+        a model more than `max_version_lag` versions behind the newest, or when it hasn't sent a heartbeat for
+        `silence` seconds. Workers silent for `worker_timeout` seconds are forgotten. Silence is measured from when
+        the heartbeat was sent, so heartbeats that queued up while the node was busy don't look fresh.
+    """
+    def __init__(self, redis: Redis, stream="metrics:heartbeats", straggler_ratio=0.5, max_version_lag=5,
+                 silence=60, worker_timeout=600):
+        self.redis = redis
+        self.stream = stream
+        self.straggler_ratio = straggler_ratio
+        self.max_version_lag = max_version_lag
+        self.silence = silence
+        self.worker_timeout = worker_timeout
+
+        self.workers = {}
+
+        # Heartbeats sent before the node started are too old to say anything
+        latest = redis.xrevrange(stream, count=1)
+        self.last_id = latest[0][0] if latest else "0"
+
+    def update(self):
+        """
+        Reads the heartbeats sent since the last update. Returns how many there were.
+        """
+        count = 0
+        while True:
+            response = self.redis.xread({self.stream: self.last_id}, count=1000)
+            entries = response[0][1] if response else []
+            if not entries:
+                break
+
+            for entry_id, fields in entries:
+                heartbeat = {key.decode(): float(value) for key, value in fields.items() if key != b"worker"}
+
+                # Heartbeats from workers that don't send the time yet are dated by their entry ID, in milliseconds
+                if "time" not in heartbeat:
+                    heartbeat["time"] = int(entry_id.split(b"-")[0]) / 1000
+                self.workers[fields[b"worker"].decode()] = heartbeat
+
+            self.last_id = entries[-1][0]
+            count += len(entries)
+
+        now = time.time()
+        for worker_name in [name for name, worker in self.workers.items()
+                            if now - worker["time"] > self.worker_timeout]:
+            del self.workers[worker_name]
+
+        return count
+
+    def stragglers(self):
+        """
+        Returns the reasons each straggling worker is one for, by worker name.
+        """
+        now = time.time()
+        active = {name: worker for name, worker in self.workers.items() if now - worker["time"] <= self.silence}
+
+        median_rate = float(np.median([worker["steps_per_second"] for worker in active.values()])) if active else 0.0
+        newest_version = max((worker["model_version"] for worker in active.values()), default=0)
+
+        stragglers = {}
+        for name, worker in self.workers.items():
+            reasons = []
+            if name not in active:
+                reasons.append("silent for %.0fs" % (now - worker["time"]))
+            else:
+                if worker["steps_per_second"] < self.straggler_ratio * median_rate:
+                    reasons.append("%.1f steps/sec against a median of %.1f" % (worker["steps_per_second"],
+                                                                                median_rate))
+                if newest_version - worker["model_version"] > self.max_version_lag:
+                    reasons.append("model version %d of %d" % (worker["model_version"], newest_version))
+
+            if reasons:
+                stragglers[name] = reasons
+
+        return stragglers
+
+    def summary(self):
+        now = time.time()
+        active = [worker for worker in self.workers.values() if now - worker["time"] <= self.silence]
+
+        def mean(key):
+            return float(np.mean([worker[key] for worker in active])) if active else 0.0
+
+        return {
+            "workers": len(active),
+            "steps_per_second": sum(worker["steps_per_second"] for worker in active),
+            "frame_wait_ms": mean("frame_wait_ms"),
+            "step_p99_ms": max((worker["step_p99_ms"] for worker in active), default=0.0),
+            "restarts": int(sum(worker["restarts"] for worker in self.workers.values())),
+            "stragglers": len(self.stragglers()),
+        }
+
+    def publish(self, key="metrics:fleet", expire=600):
+        """
+        Stores the fleet view in Redis, for tools that query it while the node runs.
+        """
+        self.redis.set(key, json.dumps({
+            "summary": self.summary(),
+            "workers": self.workers,
+            "stragglers": self.stragglers(),
+        }), ex=expire)
@@ -7,9 +7,12 @@ import torch.optim as optim
 
 
 class DeepQNetwork(nn.Module):
-    def __init__(self, lr, feature_count, hidden_dims, n_actions, num_layers=3, lstm_units=256):
+    def __init__(self, lr, feature_count, hidden_dims, n_actions, num_layers=3, lstm_units=256, mixed_precision=False):
         super(DeepQNetwork, self).__init__()
 
+        # Run forward (and so backward) passes in bfloat16 through autocast, weights stay in fp32
+        self.mixed_precision = mixed_precision
+
         self.hidden_dims = hidden_dims
         self.n_actions = n_actions
         self.num_layers = num_layers
@@ -70,9 +73,33 @@ class DeepQNetwork(nn.Module):
 
     def forward(self, state, hidden_state=None, cell_state=None):
         if hidden_state is None or cell_state is None:
-            hidden_state = torch.zeros(self.num_layers, state.size(0), self.lstm_units).to(self.device)
-            cell_state = torch.zeros(self.num_layers, state.size(0), self.lstm_units).to(self.device)
+            hidden_state, cell_state = self.initial_state(state.size(0))
+
+        with self.autocast():
+            x = self.encode(state)
+
+            # LSTM
+            out, (hidden_state, cell_state) = self.lstm(x, (hidden_state, cell_state))
+
+            actions = self.head(out[:, -1, :])
+
+        # Outputs are always fp32 so losses, TD-errors and priorities are computed in full precision
+        return actions.float(), (hidden_state.float(), cell_state.float())
 
+    def autocast(self):
+        return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.mixed_precision)
+
+    def initial_state(self, batch_size):
+        hidden_state = torch.zeros(self.num_layers, batch_size, self.lstm_units).to(self.device)
+        cell_state = torch.zeros(self.num_layers, batch_size, self.lstm_units).to(self.device)
+
+        return hidden_state, cell_state
+
+    def encode(self, state):
+        """
+        Encodes every observation in the sequence independently, producing the LSTM input features. Because no
+            information crosses frames here, features of overlapping windows can be computed once and shared.
+        """
         x = F.leaky_relu(self.fc0(state[:, :, :11]), 0.01)
         # x = F.leaky_relu(self.fc0(state), 0.01)
         #x = self.bn0(x)
@@ -96,12 +123,10 @@ class DeepQNetwork(nn.Module):
         cnn_out = cnn_out.reshape(batch_size, num_observations, -1)
 
         # Concatenate the CNN output with the non-raycasting part of state
-        x = torch.cat((x, cnn_out), dim=2)
+        return torch.cat((x, cnn_out), dim=2)
 
-        # LSTM
-        out, (hidden_state, cell_state) = self.lstm(x, (hidden_state, cell_state))
-
-        x = F.leaky_relu(self.fc1(out[:, -1, :]), 0.01)
+    def head(self, x):
+        x = F.leaky_relu(self.fc1(x), 0.01)
         x = self.bn1(x)
 
         x = F.leaky_relu(self.fc2(x), 0.01)
@@ -113,10 +138,92 @@ class DeepQNetwork(nn.Module):
         value = self.value_stream(x)
         advantages = self.advantage_stream(x)
 
-        actions = value + (advantages - advantages.mean(dim=1, keepdim=True))
+        return value + (advantages - advantages.mean(dim=1, keepdim=True))
+
+    @torch.no_grad()
+    def burn_in(self, frames, lengths, hidden_state, cell_state):
+        """
+        Runs the LSTM from a stored recurrent state over the first `lengths[i]` frames of each sequence in `frames`,
+            returning the recurrent state after the last of them. Sequences with no frames keep their stored state.
+        """
+        with self.autocast():
+            x = self.encode(frames)
 
-        return actions, (hidden_state, cell_state)
+            packed = nn.utils.rnn.pack_padded_sequence(x, lengths.clamp(min=1).cpu(), batch_first=True,
+                                                       enforce_sorted=False)
+            _, (burnt_hidden, burnt_cell) = self.lstm(packed, (hidden_state, cell_state))
+
+        empty = (lengths == 0).to(self.device).view(1, -1, 1)
+
+        return (torch.where(empty, hidden_state, burnt_hidden.float()),
+                torch.where(empty, cell_state, burnt_cell.float()))
+
+    def forward_pair(self, window, hidden_state, cell_state, next_hidden_state, next_cell_state):
+        """
+        Evaluates both the current and the next state of a batch of transitions from a single window of
+            `sequence_length + 1` observations, where `window[:, :-1]` is the state and `window[:, 1:]` the next state.
+
+        The observations are encoded once and shared between both sequences. The next state is only used to pick the
+            greedy action, so its LSTM pass and head run without recording a graph for the backward pass.
+        """
+        with self.autocast():
+            x = self.encode(window)
+
+            out, _ = self.lstm(x[:, :-1], (hidden_state, cell_state))
+            q_values = self.head(out[:, -1, :])
+
+            with torch.no_grad():
+                out, _ = self.lstm(x[:, 1:].detach(), (next_hidden_state, next_cell_state))
+                q_next = self.head(out[:, -1, :])
+
+        return q_values.float(), q_next.float()
 
     def freeze(self):
         for param in self.parameters():
             param.requires_grad = False
+
+
+class TargetNetworkUpdater:
+    """
+    Updates a target network from a source network in place, either as a hard copy or as a soft (Polyak) update,
+        target = (1 - tau) * target + tau * source.
+
+    The tensor lists are gathered once up front, so an update is a handful of fused foreach kernels over existing
+        storage and allocates nothing.
+    """
+    def __init__(self, source: nn.Module, target: nn.Module):
+        source_state = source.state_dict(keep_vars=True)
+        target_state = target.state_dict(keep_vars=True)
+
+        # Parameters and batch norm running statistics are blended, integer buffers like num_batches_tracked copied
+        self.source_floats, self.target_floats = [], []
+        self.source_others, self.target_others = [], []
+
+        for name, source_tensor in source_state.items():
+            target_tensor = target_state[name]
+
+            if source_tensor.is_floating_point():
+                self.source_floats.append(source_tensor.detach())
+                self.target_floats.append(target_tensor.detach())
+            else:
+                self.source_others.append(source_tensor.detach())
+                self.target_others.append(target_tensor.detach())
+
+    @torch.no_grad()
+    def hard_update(self):
+        if hasattr(torch, "_foreach_copy_"):
+            torch._foreach_copy_(self.target_floats, self.source_floats)
+        else:
+            for target_tensor, source_tensor in zip(self.target_floats, self.source_floats):
+                target_tensor.copy_(source_tensor)
+
+        for target_tensor, source_tensor in zip(self.target_others, self.source_others):
+            target_tensor.copy_(source_tensor)
+
+    @torch.no_grad()
+    def soft_update(self, tau):
+        torch._foreach_mul_(self.target_floats, 1.0 - tau)
+        torch._foreach_add_(self.target_floats, self.source_floats, alpha=tau)
+
+        for target_tensor, source_tensor in zip(self.target_others, self.source_others):
+            target_tensor.copy_(source_tensor)
@@ -52,6 +52,14 @@ class RatchetEnvironment:
             self.current_level_index = 0
 
         self.game.set_level(self.levels[self.current_level_index])
+
+    def set_levels(self, levels):
+        """
+        Changes the levels `cycle_level` goes through and moves to the first of them.
+        """
+        self.levels = list(levels)
+        self.current_level_index = -1
+        self.cycle_level()
             
     def stop(self):
         self.game.close_process()
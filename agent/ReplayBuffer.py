@@ -1,9 +1,16 @@
+import json
+import os
+import time
+
 import torch
 import numpy as np
 
-from collections import namedtuple
+from collections import namedtuple, deque
+
+from queue import Queue, Empty, Full
+from threading import Lock, Thread, Event
 
-from threading import Lock
+from SharedArrays import create_shared_array, attach_shared_array, release_segments, SharedDescription, ProcessLock
 
 
 Transition = namedtuple('Transition', ('state', 'action', 'reward', 'next_state',
@@ -13,25 +20,51 @@ FullTransition = namedtuple('Transition', ('state', 'action', 'reward', 'next_st
 TransitionMessage = namedtuple('TransitionMessage', ('transition', 'worker_name'))
 
 class EpisodeReplayBuffer:
+    """
+    Ring buffer of whole episodes. Transitions live in preallocated arrays indexed by ring position, and an episode
+        index records each episode's start offset, length and generation (a running episode number).
+
+    Episodes are only ever evicted whole, oldest first, so the live episodes are always the generations from
+        `oldest` up to `generation`. Looking an episode up by generation is O(1), and a generation that doesn't
+        match its index slot has been evicted.
+    """
     def __init__(self, capacity):
         self.capacity = capacity
-        self.buffer = []
         self.worker_buffer = {}
-        self.episode_boundaries = []
         self.position = 0
+        self.size = 0
         self.lock = Lock()
 
         self.new_samples = 0
 
+        # Every episode has at least one transition, so there can never be more episodes than transitions
+        self.episode_start = np.zeros(capacity, dtype=np.int64)
+        self.episode_length = np.zeros(capacity, dtype=np.int64)
+        self.episode_generation = np.full(capacity, -1, dtype=np.int64)
+        self.oldest = 0
+        self.generation = 0
+
+        self.arrays = None
+
         self.device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 
-    def add(self, state, action, reward, next_state, done, worker_id="default"):
-        state = torch.tensor(state, dtype=torch.float32).to(self.device)
-        action = torch.tensor(action, dtype=torch.int64).to(self.device)
-        reward = torch.tensor(reward, dtype=torch.float32).to(self.device)
-        next_state = torch.tensor(next_state, dtype=torch.float32).to(self.device)
-        done = torch.tensor(done, dtype=torch.bool).to(self.device)
+    def __len__(self):
+        return self.size
 
+    @property
+    def episodes(self):
+        return self.generation - self.oldest
+
+    def allocate(self, state_shape):
+        self.arrays = {
+            "states": np.zeros((self.capacity, *state_shape), dtype=np.float32),
+            "actions": np.zeros(self.capacity, dtype=np.int64),
+            "rewards": np.zeros(self.capacity, dtype=np.float32),
+            "next_states": np.zeros((self.capacity, *state_shape), dtype=np.float32),
+            "dones": np.zeros(self.capacity, dtype=bool),
+        }
+
+    def add(self, state, action, reward, next_state, done, worker_id="default"):
         # Add to worker buffer
         if worker_id not in self.worker_buffer:
             self.worker_buffer[worker_id] = []
@@ -40,98 +73,572 @@ class EpisodeReplayBuffer:
 
         # If last transition in episode, add to global buffer
         if done:
-            self.position = (self.position + len(self.worker_buffer[worker_id])) % self.capacity
+            self.add_episode(self.worker_buffer.pop(worker_id))
 
-            with self.lock:
-                self.buffer.extend(self.worker_buffer[worker_id])
-                self.buffer = self.buffer[-self.capacity:]
+    def add_episode(self, transitions):
+        # Episodes longer than the whole buffer keep their last transitions
+        transitions = transitions[-self.capacity:]
+        length = len(transitions)
 
-                self.episode_boundaries.append(self.position)
+        if self.arrays is None:
+            self.allocate(np.shape(transitions[0][0]))
 
-                self.new_samples += len(self.worker_buffer[worker_id])
+        states, actions, rewards, next_states, dones = zip(*transitions)
 
-            self.worker_buffer[worker_id] = []
+        with self.lock:
+            # Evict whole episodes until the new one fits
+            while self.size + length > self.capacity:
+                slot = self.oldest % self.capacity
+                self.size -= self.episode_length[slot]
+                self.episode_generation[slot] = -1
+                self.oldest += 1
+
+            positions = (self.position + np.arange(length)) % self.capacity
+
+            self.arrays["states"][positions] = states
+            self.arrays["actions"][positions] = actions
+            self.arrays["rewards"][positions] = rewards
+            self.arrays["next_states"][positions] = next_states
+            self.arrays["dones"][positions] = dones
 
-    def sample(self, episodes: int):
+            slot = self.generation % self.capacity
+            self.episode_start[slot] = self.position
+            self.episode_length[slot] = length
+            self.episode_generation[slot] = self.generation
+
+            self.generation += 1
+            self.position = (self.position + length) % self.capacity
+            self.size += length
+
+            self.new_samples += length
+
+    def get_episode(self, generation):
         """
-        Sample a batch of episodes at the episode boundaries.
+        Returns (start, length) of a stored episode, or None if it has been evicted.
         """
-        if len(self.episode_boundaries) < episodes:
-            return [], [], [], [], []
+        slot = generation % self.capacity
+        if self.episode_generation[slot] != generation:
+            return None
 
-        indices = np.random.choice(self.episode_boundaries, episodes, replace=True)
+        return self.episode_start[slot], self.episode_length[slot]
 
-        self.lock.acquire()
+    def sample(self, episodes: int, padded=False):
+        """
+        Sample a batch of whole episodes.
 
-        # Get the samples starting from the episode boundary until the next episode boundary
-        samples = []
-        for i in indices:
-            end_index = self.position
+        By default the episodes' transitions are concatenated. With `padded`, every field is
+            [episodes, longest episode, ...] with zeros after the end of shorter episodes, and the episode lengths are
+            returned as a sixth element.
+        """
+        if self.episodes < episodes:
+            return [], [], [], [], []
 
-            # Find the end
-            for j in range(i, len(self.episode_boundaries)):
-                if self.episode_boundaries[j] == i:
-                    end_index = self.episode_boundaries[j+1]
-                    break
+        with self.lock:
+            generations = np.random.randint(self.oldest, self.generation, episodes)
+            slots = generations % self.capacity
 
-            samples.extend(self.buffer[i:end_index])
+            starts = self.episode_start[slots]
+            lengths = self.episode_length[slots]
 
-        self.lock.release()
+            steps = np.arange(lengths.max())
+            positions = (starts[:, None] + steps) % self.capacity
+            mask = steps < lengths[:, None]
 
-        if len(samples) <= 0:
-            return [], [], [], [], []
+            if padded:
+                # The padding is a zero of each field's own type, so dones stay a boolean mask
+                batch = [np.where(mask.reshape(*mask.shape, *([1] * (array.ndim - 1))), array[positions],
+                                  np.zeros((), dtype=array.dtype))
+                         for array in self.arrays.values()]
+            else:
+                batch = [array[positions[mask]] for array in self.arrays.values()]
 
-        batch = Transition(*zip(*samples))
-        states, actions, rewards, next_states, dones = map(lambda x: torch.stack(x).to(self.device), batch)
+        states, actions, rewards, next_states, dones = (torch.from_numpy(field).to(self.device) for field in batch)
 
         self.new_samples = 0
 
+        if padded:
+            return states, actions, rewards, next_states, dones, torch.from_numpy(lengths)
+
         return states, actions, rewards, next_states, dones
 
 
+class SumTree:
+    """
+    Binary sum tree over a fixed number of leaves, stored in one NumPy array with the root at index 1 and the leaves
+        at `size` to `2 * size - 1`. Lookups, updates and batched sampling are O(log N).
+    """
+    def __init__(self, capacity, tree=None):
+        self.capacity = capacity
+        self.size = 1 << max(0, (capacity - 1).bit_length())
+        self.depth = self.size.bit_length() - 1
+
+        # An existing array, like a memory-mapped one, can be passed in to hold the tree
+        self.tree = tree if tree is not None else np.zeros(2 * self.size, dtype=np.float64)
+
+    def rebuild(self):
+        # Recomputes every parent from the leaves
+        for level in range(self.depth - 1, -1, -1):
+            nodes = np.arange(1 << level, 2 << level)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def __getitem__(self, indices):
+        return self.tree[np.asarray(indices) + self.size]
+
+    def set(self, index, value):
+        # Scalar path for single inserts, cheaper than the vectorized update for one leaf
+        tree = self.tree
+        node = index + self.size
+        tree[node] = value
+
+        node >>= 1
+        while node >= 1:
+            tree[node] = tree[2 * node] + tree[2 * node + 1]
+            node >>= 1
+
+    def update(self, indices, values):
+        nodes = np.asarray(indices, dtype=np.int64) + self.size
+        self.tree[nodes] = values
+
+        # Recompute the parents level by level, every level is one vectorized operation. Parents shared by several
+        # nodes are written more than once, but always with the same sum
+        for _ in range(self.depth):
+            nodes >>= 1
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        """
+        Returns the leaf indices where the cumulative sum of the leaves passes each of `values`.
+        """
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+
+        for _ in range(self.depth):
+            left = 2 * nodes
+            left_sum = self.tree[left]
+
+            # Never step into an empty subtree, which rounding at the very end of the range could otherwise do
+            go_right = (values > left_sum) & (self.tree[left + 1] > 0)
+
+            values -= left_sum * go_right
+            nodes = left + go_right
+
+        return nodes - self.size
+
+    def sample(self, batch_size):
+        """
+        Stratified sampling: the total is split into `batch_size` equal segments and one leaf is drawn from each.
+        """
+        segment = self.total / batch_size
+        values = (np.arange(batch_size) + np.random.uniform(size=batch_size)) * segment
+
+        return self.find(values)
+
+
 class PrioritizedReplayBuffer:
-    def __init__(self, capacity, alpha=0.6):
+    """
+    Prioritized replay with structure-of-arrays storage. Every field is one preallocated tensor indexed by ring
+        position, allocated on the first `add` when the state and recurrent state shapes are known.
+
+    Sampling probabilities are priority ** alpha over the sum of all of them, kept in a sum tree. New transitions get
+        the highest priority seen so far.
+
+    With `deduplicate_frames`, the state windows aren't stored per transition. Each observation is stored once in a
+        frame ring, linked to the previous frame of the same worker's stream, and transitions only point at the frame
+        of their newest observation. Windows are rebuilt when sampling by following the links, with zeros before the
+        start of an episode. The frame ring is `frame_margin` larger than the transition ring, since windows reach
+        back into frames older than the oldest transition. A link to a frame that has been overwritten anyway is
+        treated like an episode start. A transition whose own two frames, the newest of its state and of its next
+        state, are overwritten can't be rebuilt, and is dropped by setting its priority to zero.
+
+    With a `path`, every array, the sum tree included, is a memory-mapped .npy file in that directory, so capacity
+        isn't limited by RAM and the OS page cache keeps whatever is sampled often resident. `flush` writes the ring
+        position and counters to metadata.json, and a buffer created on a directory that has one reopens where the
+        last flush left off. Transitions added after the last flush may be lost.
+
+    Observations can be stored as float16, or quantized to uint8 or int16 with an affine mapping of
+        `observation_range`, a (low, high) pair of scalars or per-feature arrays. The environment normalizes every
+        feature to [-1, 1], which is the default. The integer zero point makes 0.0, the padding value, exact, and values
+        outside the range are clipped. Samples are dequantized to float32 in one vectorized operation.
+    """
+    def __init__(self, capacity, alpha=0.6, deduplicate_frames=False, frame_margin=0.25, path=None,
+                 observation_dtype="float32", observation_range=(-1.0, 1.0)):
         self.capacity = capacity
         self.alpha = alpha
-        self.buffer = [None] * capacity
-        self.priorities = [1] * capacity
+        self.deduplicate_frames = deduplicate_frames
+        self.observation_dtype = np.dtype(observation_dtype)
+        self.observation_range = observation_range
+        self.frame_margin = frame_margin
+        self.frame_capacity = capacity + max(1, int(capacity * frame_margin))
+        self.frame_position = 0
+        self.frame_total = 0
+        self.streams = {}
+        self.sequence_length = None
+        self.state_shape = None
+        self.recurrent_shape = None
+        self.priorities = SumTree(capacity)
         self.position = 0
         self.total = 0
         self.lock = Lock()
         self.new_samples = 0
         self.max_priority = 1
+        self.path = path
+
+        if self.observation_dtype.kind in "iu":
+            info = np.iinfo(self.observation_dtype)
+            low, high = (np.asarray(bound, dtype=np.float32) for bound in observation_range)
+            levels = float(info.max) - float(info.min)
+
+            # Stored value = round(observation / step) + zero point, with the zero point an integer
+            self.quantization_step = ((high - low) / levels).astype(np.float32)
+            self.quantization_zero = (np.round(-low / self.quantization_step) + info.min).astype(np.float32)
+            self.quantization_limits = (info.min, info.max)
+
+        self.arrays = None
+        self.states = None
+        self.next_states = None
+        self.actions = None
+        self.rewards = None
+        self.dones = None
+        self.hidden_states = None
+        self.cell_states = None
+        self.next_hidden_states = None
+        self.next_cell_states = None
 
         self.device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 
-    def add(self, state, action, reward, next_state, done, next_hidden_state, next_cell_state):
-        max_priority = self.max_priority
+        if path is not None and os.path.exists(os.path.join(path, "metadata.json")):
+            self.reopen()
 
-        state = torch.tensor(state, dtype=torch.float32)
-        action = torch.tensor(action, dtype=torch.int64)
-        reward = torch.tensor(reward, dtype=torch.float32)
-        next_state = torch.tensor(next_state, dtype=torch.float32)
-        done = torch.tensor(done, dtype=torch.bool)
+    def __len__(self):
+        return min(self.total, self.capacity)
 
-        next_hidden_state = next_hidden_state
-        next_cell_state = next_cell_state
+    def create_array(self, name, shape, dtype, fill=0):
+        if self.path is None:
+            return np.full(shape, fill, dtype=dtype)
 
-        # Link "current" hidden state to previous transitions' next_hidden_state
-        if self.total > 0:
-            # If last transition was terminal, reset hidden and cell state
-            if self.buffer[self.position-1][4]:
-                hidden_state = torch.zeros_like(next_hidden_state)
-                cell_state = torch.zeros_like(next_cell_state)
-            else:
-                hidden_state = self.buffer[self.position-1][7]
-                cell_state = self.buffer[self.position-1][8]
+        # New files are sparse, disk space is only used as the ring fills up
+        array = np.lib.format.open_memmap(os.path.join(self.path, f"{name}.npy"), mode="w+", dtype=dtype, shape=shape)
+        if fill != 0:
+            array[:] = fill
+
+        return array
+
+    def fields(self, state_shape, recurrent_shape):
+        """
+        Returns {name: (shape, dtype, initial value)} of every stored array.
+        """
+        fields = {}
+        if self.deduplicate_frames:
+            fields.update({
+                "transition_frames": ((self.capacity,), np.int64, 0),
+                "transition_serials": ((self.capacity,), np.int64, -1),
+                "frames": ((self.frame_capacity, *state_shape[1:]), self.observation_dtype, 0),
+                "frame_serials": ((self.frame_capacity,), np.int64, -1),
+                "frame_previous": ((self.frame_capacity,), np.int64, -1),
+                "frame_previous_serials": ((self.frame_capacity,), np.int64, -1),
+
+                # Transition whose state's newest frame is in the slot, dropped when the slot is written again
+                "frame_transitions": ((self.frame_capacity,), np.int64, -1),
+            })
+        else:
+            fields.update({
+                "states": ((self.capacity, *state_shape), self.observation_dtype, 0),
+                "next_states": ((self.capacity, *state_shape), self.observation_dtype, 0),
+            })
+
+        fields.update({
+            "actions": ((self.capacity,), np.int64, 0),
+            "rewards": ((self.capacity,), np.float32, 0),
+            "dones": ((self.capacity,), bool, 0),
+
+            # Recurrent states are stored without their batch dimension of 1, as [capacity, num_layers, lstm_units]
+            "hidden_states": ((self.capacity, *recurrent_shape), np.float32, 0),
+            "cell_states": ((self.capacity, *recurrent_shape), np.float32, 0),
+            "next_hidden_states": ((self.capacity, *recurrent_shape), np.float32, 0),
+            "next_cell_states": ((self.capacity, *recurrent_shape), np.float32, 0),
+        })
+
+        return fields
+
+    def allocate(self, state_shape, recurrent_shape):
+        self.sequence_length = state_shape[0]
+        self.state_shape = tuple(state_shape)
+        self.recurrent_shape = tuple(recurrent_shape)
+
+        if self.path is not None:
+            os.makedirs(self.path, exist_ok=True)
+
+        # Storage is allocated through NumPy and shared with the tensors, element writes are much cheaper on the arrays
+        self.arrays = {
+            name: self.create_array(name, shape, dtype, fill)
+            for name, (shape, dtype, fill) in self.fields(state_shape, recurrent_shape).items()
+        }
+
+        self.priorities = SumTree(self.capacity, self.create_array("priorities", (2 * self.priorities.size,), np.float64))
+
+        for name, array in self.arrays.items():
+            setattr(self, name, torch.from_numpy(array))
+
+    def check_shapes(self, state_shape, recurrent_shape):
+        """
+        Raises if transitions don't have the shapes the arrays were allocated for, like when a buffer reopened from
+            disk was written by a learner with another window or network.
+        """
+        if (tuple(state_shape), tuple(recurrent_shape)) != (self.state_shape, self.recurrent_shape):
+            raise ValueError(f"Transitions with state shape {tuple(state_shape)} and recurrent shape "
+                             f"{tuple(recurrent_shape)} don't fit a buffer of {self.state_shape} and "
+                             f"{self.recurrent_shape}")
+
+    def quantize(self, observations):
+        if self.observation_dtype.kind not in "iu":
+            return np.asarray(observations, dtype=self.observation_dtype)
+
+        stored = np.round(np.asarray(observations, dtype=np.float32) / self.quantization_step) + self.quantization_zero
+        return np.clip(stored, *self.quantization_limits).astype(self.observation_dtype)
+
+    def dequantize(self, stored):
+        if self.observation_dtype.kind not in "iu":
+            return stored.astype(np.float32, copy=False)
+
+        return (stored.astype(np.float32) - self.quantization_zero) * self.quantization_step
+
+    def metadata(self):
+        return {
+            "capacity": self.capacity,
+            "alpha": self.alpha,
+            "deduplicate_frames": self.deduplicate_frames,
+            "observation_dtype": self.observation_dtype.name,
+            "observation_range": np.asarray(self.observation_range, dtype=np.float64).tolist(),
+            "frame_capacity": self.frame_capacity,
+            "state_shape": list(self.state_shape),
+            "recurrent_shape": list(self.recurrent_shape),
+            "position": self.position,
+            "total": self.total,
+            "frame_position": self.frame_position,
+            "frame_total": self.frame_total,
+            "max_priority": float(self.max_priority),
+        }
+
+    def flush(self):
+        """
+        Writes the memory-mapped arrays to disk, then the metadata that makes them valid. Does nothing in memory.
+        """
+        if self.path is None or self.arrays is None:
+            return
+
+        with self.lock:
+            for array in self.arrays.values():
+                array.flush()
+            self.priorities.tree.flush()
+
+            metadata = self.metadata()
+
+        # Replaced atomically, a crash mid-write leaves the previous metadata in place
+        temporary_path = os.path.join(self.path, "metadata.json.tmp")
+        with open(temporary_path, "w") as file:
+            json.dump(metadata, file)
+        os.replace(temporary_path, os.path.join(self.path, "metadata.json"))
+
+    def reopen(self):
+        with open(os.path.join(self.path, "metadata.json")) as file:
+            metadata = json.load(file)
+
+        expected = {
+            "capacity": self.capacity,
+            "deduplicate_frames": self.deduplicate_frames,
+            "frame_capacity": self.frame_capacity,
+            "observation_dtype": self.observation_dtype.name,
+        }
+        for key, value in expected.items():
+            if metadata.get(key) != value:
+                raise ValueError(f"Replay buffer at {self.path} has {key} {metadata.get(key)}, not {value}")
+
+        # Quantized observations only decode to what was stored with the range they were encoded with
+        observation_range = np.asarray(self.observation_range, dtype=np.float64)
+        stored_range = np.asarray(metadata["observation_range"], dtype=np.float64)
+        if stored_range.shape != observation_range.shape or not np.array_equal(stored_range, observation_range):
+            raise ValueError(f"Replay buffer at {self.path} has observation_range {stored_range.tolist()}, "
+                             f"not {observation_range.tolist()}")
+
+        self.alpha = metadata["alpha"]
+        self.state_shape = tuple(metadata["state_shape"])
+        self.recurrent_shape = tuple(metadata["recurrent_shape"])
+        self.sequence_length = self.state_shape[0]
+        self.position = metadata["position"]
+        self.total = metadata["total"]
+        self.frame_position = metadata["frame_position"]
+        self.frame_total = metadata["frame_total"]
+        self.max_priority = metadata["max_priority"]
+
+        # Opening maps the files without reading them, pages are loaded as they're touched
+        self.arrays = {
+            name: np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r+")
+            for name in self.fields(self.state_shape, self.recurrent_shape)
+        }
+
+        for name, array in self.arrays.items():
+            setattr(self, name, torch.from_numpy(array))
+
+        self.priorities = SumTree(self.capacity, np.load(os.path.join(self.path, "priorities.npy"), mmap_mode="r+"))
+
+        # Slots written after the last flush aren't part of the buffer, and the tree may have been cut off mid-update
+        if self.total < self.capacity:
+            self.priorities.tree[self.priorities.size + self.total:] = 0.0
+        self.priorities.rebuild()
+
+        print(f"Reopened replay buffer at {self.path} with {len(self)} transitions")
+
+    def write_frame(self, frame, previous):
+        """
+        Writes one observation to the frame ring, linked to `previous` (slot, serial), and returns its own.
+        """
+        arrays = self.arrays
+        slot = self.frame_position
+
+        dependent = arrays["frame_transitions"][slot]
+        if dependent >= 0 and arrays["frame_previous"][arrays["transition_frames"][dependent]] == slot:
+            self.priorities.set(dependent, 0.0)
+        arrays["frame_transitions"][slot] = -1
+
+        # The serial is invalid while the frame is written, so readers in other processes can tell it changed
+        arrays["frame_serials"][slot] = -1
+        arrays["frames"][slot] = self.quantize(frame)
+        arrays["frame_previous"][slot] = previous[0] if previous is not None else -1
+        arrays["frame_previous_serials"][slot] = previous[1] if previous is not None else -1
+        arrays["frame_serials"][slot] = self.frame_total
+
+        written = (slot, self.frame_total)
+
+        self.frame_position = (self.frame_position + 1) % self.frame_capacity
+        self.frame_total += 1
+
+        return written
+
+    def store_frames(self, state, next_state, done, worker_id):
+        arrays = self.arrays
+        last = self.streams.get(worker_id)
+
+        # A stream continues when the state's newest frame is the last frame stored for the worker. Otherwise it's a
+        # new episode, or messages were lost, and the chain restarts from the state window minus its zero padding.
+        continues = last is not None and arrays["frame_serials"][last[0]] == last[1] and \
+            np.array_equal(arrays["frames"][last[0]], self.quantize(state[-1]))
+
+        if not continues:
+            last = None
+
+            padding = 0
+            while padding < len(state) - 1 and not np.any(state[padding]):
+                padding += 1
+
+            for frame in state[padding:]:
+                last = self.write_frame(frame, last)
+
+        last = self.write_frame(next_state[-1], last)
+
+        if done:
+            self.streams.pop(worker_id, None)
         else:
-            hidden_state = torch.zeros_like(next_hidden_state)
-            cell_state = torch.zeros_like(next_cell_state)
+            self.streams[worker_id] = last
+
+        return last
+
+    def link_transitions(self, positions, frames):
+        """
+        Points the transitions at `positions` to their newest frames, the (slot, serial) pairs `store_frames` returned.
+        """
+        arrays = self.arrays
+        slots, serials = np.asarray(frames, dtype=np.int64).reshape(-1, 2).T
+
+        arrays["transition_frames"][positions] = slots
+        arrays["transition_serials"][positions] = serials
+        arrays["frame_transitions"][arrays["frame_previous"][slots]] = positions
+
+    def intact(self, indices):
+        """
+        Which of the transitions at `indices` still have the newest frames of their state and next state.
+        """
+        arrays = self.arrays
+        frames = arrays["transition_frames"][indices]
+        previous = arrays["frame_previous"][frames]
+
+        return (arrays["frame_serials"][frames] == arrays["transition_serials"][indices]) & (previous >= 0) & \
+            (arrays["frame_serials"][previous] == arrays["frame_previous_serials"][frames])
+
+    def window_slots(self, indices):
+        """
+        Frame slots of the `sequence_length + 1` observations covering the state and next state windows of the given
+            transitions, -1 for padding.
+        """
+        arrays = self.arrays
+        batch_size = len(indices)
+
+        slots = np.empty((batch_size, self.sequence_length + 1), dtype=np.int64)
+
+        # A transition whose own frame was overwritten has nothing left to rebuild, its window is all padding
+        current = arrays["transition_frames"][indices]
+        valid = arrays["frame_serials"][current] == arrays["transition_serials"][indices]
+        slots[:, -1] = np.where(valid, current, -1)
+
+        for column in range(self.sequence_length - 1, -1, -1):
+            previous = arrays["frame_previous"][current]
+            valid &= (previous >= 0) & \
+                (arrays["frame_serials"][previous] == arrays["frame_previous_serials"][current])
+
+            current = np.where(valid, previous, current)
+            slots[:, column] = np.where(valid, previous, -1)
+
+        return slots
+
+    def gather_windows(self, slots):
+        """
+        Rebuilds state and next state windows from the frame ring, given their `window_slots`.
+        """
+        windows = self.dequantize(self.arrays["frames"][slots]) * (slots >= 0)[..., None]
+        windows = torch.from_numpy(windows)
+
+        return windows[:, :-1], windows[:, 1:]
+
+    def add(self, state, action, reward, next_state, done, next_hidden_state, next_cell_state, worker_id="default"):
+        next_hidden_state = next_hidden_state.detach().squeeze(1).cpu().numpy()
+        next_cell_state = next_cell_state.detach().squeeze(1).cpu().numpy()
+
+        if self.arrays is None:
+            self.allocate(np.shape(state), next_hidden_state.shape)
+        self.check_shapes(np.shape(state), next_hidden_state.shape)
+
+        arrays = self.arrays
 
         self.lock.acquire()
 
-        self.buffer[self.position] = (state, action, reward, next_state, done, hidden_state, cell_state, next_hidden_state, next_cell_state)
-        self.priorities[self.position] = max_priority
+        position = self.position
+        previous = (position - 1) % self.capacity
+
+        if self.deduplicate_frames:
+            self.link_transitions([position], [self.store_frames(state, next_state, done, worker_id)])
+        else:
+            arrays["states"][position] = self.quantize(state)
+            arrays["next_states"][position] = self.quantize(next_state)
+
+        arrays["actions"][position] = action
+        arrays["rewards"][position] = reward
+        arrays["dones"][position] = done
+
+        # Link "current" hidden state to previous transitions' next_hidden_state, reset after terminal transitions
+        if self.total > 0 and not arrays["dones"][previous]:
+            arrays["hidden_states"][position] = arrays["next_hidden_states"][previous]
+            arrays["cell_states"][position] = arrays["next_cell_states"][previous]
+        else:
+            arrays["hidden_states"][position] = 0.0
+            arrays["cell_states"][position] = 0.0
+
+        arrays["next_hidden_states"][position] = next_hidden_state
+        arrays["next_cell_states"][position] = next_cell_state
+
+        self.priorities.set(position, self.max_priority ** self.alpha)
 
         self.position = (self.position + 1) % self.capacity
         self.lock.release()
@@ -140,37 +647,847 @@ class PrioritizedReplayBuffer:
 
         self.total += 1
 
-    def sample(self, batch_size, beta=0.4):
-        if not self.buffer:
+    def add_batch(self, states, actions, rewards, next_states, dones, next_hidden_states, next_cell_states,
+                  worker_ids):
+        """
+        Adds a batch of transitions under a single lock acquisition. Recurrent states are NumPy arrays without their
+            batch dimension of 1, as [count, num_layers, lstm_units]. Same result as calling `add` for each in order.
+        """
+        count = len(actions)
+        if count == 0:
+            return
+
+        if self.arrays is None:
+            self.allocate(np.shape(states)[1:], np.shape(next_hidden_states)[1:])
+        self.check_shapes(np.shape(states)[1:], np.shape(next_hidden_states)[1:])
+
+        with self.lock:
+            # More transitions than fit only matter for the recurrent state link into the ones that are kept
+            for start in range(0, count, self.capacity):
+                end = min(start + self.capacity, count)
+                self.write_batch(states[start:end], actions[start:end], rewards[start:end], next_states[start:end],
+                                 dones[start:end], next_hidden_states[start:end], next_cell_states[start:end],
+                                 worker_ids[start:end])
+
+    def write_batch(self, states, actions, rewards, next_states, dones, next_hidden_states, next_cell_states,
+                    worker_ids):
+        arrays = self.arrays
+        count = len(actions)
+        dones = np.asarray(dones, dtype=bool)
+
+        positions = (self.position + np.arange(count)) % self.capacity
+        previous = (self.position - 1) % self.capacity
+
+        # The slot before the batch is read before the batch can overwrite it
+        linked = np.empty(count, dtype=bool)
+        linked[0] = self.total > 0 and not arrays["dones"][previous]
+        linked[1:] = ~dones[:-1]
+
+        hidden_states = np.concatenate([arrays["next_hidden_states"][previous][None], next_hidden_states[:-1]])
+        cell_states = np.concatenate([arrays["next_cell_states"][previous][None], next_cell_states[:-1]])
+
+        if self.deduplicate_frames:
+            self.link_transitions(positions, [
+                self.store_frames(state, next_state, done, worker_id)
+                for state, next_state, done, worker_id in zip(states, next_states, dones, worker_ids)
+            ])
+        else:
+            arrays["states"][positions] = self.quantize(states)
+            arrays["next_states"][positions] = self.quantize(next_states)
+
+        arrays["actions"][positions] = actions
+        arrays["rewards"][positions] = rewards
+        arrays["dones"][positions] = dones
+
+        arrays["hidden_states"][positions] = hidden_states * linked[:, None, None]
+        arrays["cell_states"][positions] = cell_states * linked[:, None, None]
+        arrays["next_hidden_states"][positions] = next_hidden_states
+        arrays["next_cell_states"][positions] = next_cell_states
+
+        priorities = np.full(count, self.max_priority ** self.alpha)
+
+        # Long batches can overwrite the frames of their own first transitions
+        if self.deduplicate_frames:
+            priorities *= self.intact(positions)
+
+        self.priorities.update(positions, priorities)
+
+        self.position = (self.position + count) % self.capacity
+        self.new_samples += count
+        self.total += count
+
+    def sample(self, batch_size, beta=0.4, device=None):
+        if self.total == 0:
             return [], [], [], [], []
 
         self.lock.acquire()
 
-        buffer_len = min(self.total, self.capacity)
+        buffer_len = len(self)
 
-        priorities = np.array(self.priorities[:buffer_len]) ** self.alpha
-        probabilities = priorities / priorities.sum()
-        indices = np.random.choice(buffer_len, batch_size, replace=True, p=probabilities)
-        samples = [self.buffer[idx] for idx in indices]
+        indices = self.priorities.sample(batch_size)
+        probabilities = self.priorities[indices] / self.priorities.total
 
-        # Set max priority based on the sampled priorities
-        self.max_priority = max(priorities[indices])
+        (states, actions, rewards, next_states, dones,
+         hidden_states, cell_states, next_hidden_states, next_cell_states) = self.gather(indices, device=device)
 
         self.lock.release()
 
         total = buffer_len
-        weights = (total * probabilities[indices]) ** (-beta)
+        weights = (total * probabilities) ** (-beta)
+        weights /= weights.max()
+        weights = np.array(weights, dtype=np.float32)
+
+        self.new_samples = 0
+
+        return (states, actions, rewards, next_states, dones, indices, weights,
+                hidden_states, cell_states, next_hidden_states, next_cell_states)
+
+    def gather(self, indices, slots=None, device=None):
+        """
+        Reads the transitions at `indices` to `device`, the buffer's by default, as (states, actions, rewards,
+            next_states, dones, hidden_states, cell_states, next_hidden_states, next_cell_states). `slots` are the
+            window slots if the caller already looked them up.
+        """
+        device = device or self.device
+        index = torch.from_numpy(indices)
+        actions, rewards, dones = (
+            field.index_select(0, index).to(device) for field in (self.actions, self.rewards, self.dones)
+        )
+
+        if self.deduplicate_frames:
+            states, next_states = self.gather_windows(slots if slots is not None else self.window_slots(indices))
+        else:
+            states = torch.from_numpy(self.dequantize(self.arrays["states"][indices]))
+            next_states = torch.from_numpy(self.dequantize(self.arrays["next_states"][indices]))
+
+        states, next_states = states.to(device), next_states.to(device)
+
+        # Recurrent states go to the LSTM as [num_layers, batch_size, lstm_units]
+        hidden_states, cell_states, next_hidden_states, next_cell_states = (
+            field.index_select(0, index).permute(1, 0, 2).contiguous().to(device)
+            for field in (self.hidden_states, self.cell_states, self.next_hidden_states, self.next_cell_states)
+        )
+
+        return (states, actions, rewards, next_states, dones,
+                hidden_states, cell_states, next_hidden_states, next_cell_states)
+
+    def update_priorities(self, indices, new_priorities):
+        new_priorities = np.asarray(new_priorities, dtype=np.float64)
+
+        with self.lock:
+            # Transitions dropped since they were sampled stay dropped
+            if self.deduplicate_frames:
+                self.priorities.update(indices, new_priorities ** self.alpha * self.intact(indices))
+            else:
+                self.priorities.update(indices, new_priorities ** self.alpha)
+            self.max_priority = max(self.max_priority, new_priorities.max())
+
+
+def header_counter(index):
+    """
+    Property for a counter kept in the shared header array instead of the instance.
+    """
+    def get(self):
+        return int(self.header[index])
+
+    def set(self, value):
+        self.header[index] = value
+
+    return property(get, set)
+
+
+class SharedReplayBuffer(PrioritizedReplayBuffer):
+    """
+    Prioritized replay whose arrays, sum tree and ring counters live in named shared memory, so other processes on the
+        machine can attach to it with `SharedReplayBuffer.attach(name)`. One process adds transitions, any number
+        sample and update priorities.
+
+    Writes to the ring and the tree, priority updates included, are serialized by a `ProcessLock`. Sampling doesn't
+        take it: before writing a slot, the writer publishes the total it will reach in `writing`, and a reader that
+        finds any of its sampled slots within what was written meanwhile, or a changed frame link, samples again. The
+        tree may be read mid-update, which only skews probabilities slightly for that batch.
+    """
+    header_fields = ("position", "total", "writing", "frame_position", "frame_total", "max_priority")
+
+    def __init__(self, name, capacity, alpha=0.6, deduplicate_frames=False, frame_margin=0.25,
+                 observation_dtype="float32", observation_range=(-1.0, 1.0), create=True, max_retries=10):
+        self.name = name
+        self.create = create
+        self.max_retries = max_retries
+        self.segments = []
+        self.retries = 0
+
+        # The base class resets the counters, so an attaching process only maps the real header afterwards
+        self.header = np.zeros(len(self.header_fields), dtype=np.int64)
+
+        super().__init__(capacity, alpha=alpha, deduplicate_frames=deduplicate_frames, frame_margin=frame_margin,
+                         observation_dtype=observation_dtype, observation_range=observation_range)
+
+        if create:
+            segment, header = create_shared_array(f"{name}_header", self.header.shape, np.int64)
+            header[:] = self.header
+            self.description = SharedDescription(f"{name}_description", create=True)
+            self.description.write(self.settings())
+        else:
+            segment, header = attach_shared_array(f"{name}_header", self.header.shape, np.int64)
+            self.description = SharedDescription(f"{name}_description")
+
+        self.segments += [segment, self.description.segment]
+        self.header = header
+
+        self.lock = ProcessLock(name)
+
+    @classmethod
+    def attach(cls, name, timeout=30.0):
+        """
+        Attaches to the buffer another process created, once it has received its first transition. A `timeout` of
+            None waits forever.
+        """
+        _, settings = SharedDescription.wait(f"{name}_description", key="state_shape", timeout=timeout)
+
+        replay_buffer = cls(name, settings["capacity"], alpha=settings["alpha"],
+                            deduplicate_frames=settings["deduplicate_frames"], frame_margin=settings["frame_margin"],
+                            observation_dtype=settings["observation_dtype"],
+                            observation_range=settings["observation_range"], create=False)
+        replay_buffer.map_arrays(settings["state_shape"], settings["recurrent_shape"])
+
+        return replay_buffer
+
+    def settings(self):
+        settings = {
+            "capacity": self.capacity,
+            "alpha": self.alpha,
+            "deduplicate_frames": self.deduplicate_frames,
+            "frame_margin": self.frame_margin,
+            "observation_dtype": self.observation_dtype.name,
+            "observation_range": np.asarray(self.observation_range, dtype=np.float64).tolist(),
+        }
+
+        if self.state_shape is not None:
+            settings["state_shape"] = list(self.state_shape)
+            settings["recurrent_shape"] = list(self.recurrent_shape)
+
+        return settings
+
+    position = header_counter(0)
+    total = header_counter(1)
+    writing = header_counter(2)
+    frame_position = header_counter(3)
+    frame_total = header_counter(4)
+
+    @property
+    def max_priority(self):
+        return float(self.header[5:6].view(np.float64)[0])
+
+    @max_priority.setter
+    def max_priority(self, value):
+        self.header[5:6].view(np.float64)[0] = value
+
+    def create_array(self, name, shape, dtype, fill=0):
+        segment, array = create_shared_array(f"{self.name}_{name}", shape, dtype, fill)
+        self.segments.append(segment)
+
+        return array
+
+    def allocate(self, state_shape, recurrent_shape):
+        super().allocate(state_shape, recurrent_shape)
+
+        # Attaching processes wait for the shapes
+        self.description.write(self.settings())
+
+    def map_arrays(self, state_shape, recurrent_shape):
+        self.sequence_length = state_shape[0]
+        self.state_shape = tuple(state_shape)
+        self.recurrent_shape = tuple(recurrent_shape)
+
+        self.arrays = {}
+        for name, (shape, dtype, _) in self.fields(state_shape, recurrent_shape).items():
+            segment, self.arrays[name] = attach_shared_array(f"{self.name}_{name}", shape, dtype)
+            self.segments.append(segment)
+
+        segment, tree = attach_shared_array(f"{self.name}_priorities", (2 * self.priorities.size,), np.float64)
+        self.segments.append(segment)
+        self.priorities = SumTree(self.capacity, tree)
+
+        for name, array in self.arrays.items():
+            setattr(self, name, torch.from_numpy(array))
+
+    def add(self, state, action, reward, next_state, done, next_hidden_state, next_cell_state, worker_id="default"):
+        self.writing = self.total + 1
+
+        super().add(state, action, reward, next_state, done, next_hidden_state, next_cell_state, worker_id)
+
+    def add_batch(self, states, actions, rewards, next_states, dones, next_hidden_states, next_cell_states,
+                  worker_ids):
+        self.writing = self.total + len(actions)
+
+        super().add_batch(states, actions, rewards, next_states, dones, next_hidden_states, next_cell_states,
+                          worker_ids)
+
+    def overwritten(self, indices, committed):
+        """
+        Which of `indices` may have been written since the total was `committed`.
+        """
+        written = self.writing - committed
+
+        return (indices - committed) % self.capacity < written
+
+    def sample(self, batch_size, beta=0.4, device=None):
+        for _ in range(self.max_retries + 1):
+            committed = self.total
+            buffer_len = min(committed, self.capacity)
+            if buffer_len == 0 or self.arrays is None:
+                return [], [], [], [], []
+
+            indices = self.priorities.sample(batch_size)
+            priorities = self.priorities[indices]
+            total = self.priorities.total
+
+            slots = self.window_slots(indices) if self.deduplicate_frames else None
+            batch = self.gather(indices, slots, device)
+
+            # Torn reads: a slot the writer reached meanwhile, a frame that was replaced, or a leaf that wasn't set yet
+            if self.overwritten(indices, committed).any() or not np.all(priorities > 0):
+                self.retries += 1
+                continue
+
+            if slots is not None and not np.array_equal(self.window_slots(indices), slots):
+                self.retries += 1
+                continue
+
+            break
+        else:
+            raise RuntimeError(f"Could not sample a consistent batch from {self.name} in {self.max_retries} retries")
+
+        weights = (buffer_len * priorities / total) ** (-beta)
         weights /= weights.max()
         weights = np.array(weights, dtype=np.float32)
 
-        batch = FullTransition(*zip(*samples))
-        states, actions, rewards, next_states, dones = map(lambda x: torch.stack(x).to(self.device), batch[:-4])
+        self.new_samples = 0
+
+        (states, actions, rewards, next_states, dones,
+         hidden_states, cell_states, next_hidden_states, next_cell_states) = batch
+
+        return (states, actions, rewards, next_states, dones, indices, weights,
+                hidden_states, cell_states, next_hidden_states, next_cell_states)
+
+    def close(self):
+        """
+        Unmaps the shared memory, and in the creating process removes it.
+        """
+        self.arrays = None
+        for name in self.fields(self.state_shape or (1, 1), self.recurrent_shape or (1,)):
+            setattr(self, name, None)
+
+        self.priorities = SumTree(self.capacity)
+        self.header = np.zeros(len(self.header_fields), dtype=np.int64)
+        self.description = None
+
+        release_segments(self.segments, unlink=self.create)
+        self.segments = []
+
+        self.lock.close()
+
+
+class SequenceReplayBuffer:
+    """
+    R2D2-style sequence replay. Instead of two observation windows and four recurrent states per transition, each
+        worker's stream of observations is cut into overlapping sequences that store every frame once, along with a
+        single recurrent state snapshot taken at the start of the sequence.
+
+    The snapshot is the actor's recurrent state from just before the sequence's first frame, the state it had after
+        the transition whose window ended with the frame before. Frames from before the episode's first observation are
+        padding, sequences that start in them have a zero snapshot and padding is never burnt in.
+
+    A sequence covers `period` transitions. It holds `burn_in + sequence_length + period` frames: the burn-in prefix,
+        the first transition's window, and one more frame for each following transition. Sampling picks a sequence by
+        priority and a transition within it uniformly. The snapshot and the frames before the transition's window are
+        returned so the learner can burn in its initial LSTM state.
+
+    Sampled transitions are identified by `sequence * period + offset`. Every transition keeps the last TD error it
+        was updated with, new ones the highest seen so far, and a sequence's priority mixes them like R2D2 does:
+        `priority_eta` times their maximum plus the rest times their mean. An update of one transition doesn't erase
+        what was learnt about the others.
+
+    `capacity` is in transitions, like the other buffers.
+    """
+    def __init__(self, capacity, sequence_length, burn_in=8, period=None, alpha=0.6, priority_eta=0.9):
+        self.sequence_length = sequence_length
+        self.burn_in = burn_in
+        self.period = period or sequence_length
+        self.frame_count = self.burn_in + self.sequence_length + self.period
+
+        # Position of an episode's first observation in its stream of frames, after the padding
+        self.first_observation = self.burn_in + self.sequence_length - 1
+
+        self.capacity = max(1, capacity // self.period)
+        self.alpha = alpha
+        self.priority_eta = priority_eta
+        self.priorities = SumTree(self.capacity)
+        self.position = 0
+        self.total = 0
+        self.transitions = 0
+        self.lock = Lock()
+        self.new_samples = 0
+        self.max_priority = 1
+
+        # Frames, actions and recurrent states of each worker's sequence that hasn't been completed yet
+        self.streams = {}
+
+        self.arrays = None
+
+        self.device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+
+    def __len__(self):
+        return self.transitions
+
+    def allocate(self, features, recurrent_shape):
+        self.arrays = {
+            "frames": np.zeros((self.capacity, self.frame_count, features), dtype=np.float32),
+            "actions": np.zeros((self.capacity, self.period), dtype=np.int64),
+            "rewards": np.zeros((self.capacity, self.period), dtype=np.float32),
+            "dones": np.zeros((self.capacity, self.period), dtype=bool),
+            "lengths": np.zeros(self.capacity, dtype=np.int64),
+            "paddings": np.zeros(self.capacity, dtype=np.int64),
+            "td_errors": np.zeros((self.capacity, self.period), dtype=np.float64),
+            "hidden_states": np.zeros((self.capacity, *recurrent_shape), dtype=np.float32),
+            "cell_states": np.zeros((self.capacity, *recurrent_shape), dtype=np.float32),
+        }
+
+    def memory_per_transition(self):
+        if self.arrays is None:
+            return 0
+
+        return sum(array.nbytes for array in self.arrays.values()) / (self.capacity * self.period)
+
+    def recurrent_schedule(self):
+        """
+        (interval, phase) of the steps of an episode whose recurrent state becomes a sequence snapshot, for workers
+            that only send those, see `ExperiencePublisher`.
+        """
+        # A sequence starting at frame `start` needs the state after step start - first_observation - 1
+        return self.period, -(self.first_observation + 1) % self.period
+
+    def add(self, state, action, reward, next_state, done, next_hidden_state, next_cell_state, worker_id="default"):
+        self.append(state, action, reward, next_state, done, next_hidden_state.detach().squeeze(1).cpu().numpy(),
+                    next_cell_state.detach().squeeze(1).cpu().numpy(), worker_id)
+
+    def add_batch(self, states, actions, rewards, next_states, dones, next_hidden_states, next_cell_states,
+                  worker_ids):
+        # Transitions only reach the locked arrays a sequence at a time, so there's nothing to gain from batching
+        for transition in zip(states, actions, rewards, next_states, dones, next_hidden_states, next_cell_states,
+                              worker_ids):
+            self.append(*transition)
+
+    def append(self, state, action, reward, next_state, done, next_hidden_state, next_cell_state, worker_id):
+        if self.arrays is None:
+            self.allocate(np.shape(state)[-1], next_hidden_state.shape)
+
+        stream = self.streams.get(worker_id)
+        if stream is None:
+            # New episode: burn-in padding, then the first window, which is already zero-padded by the worker. The
+            # recurrent states are the actor's before each transition, starting from zero
+            stream = {
+                "frames": [np.zeros(np.shape(state)[-1], dtype=np.float32)] * self.burn_in + list(state),
+                "start": 0,
+                "actions": [],
+                "rewards": [],
+                "dones": [],
+                "hidden_states": [np.zeros_like(next_hidden_state)],
+                "cell_states": [np.zeros_like(next_cell_state)],
+                "first_state": 0,
+            }
+            self.streams[worker_id] = stream
+
+        stream["frames"].append(next_state[-1])
+        stream["actions"].append(action)
+        stream["rewards"].append(reward)
+        stream["dones"].append(done)
+        stream["hidden_states"].append(next_hidden_state)
+        stream["cell_states"].append(next_cell_state)
+
+        if len(stream["actions"]) == self.period or done:
+            self.store_sequence(stream)
+
+            if done:
+                del self.streams[worker_id]
+            else:
+                # The next sequence starts `period` frames later, from the recurrent state the actor had just before
+                # that frame. States older than it aren't needed anymore
+                stream["frames"] = stream["frames"][self.period:]
+                stream["start"] += self.period
+                stream["actions"], stream["rewards"], stream["dones"] = [], [], []
+
+                first_state = max(0, stream["start"] - self.first_observation)
+                del stream["hidden_states"][:first_state - stream["first_state"]]
+                del stream["cell_states"][:first_state - stream["first_state"]]
+                stream["first_state"] = first_state
+
+        self.new_samples += 1
+
+    def store_sequence(self, stream):
+        length = len(stream["actions"])
+        arrays = self.arrays
+
+        self.lock.acquire()
+
+        position = self.position
+
+        # Sequences cut short by the end of an episode are zero-padded
+        arrays["frames"][position] = 0.0
+        arrays["frames"][position, :len(stream["frames"])] = stream["frames"]
+        arrays["actions"][position, :length] = stream["actions"]
+        arrays["rewards"][position, :length] = stream["rewards"]
+        arrays["dones"][position] = False
+        arrays["dones"][position, :length] = stream["dones"]
+        arrays["hidden_states"][position] = stream["hidden_states"][0]
+        arrays["cell_states"][position] = stream["cell_states"][0]
+        arrays["paddings"][position] = max(0, self.first_observation - stream["start"])
+
+        self.transitions += length - arrays["lengths"][position]
+        arrays["lengths"][position] = length
+
+        arrays["td_errors"][position] = 0.0
+        arrays["td_errors"][position, :length] = self.max_priority
+        self.priorities.set(position, self.max_priority ** self.alpha)
+
+        self.position = (self.position + 1) % self.capacity
+        self.total += 1
+
+        self.lock.release()
+
+    def sample(self, batch_size, beta=0.4, device=None):
+        """
+        Returns the usual batch of transitions, with the burn-in inputs in place of per-transition recurrent states:
+            (states, actions, rewards, next_states, dones, indices, weights,
+             burn_in_frames, burn_in_lengths, hidden_states, cell_states)
+
+        `burn_in_frames[i, :burn_in_lengths[i]]` are the frames between the snapshot and the start of transition i's
+            state window without padding, `hidden_states` and `cell_states` the snapshots as
+            [num_layers, batch_size, lstm_units]. Tensors are on `device`, the buffer's by default.
+        """
+        arrays = self.arrays
+        device = device or self.device
+
+        self.lock.acquire()
+
+        sequences = self.priorities.sample(batch_size)
+        probabilities = self.priorities[sequences] / self.priorities.total
+
+        lengths = arrays["lengths"][sequences]
+        offsets = (np.random.uniform(size=batch_size) * lengths).astype(np.int64)
+
+        # Every transition's windows are a fixed-size slice of its sequence's frames, starting at its offset
+        window = offsets[:, None] + np.arange(self.burn_in, self.burn_in + self.sequence_length + 1)
+        windows = arrays["frames"][sequences[:, None], window]
+
+        # Burn-in starts after the padding, whose snapshot is the zero state
+        paddings = arrays["paddings"][sequences]
+        burn_in_window = np.minimum(paddings[:, None] + np.arange(self.burn_in + self.period - 1),
+                                    self.frame_count - 1)
+        burn_in_frames = arrays["frames"][sequences[:, None], burn_in_window]
+        burn_in_lengths = np.maximum(0, offsets + self.burn_in - paddings)
+        hidden_states = arrays["hidden_states"][sequences]
+        cell_states = arrays["cell_states"][sequences]
+
+        actions = arrays["actions"][sequences, offsets]
+        rewards = arrays["rewards"][sequences, offsets]
+        dones = arrays["dones"][sequences, offsets]
+
+        transitions = self.transitions
+
+        self.lock.release()
+
+        # A sequence is picked by priority, then one of its transitions uniformly
+        weights = (transitions * probabilities / lengths) ** (-beta)
+        weights /= weights.max()
+        weights = np.array(weights, dtype=np.float32)
 
         self.new_samples = 0
 
-        return states, actions, rewards, next_states, dones, indices, weights, *map(lambda x: torch.stack(x).squeeze(2).permute(1, 0, 2).contiguous(), batch[-4:])
+        windows = torch.from_numpy(windows).to(device)
+
+        return (windows[:, :-1], torch.from_numpy(actions).to(device), torch.from_numpy(rewards).to(device),
+                windows[:, 1:], torch.from_numpy(dones).to(device), sequences * self.period + offsets, weights,
+                torch.from_numpy(burn_in_frames).to(device), torch.from_numpy(burn_in_lengths),
+                torch.from_numpy(hidden_states).permute(1, 0, 2).contiguous().to(device),
+                torch.from_numpy(cell_states).permute(1, 0, 2).contiguous().to(device))
 
     def update_priorities(self, indices, new_priorities):
-        for idx, priority in zip(indices, new_priorities):
-            self.priorities[idx] = priority
+        new_priorities = np.asarray(new_priorities, dtype=np.float64)
+
+        sequences, offsets = np.divmod(np.asarray(indices), self.period)
+
+        with self.lock:
+            td_errors = self.arrays["td_errors"]
+            td_errors[sequences, offsets] = new_priorities
+
+            # Padding after the end of an episode is zero and never raises the maximum, the mean only counts the rest
+            sequences = np.unique(sequences)
+            errors = td_errors[sequences]
+            mixed = self.priority_eta * errors.max(axis=1) + \
+                (1 - self.priority_eta) * errors.sum(axis=1) / self.arrays["lengths"][sequences]
+
+            self.priorities.update(sequences, mixed ** self.alpha)
+            self.max_priority = max(self.max_priority, new_priorities.max())
+
+
+class StagingBuffer:
+    """
+    Staging area between the threads that receive transitions and the learner. Each producer appends to its own
+        deque, which is safe without a lock with one producer and one consumer, and the learner moves everything
+        staged into the replay buffer with one `add_batch` per producer when it calls `commit`.
+
+    Recurrent states are converted to NumPy when staged, so that work stays on the producer's thread. With
+        `ingestion_stats`, the time transitions were created at is passed to its `visible` when they're committed.
+    """
+    def __init__(self, ingestion_stats=None):
+        self.queues = {}
+        self.ingestion_stats = ingestion_stats
+
+        self.peak_depth = 0
+        self.committed = 0
+        self.last_committed = 0
+        self.last_commit_time = 0.0
+        self.commit_time = 0.0
+        self.commits = 0
+
+    def __len__(self):
+        return sum(len(queue) for queue in list(self.queues.values()))
+
+    def stage(self, state, action, reward, next_state, done, next_hidden_state, next_cell_state, worker_id="default",
+              producer="listener", created=None):
+        queue = self.queues.get(producer)
+        if queue is None:
+            queue = self.queues.setdefault(producer, deque())
+
+        queue.append((state, action, reward, next_state, done, next_hidden_state.detach().squeeze(1).cpu().numpy(),
+                      next_cell_state.detach().squeeze(1).cpu().numpy(), worker_id, created))
+
+    def stage_batch(self, states, actions, rewards, next_states, dones, next_hidden_states, next_cell_states,
+                    worker_id="default", producer="listener", created=None):
+        """
+        Stages transitions that are already arrays, recurrent states without their batch dimension of 1.
+        """
+        queue = self.queues.get(producer)
+        if queue is None:
+            queue = self.queues.setdefault(producer, deque())
+
+        if created is None:
+            created = [None] * len(actions)
+
+        queue.extend(zip(states, actions, rewards, next_states, dones, next_hidden_states, next_cell_states,
+                         [worker_id] * len(actions), created))
+
+    def commit(self, replay_buffer):
+        """
+        Adds everything staged so far to `replay_buffer`. Returns the number of transitions committed.
+        """
+        start_time = time.perf_counter()
+
+        depth = 0
+        committed = 0
+        for queue in list(self.queues.values()):
+            # Only what was staged before the commit started, the producer keeps appending meanwhile
+            count = len(queue)
+            depth += count
+            if count == 0:
+                continue
+
+            transitions = [queue.popleft() for _ in range(count)]
+            (states, actions, rewards, next_states, dones, next_hidden_states, next_cell_states, worker_ids,
+             created) = zip(*transitions)
+
+            replay_buffer.add_batch(np.stack(states), np.array(actions), np.array(rewards, dtype=np.float32),
+                                    np.stack(next_states), np.array(dones, dtype=bool), np.stack(next_hidden_states),
+                                    np.stack(next_cell_states), list(worker_ids))
+            committed += count
+
+            if self.ingestion_stats is not None:
+                self.ingestion_stats.visible([timestamp for timestamp in created if timestamp is not None])
+
+        self.peak_depth = max(self.peak_depth, depth)
+
+        if committed > 0:
+            self.last_committed = committed
+            self.last_commit_time = time.perf_counter() - start_time
+            self.commit_time += self.last_commit_time
+            self.committed += committed
+            self.commits += 1
+
+        return committed
+
+    def stats(self):
+        """
+        Staged depth and commit cost since the last call.
+        """
+        stats = {
+            "staged": len(self),
+            "peak_staged": self.peak_depth,
+            "committed": self.committed,
+            "commits": self.commits,
+            "commit_ms": self.commit_time / max(1, self.commits) * 1000,
+            "commit_us_per_transition": self.commit_time / max(1, self.committed) * 1e6,
+        }
+
+        self.peak_depth = 0
+        self.committed = 0
+        self.commit_time = 0.0
+        self.commits = 0
+
+        return stats
+
+
+class BatchPrefetcher:
+    """
+    Samples the next `depth` batches from a replay buffer on a background thread, so the learner only waits when the
+        queue runs dry. Priority updates are deferred: the learner hands them to `update_priorities`, and the thread
+        applies them in order before it samples its next batch. Queued batches were sampled before the updates of the
+        batches ahead of them, which is at most `depth` batches of staleness.
+
+    An exception on the background thread ends it, and once the batches queued before it are used up, `get` raises
+        instead of leaving the learner waiting for a batch that never comes.
+
+    With `pin_memory` the batches are sampled to the CPU, moved into page-locked memory and copied to the buffer's
+        device without blocking, from the background thread. The buffer itself is left alone, other callers still
+        sample to its device.
+    """
+    def __init__(self, replay_buffer, batch_size, depth=2, beta=0.4, pin_memory=False):
+        self.replay_buffer = replay_buffer
+        self.batch_size = batch_size
+        self.beta = beta
+
+        self.device = replay_buffer.device
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+
+        self.batches = Queue(maxsize=depth)
+        self.pending_updates = deque()
+        self.stopped = Event()
+        self.error = None
+
+        self.stall_time = 0.0
+        self.stalls = 0
+        self.fetched = 0
+        self.last_stats_time = time.perf_counter()
+
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def apply_pending_updates(self):
+        while self.pending_updates:
+            indices, priorities = self.pending_updates.popleft()
+            self.replay_buffer.update_priorities(indices, priorities)
+
+    def run(self):
+        try:
+            self.prefetch()
+        except Exception as e:
+            self.error = e
+            raise
+
+    def prefetch(self):
+        while not self.stopped.is_set():
+            self.apply_pending_updates()
+
+            if len(self.replay_buffer) < self.batch_size:
+                time.sleep(0.01)
+                continue
+
+            batch = self.replay_buffer.sample(self.batch_size, beta=self.beta,
+                                              device=torch.device("cpu") if self.pin_memory else None)
+            if self.pin_memory:
+                batch = tuple(
+                    field.pin_memory().to(self.device, non_blocking=True) if isinstance(field, torch.Tensor) else field
+                    for field in batch
+                )
+
+            # Waits for room in the queue, but keeps applying updates and notices when it's stopped
+            while not self.stopped.is_set():
+                try:
+                    self.batches.put(batch, timeout=0.01)
+                    break
+                except Full:
+                    self.apply_pending_updates()
+
+    def get(self):
+        """
+        Returns the next batch, waiting for the background thread if none is ready.
+        """
+        start_time = time.perf_counter()
+
+        try:
+            batch = self.batches.get_nowait()
+        except Empty:
+            while True:
+                try:
+                    batch = self.batches.get(timeout=0.1)
+                    break
+                except Empty:
+                    if not self.thread.is_alive():
+                        raise RuntimeError("The batch prefetching thread has stopped") from self.error
+
+            self.stall_time += time.perf_counter() - start_time
+            self.stalls += 1
+
+        self.fetched += 1
+
+        return batch
+
+    def update_priorities(self, indices, priorities):
+        self.pending_updates.append((indices, priorities))
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+        self.apply_pending_updates()
+
+    def stats(self):
+        """
+        Learner stall time and queue depth since the last call.
+        """
+        elapsed = time.perf_counter() - self.last_stats_time
+
+        stats = {
+            "queued": self.batches.qsize(),
+            "fetched": self.fetched,
+            "stalls": self.stalls,
+            "stall_ms": self.stall_time / max(1, self.fetched) * 1000,
+            "stall_fraction": self.stall_time / elapsed if elapsed > 0 else 0.0,
+            "pending_updates": len(self.pending_updates),
+        }
+
+        self.stall_time = 0.0
+        self.stalls = 0
+        self.fetched = 0
+        self.last_stats_time = time.perf_counter()
+
+        return stats
+
+
+def synthetic_transitions(transitions, sequence_length, features, n_actions, recurrent_shape, seed=0):
+    """
+    Generates a fixed, synthetic stream of episodes as `add` arguments. Used for benchmarks and thread tuning, where
+        the contents don't matter but runs need to be comparable.
+    """
+    rng = np.random.default_rng(seed)
+
+    state_sequence = np.zeros((sequence_length, features), dtype=np.float32)
+    for step in range(transitions):
+        state = rng.uniform(-1.0, 1.0, features).astype(np.float32)
+        new_state_sequence = np.concatenate((state_sequence[1:], [state]))
+
+        hidden_state = torch.tensor(rng.normal(0.0, 0.1, recurrent_shape), dtype=torch.float32)
+        cell_state = torch.tensor(rng.normal(0.0, 0.1, recurrent_shape), dtype=torch.float32)
+
+        done = step % 200 == 199
+
+        yield (state_sequence, int(rng.integers(n_actions)), float(rng.normal()), new_state_sequence, done,
+               hidden_state, cell_state)
+
+        state_sequence = np.zeros_like(state_sequence) if done else new_state_sequence
+
 
+def fill_synthetic(replay_buffer, transitions, sequence_length, features, n_actions, recurrent_shape, seed=0):
+    for transition in synthetic_transitions(transitions, sequence_length, features, n_actions, recurrent_shape, seed):
+        replay_buffer.add(*transition)
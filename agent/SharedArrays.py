@@ -0,0 +1,176 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from multiprocessing import shared_memory, resource_tracker
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+
+def create_shared_array(name, shape, dtype, fill=0):
+    """
+    Creates a NumPy array in named shared memory, replacing a leftover segment of the same name. Returns the segment,
+        which has to be kept alive as long as the array is used, and the array.
+    """
+    dtype = np.dtype(dtype)
+    size = max(1, int(np.prod(shape)) * dtype.itemsize)
+
+    try:
+        stale = shared_memory.SharedMemory(name=name)
+        stale.close()
+        stale.unlink()
+    except FileNotFoundError:
+        pass
+
+    segment = shared_memory.SharedMemory(name=name, create=True, size=size)
+    array = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+    array.fill(fill)
+
+    return segment, array
+
+
+def attach_shared_array(name, shape, dtype):
+    segment = attach_segment(name)
+
+    return segment, np.ndarray(shape, dtype=np.dtype(dtype), buffer=segment.buf)
+
+
+def attach_segment(name):
+    """
+    Opens an existing segment without taking ownership of it. Before Python 3.13 every process that opens a segment
+        registers it with its resource tracker, which unlinks it when that process exits, even if it didn't create it.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+
+    # Unregistering afterwards isn't enough, child processes share their parent's tracker and would remove the
+    # parent's registration instead, so registration is skipped while opening
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None if rtype == "shared_memory" else register(name, rtype)
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def release_segments(segments, unlink=False):
+    for segment in segments:
+        try:
+            segment.close()
+        except BufferError:
+            # Arrays or tensors that view the segment are still alive, the mapping goes away with them
+            pass
+
+        if unlink:
+            try:
+                segment.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class SharedDescription:
+    """
+    A small JSON document in named shared memory, used to tell attaching processes the shapes and settings of the
+        arrays another process created.
+    """
+    size = 1 << 16
+
+    def __init__(self, name, create=False):
+        self.name = name
+        if create:
+            self.segment, self.array = create_shared_array(name, (self.size,), np.uint8)
+        else:
+            self.segment, self.array = attach_shared_array(name, (self.size,), np.uint8)
+
+    def write(self, document):
+        data = json.dumps(document).encode()
+        if len(data) + 8 > self.size:
+            raise ValueError(f"Description of {self.name} is {len(data)} bytes, at most {self.size - 8} fit")
+
+        # The length goes last, so a reader never sees a length for data that isn't there yet
+        self.array[8:8 + len(data)] = np.frombuffer(data, dtype=np.uint8)
+        self.array[:8] = np.frombuffer(np.int64(len(data)).tobytes(), dtype=np.uint8)
+
+    def read(self):
+        length = int(self.array[:8].view(np.int64)[0])
+        if length == 0:
+            return None
+
+        return json.loads(self.array[8:8 + length].tobytes())
+
+    @classmethod
+    def wait(cls, name, key=None, timeout=30.0):
+        """
+        Attaches to a description once it exists, and if `key` is given, once it contains that key. A `timeout` of
+            None waits forever.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            try:
+                description = cls(name)
+                document = description.read()
+                if document is not None and (key is None or key in document):
+                    return description, document
+            except FileNotFoundError:
+                pass
+
+            if deadline is not None and time.time() > deadline:
+                raise TimeoutError(f"Timed out waiting for shared memory {name}")
+
+            time.sleep(0.05)
+
+
+class ProcessLock:
+    """
+    Lock shared by every process that opens it by the same name, held on a file in the temp directory: with flock()
+        on POSIX systems, and on Windows by locking the file's first byte. The file lock belongs to the open file, not
+        the thread, so threads of one process also take a thread lock.
+    """
+    def __init__(self, name):
+        self.path = os.path.join(tempfile.gettempdir(), f"{name}.lock")
+        self.file = open(self.path, "a+")
+        self.thread_lock = threading.Lock()
+
+    def acquire(self):
+        self.thread_lock.acquire()
+
+        if os.name != "nt":
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+            return
+
+        # Byte ranges are locked from the file position, and LK_LOCK gives up after trying for 10 seconds
+        self.file.seek(0)
+        while True:
+            try:
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                pass
+
+    def release(self):
+        if os.name != "nt":
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+        else:
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+
+        self.thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def close(self):
+        self.file.close()
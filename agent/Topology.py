@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+
+import torch
+
+
+def parse_cpu_list(cpus: str):
+    """
+    Parses a CPU list like "0-3,8,10-11" into a sorted list of CPU indices. Empty or None means no restriction.
+    """
+    if not cpus:
+        return None
+
+    result = set()
+    for part in cpus.split(","):
+        part = part.strip()
+        if not part:
+            continue
+
+        if "-" in part:
+            first, last = part.split("-", 1)
+            result.update(range(int(first), int(last) + 1))
+        else:
+            result.add(int(part))
+
+    return sorted(result)
+
+
+def configure_torch_threads(intra_op_threads=None, inter_op_threads=None):
+    if intra_op_threads is not None and intra_op_threads > 0:
+        torch.set_num_threads(intra_op_threads)
+
+    if inter_op_threads is not None and inter_op_threads > 0:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError as e:
+            # Can only be set once, before any inter-op parallel work has started
+            print(f"Could not set inter-op threads: {e}")
+
+    print(f"Torch threads: {torch.get_num_threads()} intra-op, {torch.get_num_interop_threads()} inter-op")
+
+
+def pin_current_thread(cpus, name="thread"):
+    """
+    Restricts the calling thread to the given CPUs. Threads started from it afterwards, like the OpenMP pool torch
+        creates on its first parallel operation, inherit the mask.
+
+    Per-thread affinity needs Linux. Elsewhere the thread isn't pinned, since pinning the whole process instead
+        would undo the pins of the process's other threads.
+    """
+    if not cpus:
+        return
+
+    if hasattr(os, "sched_setaffinity"):
+        # On Linux, a thread ID is accepted wherever a process ID is
+        os.sched_setaffinity(threading.get_native_id(), cpus)
+        print(f"Pinned {name} to CPUs {cpus}")
+    else:
+        print(f"Per-thread affinity isn't supported here, not pinning {name}")
+
+
+def pin_current_process(cpus, name="process"):
+    if not cpus:
+        return
+
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    else:
+        import psutil
+        psutil.Process().cpu_affinity(cpus)
+
+    print(f"Pinned {name} to CPUs {cpus}")
+
+
+def unpin_process(pid):
+    """
+    Lets a process run on every CPU again. Child processes inherit their parent's affinity, like an emulator started
+        by a pinned worker.
+    """
+    cpus = list(range(os.cpu_count()))
+
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(pid, cpus)
+    else:
+        import psutil
+        psutil.Process(pid).cpu_affinity(cpus)
+
+
+def autotune_threads(step, candidates, steps=10, warmup=2):
+    """
+    Runs `step` with each candidate intra-op thread count, then keeps the count with the most steps per second.
+    """
+    results = {}
+    for threads in candidates:
+        torch.set_num_threads(threads)
+
+        for _ in range(warmup):
+            step()
+
+        start_time = time.perf_counter()
+        for _ in range(steps):
+            step()
+
+        results[threads] = steps / (time.perf_counter() - start_time)
+
+        print(f"Autotune: {threads:3d} threads: {results[threads]:7.2f} learn-steps/sec")
+
+    best = max(results, key=results.get)
+    torch.set_num_threads(best)
+
+    print(f"Autotune: using {best} intra-op threads")
+
+    return best, results
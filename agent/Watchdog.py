@@ -2,6 +2,7 @@ import threading
 import time
 
 from Game import Game
+from Topology import unpin_process
 
 
 class Watchdog:
@@ -26,6 +27,7 @@ class Watchdog:
 
         self.last_frame_count = 0
         self.last_frame_count_time = 0
+        self.restarts = 0
 
     def start(self):
         # If we're running in PyCharm debug mode, don't start the watchdog, unless --force-watchdog is passed
@@ -38,13 +40,7 @@ class Watchdog:
         import psutil
         if not any(process.name() == self.process_name for process in psutil.process_iter()):
             print("Watchdog: RPCS3 is not running, starting it...")
-            import subprocess
-            subprocess.Popen([
-                rf"{self.rpcs3_path}\{self.process_name}",
-                self.game_path,
-                "--no-gui",
-                "--headless" if not self.render else ""]
-            )
+            self.launch()
 
             time.sleep(10)
 
@@ -52,6 +48,18 @@ class Watchdog:
         thread.daemon = True
         thread.start()
 
+    def launch(self):
+        import subprocess
+        process = subprocess.Popen([
+            rf"{self.rpcs3_path}\{self.process_name}",
+            self.game_path,
+            "--no-gui",
+            "--headless" if not self.render else ""]
+        )
+
+        # RPCS3 would inherit the CPUs the worker is pinned to for inference
+        unpin_process(process.pid)
+
     def run(self):
         if self.env is None:
             return
@@ -68,15 +76,11 @@ class Watchdog:
                 subprocess.call(f"taskkill /IM {self.process_name} /F")
 
                 # Start RPCS3 again
-                subprocess.Popen([
-                    rf"{self.rpcs3_path}\{self.process_name}",
-                    self.game_path,
-                    "--no-gui",
-                    "--headless" if not self.render else ""]
-                )
+                self.launch()
 
                 # Signal to environment that it should restart and re-attach to RPCS3
                 self.env.must_restart = True
+                self.restarts += 1
 
                 self.last_frame_count = 0
                 self.last_frame_count_time = 0
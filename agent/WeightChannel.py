@@ -0,0 +1,276 @@
+import copy
+import json
+import time
+import zlib
+
+import numpy as np
+import torch
+
+from redis import Redis
+from threading import Thread, Lock, Event
+
+
+class WeightPublisher:
+    """
+    Publishes model weights to Redis for workers to fetch.
+
+    Tensors are stored per parameter, optionally as fp16 and zlib-compressed, and a parameter is only rewritten when its
+        encoded bytes changed since the last update. Every update bumps a version number and is announced on a pub/sub
+        channel so workers don't have to poll for it.
+    """
+    def __init__(self, redis: Redis, prefix="weights", half_precision=True, compression_level=1):
+        self.redis = redis
+        self.prefix = prefix
+        self.half_precision = half_precision
+        self.compression_level = compression_level
+
+        # Without Redis the publisher can still encode updates, which is what the benchmarks use
+        self.version = int(redis.get(f"{prefix}:version") or 0) if redis is not None else 0
+
+        self.checksums = {}
+
+        self.last_bytes = 0
+        self.last_raw_bytes = 0
+        self.last_changed = 0
+
+    def encode(self, tensor: torch.Tensor):
+        array = tensor.detach().cpu()
+        if self.half_precision and array.is_floating_point():
+            array = array.to(torch.float16)
+
+        data = array.numpy().tobytes()
+        if self.compression_level > 0:
+            data = zlib.compress(data, self.compression_level)
+
+        return data, str(array.numpy().dtype)
+
+    def encode_update(self, state_dict):
+        """
+        Encodes a state dict, returning the manifest of all tensors and the encoded bytes of those that changed.
+        """
+        manifest = {}
+        changed = {}
+
+        for name, tensor in state_dict.items():
+            data, dtype = self.encode(tensor)
+
+            manifest[name] = {
+                "shape": list(tensor.shape),
+                "dtype": dtype,
+                "original_dtype": str(tensor.dtype).replace("torch.", ""),
+                "compressed": self.compression_level > 0,
+            }
+
+            checksum = zlib.crc32(data)
+            if self.checksums.get(name) == checksum:
+                continue
+
+            self.checksums[name] = checksum
+            changed[name] = data
+
+        self.last_raw_bytes = sum(tensor.numel() * tensor.element_size() for tensor in state_dict.values())
+        self.last_bytes = sum(len(data) for data in changed.values())
+        self.last_changed = len(changed)
+
+        return manifest, changed
+
+    def publish(self, state_dict):
+        manifest, changed = self.encode_update(state_dict)
+
+        self.version += 1
+
+        # Params, versions and the version number change together in one transaction
+        pipeline = self.redis.pipeline()
+        if changed:
+            pipeline.hset(f"{self.prefix}:params", mapping=changed)
+            pipeline.hset(f"{self.prefix}:param_versions", mapping={name: self.version for name in changed})
+        pipeline.set(f"{self.prefix}:manifest", json.dumps(manifest))
+        pipeline.set(f"{self.prefix}:version", self.version)
+        pipeline.publish(f"{self.prefix}:updates", self.version)
+        pipeline.execute()
+
+        return self.version
+
+
+class WeightSubscriber:
+    """
+    Receives update notifications from a `WeightPublisher` and fetches the parameters that changed since the last
+        version this subscriber loaded. Only model weights are ever fetched, never optimizer state.
+    """
+    def __init__(self, redis: Redis, prefix="weights"):
+        self.redis = redis
+        self.prefix = prefix
+
+        self.version = 0
+        self.param_versions = {}
+
+        self.pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(f"{prefix}:updates")
+
+        self.last_bytes = 0
+        self.last_latency = 0.0
+
+    def poll(self):
+        """
+        Returns the newest announced version if it's newer than the loaded one, without a round trip to Redis.
+        """
+        newest = None
+        while True:
+            message = self.pubsub.get_message()
+            if message is None:
+                break
+
+            if message["type"] == "message":
+                newest = int(message["data"])
+
+        return newest if newest is not None and newest > self.version else None
+
+    def fetch(self):
+        """
+        Fetches the changed parameters of the latest version. Returns (version, {name: tensor}) or None when there's
+            nothing newer.
+        """
+        start_time = time.perf_counter()
+
+        while True:
+            # Each read is a transaction, so it never sees half of a publish
+            pipeline = self.redis.pipeline(transaction=True)
+            pipeline.get(f"{self.prefix}:version")
+            pipeline.get(f"{self.prefix}:manifest")
+            pipeline.hgetall(f"{self.prefix}:param_versions")
+            version, manifest, param_versions = pipeline.execute()
+
+            if version is None or int(version) <= self.version:
+                return None
+
+            manifest = json.loads(manifest)
+            param_versions = {name.decode(): int(param_version) for name, param_version in param_versions.items()}
+
+            names = [name for name in manifest if param_versions.get(name, 0) > self.param_versions.get(name, 0)]
+            if not names:
+                values = []
+                break
+
+            # Tensors of a version published in between would be recorded with the older versions and never fetched
+            # again, so they're only kept if the version is still the same
+            pipeline = self.redis.pipeline(transaction=True)
+            pipeline.hmget(f"{self.prefix}:params", names)
+            pipeline.get(f"{self.prefix}:version")
+            values, current_version = pipeline.execute()
+
+            if current_version == version:
+                break
+
+        tensors = {}
+        for name, data in zip(names, values):
+            if data is None:
+                continue
+
+            tensors[name] = self.decode(data, manifest[name])
+            self.param_versions[name] = param_versions[name]
+
+        self.version = int(version)
+        self.last_bytes = sum(len(data) for data in values if data is not None)
+        self.last_latency = time.perf_counter() - start_time
+
+        return self.version, tensors
+
+    @staticmethod
+    def decode(data, description):
+        if description["compressed"]:
+            data = zlib.decompress(data)
+
+        array = np.frombuffer(data, dtype=description["dtype"]).reshape(description["shape"])
+
+        return torch.from_numpy(array.copy()).to(getattr(torch, description["original_dtype"]))
+
+    def update(self, model: torch.nn.Module):
+        """
+        Fetches and loads the latest weights into `model` in place. Returns True if the model changed.
+        """
+        result = self.fetch()
+        if result is None:
+            return False
+
+        _, tensors = result
+
+        state = model.state_dict()
+        with torch.no_grad():
+            for name, tensor in tensors.items():
+                state[name].copy_(tensor)
+
+        return True
+
+
+class WeightRefresher:
+    """
+    Loads new weights on a background thread, so fetching and deserializing them never holds up acting. Updates from a
+        `WeightSubscriber` or `SharedWeightSubscriber` are loaded into a standby copy of the model, which `swap` then
+        hands out in place of the acting one between steps.
+
+    The subscriber is only used by the background thread once it's started. Updates only carry the tensors that
+        changed, so after a swap the old acting model is first brought up to date with the new one before it's the
+        standby for the next update.
+    """
+    def __init__(self, subscriber, model: torch.nn.Module, interval=0.05):
+        self.subscriber = subscriber
+        self.interval = interval
+
+        self.version = subscriber.version
+        self.standby = copy.deepcopy(model)
+        self.acting = model
+
+        self.ready = None
+        self.behind = False
+        self.lock = Lock()
+        self.requested = Event()
+
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def request(self):
+        """
+        Fetches weights even if no new version was announced, like when the configuration names a newer one.
+        """
+        self.requested.set()
+
+    def run(self):
+        requested = False
+        while True:
+            # A request made while a swap is pending is kept for after it
+            requested = self.requested.wait(self.interval) or requested
+            self.requested.clear()
+
+            with self.lock:
+                if self.ready is not None:
+                    continue
+
+                # The standby model was acting until the last swap and misses that update
+                if self.behind:
+                    self.standby.load_state_dict(self.acting.state_dict())
+                    self.behind = False
+
+            try:
+                if (requested or self.subscriber.poll() is not None) and self.subscriber.update(self.standby):
+                    with self.lock:
+                        self.ready = self.standby
+                requested = False
+            except Exception as e:
+                print(f"Failed to load new weights ({e!r}), keeping version {self.version}")
+
+    def swap(self, model: torch.nn.Module):
+        """
+        Returns the model to act with from now on: the standby model when it has newer weights than `model`, else
+            `model` itself. Call between steps.
+        """
+        # Checked without the lock first, the background thread holds it while it catches up the standby model
+        if self.ready is None:
+            return model
+
+        with self.lock:
+            self.standby, self.acting = model, self.ready
+            self.ready = None
+            self.behind = True
+            self.version = self.subscriber.version
+
+        return self.acting
@@ -0,0 +1,1046 @@
+from Agent import Agent
+from ReplayBuffer import Transition, PrioritizedReplayBuffer, SequenceReplayBuffer, SharedReplayBuffer, StagingBuffer, SumTree, \
+    synthetic_transitions
+from Network import DeepQNetwork, TargetNetworkUpdater
+from Distributed import init_distributed, broadcast_training_state
+from WeightChannel import WeightPublisher, WeightSubscriber
+from Ingestion import start_decoders, collect_decoded, fan_out
+from LocalTransport import TransitionRing, LaneReader, SharedWeightPublisher, SharedWeightSubscriber
+from Experience import ExperiencePublisher, ExperienceDecoder, ExperienceStream, IngestionStats, \
+    TransitionBatchMessage, consume_stream
+
+import torch
+import numpy as np
+
+import argparse
+import os
+import pickle
+import time
+
+from threading import Event, Thread
+
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+
+features = 44
+sequence_length = 8
+n_actions = 16
+
+
+def make_agent(batch_size, **kwargs):
+    return Agent(gamma=0.99, epsilon=1.0, batch_size=batch_size, n_actions=n_actions, eps_end=0.005,
+                 input_dims=features, lr=2.0e-6, sequence_length=sequence_length, **kwargs)
+
+
+def run_learner(agent: Agent, steps: int, seed: int):
+    np.random.seed(seed)
+
+    losses = []
+    start_time = time.perf_counter()
+    for _ in range(steps):
+        losses.append(agent.learn())
+    elapsed = time.perf_counter() - start_time
+
+    return losses, elapsed
+
+
+def copy_weights(source: Agent, destination: Agent):
+    destination.Q_eval.load_state_dict(source.Q_eval.state_dict())
+    destination.Q_eval.optimizer.load_state_dict(source.Q_eval.optimizer.state_dict())
+    destination.update_target_network()
+
+
+def compare_learners(args, agents: dict):
+    """
+    Trains every agent on the same synthetic replay set with the same sample order, returning the losses per agent.
+    """
+    results = {}
+    for name, agent in agents.items():
+        agent.fill_synthetic(args.transitions, args.seed)
+
+        # Uniform sampling, otherwise rounding differences in TD errors change which transitions the modes sample
+        agent.replay_buffer.alpha = 0.0
+
+        # A few untimed steps so allocator warm-up doesn't count against the first mode
+        warmup_losses, _ = run_learner(agent, args.warmup, args.seed)
+
+        losses, elapsed = run_learner(agent, args.steps, args.seed + 1)
+        results[name] = warmup_losses + losses
+
+        print(f"{name:>10}: {args.steps * args.batch_size / elapsed:10.1f} samples/sec, "
+              f"{1000 * elapsed / args.steps:7.2f} ms/step")
+
+    return results
+
+
+def benchmark_fused(args):
+    reference = make_agent(args.batch_size)
+    fused = make_agent(args.batch_size, fused_learn=True)
+    copy_weights(reference, fused)
+
+    results = compare_learners(args, {"separate": reference, "fused": fused})
+
+    difference = np.abs(np.array(results["separate"]) - np.array(results["fused"]))
+    print(f"max loss difference: {difference.max():.3e}, mean loss difference: {difference.mean():.3e}")
+
+    if difference.max() > args.tolerance:
+        print("WARNING: Fused learn step does not match the separate forward passes")
+
+
+def benchmark_precision(args):
+    reference = make_agent(args.batch_size, fused_learn=args.fused_learn)
+    bf16 = make_agent(args.batch_size, fused_learn=args.fused_learn, mixed_precision=True)
+    copy_weights(reference, bf16)
+
+    results = compare_learners(args, {"fp32": reference, "bf16": bf16})
+
+    fp32_losses, bf16_losses = np.array(results["fp32"]), np.array(results["bf16"])
+
+    # Loss curves in windows, so drift between the two shows up as a trend rather than noise
+    print(f"{'steps':>11} {'fp32 loss':>12} {'bf16 loss':>12} {'rel. diff':>10}")
+    window = max(1, len(fp32_losses) // args.windows)
+    for start in range(0, len(fp32_losses), window):
+        fp32_loss = fp32_losses[start:start + window].mean()
+        bf16_loss = bf16_losses[start:start + window].mean()
+
+        print(f"{start:5d}-{start + window - 1:<5d} {fp32_loss:12.6f} {bf16_loss:12.6f} "
+              f"{abs(bf16_loss - fp32_loss) / max(abs(fp32_loss), 1e-12):10.2%}")
+
+
+def time_update(update, repeats):
+    update()
+
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        update()
+
+    return 1e6 * (time.perf_counter() - start_time) / repeats
+
+
+def benchmark_target_update(args):
+    print(f"{'hidden':>7} {'params':>12} {'state dict':>14} {'hard':>12} {'soft':>12}")
+
+    for hidden_dims in args.sizes:
+        source = DeepQNetwork(lr=0.0, feature_count=features, hidden_dims=hidden_dims, n_actions=n_actions,
+                              lstm_units=hidden_dims)
+        target = DeepQNetwork(lr=0.0, feature_count=features, hidden_dims=hidden_dims, n_actions=n_actions,
+                              lstm_units=hidden_dims)
+        target.freeze()
+
+        updater = TargetNetworkUpdater(source, target)
+
+        parameters = sum(parameter.numel() for parameter in source.parameters())
+
+        state_dict_time = time_update(lambda: target.load_state_dict(source.state_dict()), args.repeats)
+        hard_time = time_update(updater.hard_update, args.repeats)
+        soft_time = time_update(lambda: updater.soft_update(args.tau), args.repeats)
+
+        print(f"{hidden_dims:7d} {parameters:12,d} {state_dict_time:11.1f} us {hard_time:9.1f} us {soft_time:9.1f} us")
+
+
+def data_parallel_rank(rank, world_size, args, results):
+    torch.set_num_threads(args.threads)
+
+    agent = make_agent(args.batch_size, fused_learn=args.fused_learn, distributed=world_size > 1)
+
+    # Every rank gets its own synthetic shard
+    agent.fill_synthetic(args.transitions, args.seed + rank)
+
+    if world_size > 1:
+        init_distributed(rank, world_size, "localhost", args.master_port + world_size)
+        broadcast_training_state(agent)
+
+    _, _ = run_learner(agent, args.warmup, args.seed + rank)
+    _, elapsed = run_learner(agent, args.steps, args.seed + rank + 1)
+
+    if rank == 0:
+        results.put(args.steps * args.batch_size * world_size / elapsed)
+
+
+def benchmark_data_parallel(args):
+    context = torch.multiprocessing.get_context("spawn")
+
+    baseline = None
+    print(f"{'learners':>8} {'samples/sec':>12} {'speedup':>8} {'efficiency':>10}")
+
+    for world_size in args.learners:
+        results = context.SimpleQueue()
+        torch.multiprocessing.spawn(data_parallel_rank, args=(world_size, args, results), nprocs=world_size)
+
+        samples_per_second = results.get()
+
+        # Efficiency is relative to the per-learner throughput of the smallest run
+        if baseline is None:
+            baseline = samples_per_second / world_size
+
+        speedup = samples_per_second / baseline
+        print(f"{world_size:8d} {samples_per_second:12.1f} {speedup:7.2f}x {speedup / world_size:10.1%}")
+
+
+def benchmark_weights(args):
+    agent = make_agent(args.batch_size)
+    agent.fill_synthetic(args.transitions, args.seed)
+
+    redis = None
+    if args.redis_url:
+        from redis import from_url as redis_from_url
+        redis = redis_from_url(args.redis_url)
+
+    publisher = WeightPublisher(redis, prefix="benchmark_weights", half_precision=not args.full_precision,
+                                compression_level=args.compression_level)
+    subscriber = WeightSubscriber(redis, prefix="benchmark_weights") if redis is not None else None
+    worker_model = make_agent(0).Q_eval
+
+    print(f"{'update':>6} {'pickled model+opt':>18} {'changed':>8} {'sent':>10} {'fetched':>10} {'latency':>9}")
+
+    for update in range(args.updates):
+        legacy_bytes = len(pickle.dumps(agent.Q_eval.state_dict())) + \
+            len(pickle.dumps(agent.Q_eval.optimizer.state_dict()))
+
+        if redis is not None:
+            publisher.publish(agent.Q_eval.state_dict())
+            subscriber.poll()
+            subscriber.update(worker_model)
+            fetched = f"{subscriber.last_bytes / 1024:7.1f} kB"
+            latency = f"{subscriber.last_latency * 1000:6.1f} ms"
+        else:
+            publisher.encode_update(agent.Q_eval.state_dict())
+            fetched, latency = "-", "-"
+
+        print(f"{update:6d} {legacy_bytes / 1024:15.1f} kB {publisher.last_changed:8d} "
+              f"{publisher.last_bytes / 1024:7.1f} kB {fetched:>10} {latency:>9}")
+
+        run_learner(agent, args.interval, args.seed + update)
+
+    if redis is not None:
+        redis.delete(*[f"benchmark_weights:{key}" for key in ("params", "param_versions", "manifest", "version")])
+
+
+def benchmark_replay(args):
+    recurrent_shape = (3, 1, 256)
+
+    # Generated up front so the ingest rate only measures the buffer
+    transitions = list(synthetic_transitions(args.ingest, sequence_length, features, n_actions, recurrent_shape,
+                                             args.seed))
+
+    print(f"{'capacity':>9} {'ingest/sec':>11} {'batches/sec':>12} {'samples/sec':>12} {'bytes/transition':>17} "
+          f"{'observation bytes':>18}")
+
+    for capacity in args.capacities:
+        if args.replay == "sequence":
+            replay_buffer = SequenceReplayBuffer(capacity, sequence_length, burn_in=args.burn_in)
+        else:
+            path = os.path.join(args.path, str(capacity)) if args.path else None
+            replay_buffer = PrioritizedReplayBuffer(capacity, deduplicate_frames=args.deduplicate_frames, path=path)
+
+        start_time = time.perf_counter()
+        for transition in transitions:
+            replay_buffer.add(*transition)
+        ingest_rate = args.ingest / (time.perf_counter() - start_time)
+
+        # Sampling cost depends on the occupied size, so sample as if the ring had been filled completely
+        if args.replay == "sequence":
+            replay_buffer.priorities.update(np.arange(replay_buffer.capacity), 1.0)
+            replay_buffer.arrays["lengths"][:] = replay_buffer.period
+            replay_buffer.transitions = replay_buffer.capacity * replay_buffer.period
+        else:
+            replay_buffer.total = capacity
+
+        allocated = sum(array.nbytes for array in replay_buffer.arrays.values())
+
+        # Everything but the per-transition fields, which is what frame deduplication shrinks
+        observations = sum(array.nbytes for name, array in replay_buffer.arrays.items()
+                           if name in ("states", "next_states") or "frame" in name)
+
+        np.random.seed(args.seed)
+        start_time = time.perf_counter()
+        for _ in range(args.batches):
+            sample = replay_buffer.sample(args.batch_size)
+            replay_buffer.update_priorities(sample[5], np.random.rand(args.batch_size) + 1e-5)
+        batch_rate = args.batches / (time.perf_counter() - start_time)
+
+        print(f"{capacity:9d} {ingest_rate:11.1f} {batch_rate:12.1f} {batch_rate * args.batch_size:12.1f} "
+              f"{allocated / capacity:17.1f} {observations / capacity:18.1f}")
+
+        if args.path and args.replay == "prioritized":
+            start_time = time.perf_counter()
+            replay_buffer.flush()
+            flush_time = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            PrioritizedReplayBuffer(capacity, deduplicate_frames=args.deduplicate_frames, path=path)
+            print(f"{'':9} flushed in {flush_time * 1000:.1f} ms, reopened in "
+                  f"{(time.perf_counter() - start_time) * 1000:.1f} ms")
+
+
+def benchmark_ingestion(args):
+    recurrent_shape = (3, 1, 256)
+    transitions = list(synthetic_transitions(args.ingest, sequence_length, features, n_actions, recurrent_shape,
+                                             args.seed))
+
+    print(f"{'mode':>7} {'ingest/sec':>11} {'batches/sec':>12} {'commit ms':>10} {'peak staged':>12}")
+
+    for mode in ("direct", "staged"):
+        replay_buffer = PrioritizedReplayBuffer(args.capacity)
+        staging = StagingBuffer() if mode == "staged" else None
+        add = staging.stage if staging is not None else replay_buffer.add
+
+        for transition in transitions[:args.batch_size]:
+            replay_buffer.add(*transition)
+
+        # A listener thread adds transitions at the given rate while this thread samples like the learner does
+        finished = Event()
+
+        def listener():
+            start_time = time.perf_counter()
+            for index, transition in enumerate(transitions):
+                add(*transition)
+
+                if args.rate and index % 100 == 0:
+                    time.sleep(max(0.0, start_time + index / args.rate - time.perf_counter()))
+
+            listener.rate = len(transitions) / (time.perf_counter() - start_time)
+            finished.set()
+
+        thread = Thread(target=listener)
+        thread.start()
+
+        batches = 0
+        start_time = time.perf_counter()
+        while not finished.is_set():
+            if staging is not None:
+                staging.commit(replay_buffer)
+
+            sample = replay_buffer.sample(args.batch_size)
+            replay_buffer.update_priorities(sample[5], np.random.rand(args.batch_size) + 1e-5)
+            batches += 1
+        batch_rate = batches / (time.perf_counter() - start_time)
+
+        thread.join()
+
+        stats = staging.stats() if staging is not None else {"commit_ms": 0.0, "peak_staged": 0}
+        print(f"{mode:>7} {listener.rate:11.1f} {batch_rate:12.1f} {stats['commit_ms']:10.2f} "
+              f"{stats['peak_staged']:12d}")
+
+
+def benchmark_prefetch(args):
+    print(f"{'depth':>6} {'samples/sec':>12} {'ms/step':>8} {'stall ms/step':>14} {'stall %':>8}")
+
+    for depth in args.depths:
+        agent = make_agent(args.batch_size, replay=args.replay)
+        agent.fill_synthetic(args.transitions, args.seed)
+
+        if depth > 0:
+            agent.start_prefetching(depth)
+
+        run_learner(agent, args.warmup, args.seed)
+        if agent.prefetcher is not None:
+            agent.prefetcher.stats()
+
+        _, elapsed = run_learner(agent, args.steps, args.seed + 1)
+
+        stats = agent.prefetcher.stats() if agent.prefetcher is not None else {"stall_ms": 0.0, "stall_fraction": 0.0}
+        agent.stop_prefetching()
+
+        print(f"{depth:6d} {args.steps * args.batch_size / elapsed:12.1f} {1000 * elapsed / args.steps:8.2f} "
+              f"{stats['stall_ms']:14.2f} {100 * stats['stall_fraction']:8.1f}")
+
+
+def benchmark_quantization(args):
+    recurrent_shape = (3, 1, 256)
+    transitions = list(synthetic_transitions(args.capacity, sequence_length, features, n_actions, recurrent_shape,
+                                             args.seed))
+
+    # Observations as sent, sampled with the same seed as every stored type below so the batches line up
+    reference = PrioritizedReplayBuffer(args.capacity)
+    for transition in transitions:
+        reference.add(*transition)
+
+    np.random.seed(args.seed)
+    reference = torch.cat([reference.sample(args.batch_size)[0] for _ in range(args.batches)])
+
+    print(f"{'dtype':>8} {'observation bytes':>18} {'samples/sec':>12} {'max error':>10} {'mean error':>11}")
+
+    for dtype in args.dtypes:
+        replay_buffer = PrioritizedReplayBuffer(args.capacity, deduplicate_frames=args.deduplicate_frames,
+                                                observation_dtype=dtype)
+        for transition in transitions:
+            replay_buffer.add(*transition)
+
+        observations = sum(array.nbytes for name, array in replay_buffer.arrays.items()
+                           if name in ("states", "next_states") or "frame" in name)
+
+        # One untimed batch first, so the first type doesn't pay for warm-up
+        replay_buffer.sample(args.batch_size)
+
+        np.random.seed(args.seed)
+        start_time = time.perf_counter()
+        batches = [replay_buffer.sample(args.batch_size) for _ in range(args.batches)]
+        sample_rate = args.batches * args.batch_size / (time.perf_counter() - start_time)
+
+        error = (torch.cat([batch[0] for batch in batches]) - reference).abs()
+
+        print(f"{dtype:>8} {observations / args.capacity:18.1f} {sample_rate:12.1f} {error.max():10.2e} "
+              f"{error.mean():11.2e}")
+
+
+def shared_replay_consumer(index, args, started, results):
+    torch.set_num_threads(1)
+
+    replay_buffer = SharedReplayBuffer.attach(args.name)
+    started.wait()
+
+    batches = 0
+    start_time = time.perf_counter()
+    while time.perf_counter() - start_time < args.duration:
+        sample = replay_buffer.sample(args.batch_size)
+        replay_buffer.update_priorities(sample[5], np.random.rand(args.batch_size) + 1e-5)
+        batches += 1
+
+    results.put((batches * args.batch_size / (time.perf_counter() - start_time), replay_buffer.retries))
+    replay_buffer.close()
+
+
+def benchmark_shared_replay(args):
+    recurrent_shape = (3, 1, 256)
+    transitions = list(synthetic_transitions(args.capacity, sequence_length, features, n_actions, recurrent_shape,
+                                             args.seed))
+
+    context = torch.multiprocessing.get_context("spawn")
+
+    print(f"{'consumers':>9} {'ingest/sec':>11} {'samples/sec':>12} {'per consumer':>13} {'retries':>8}")
+
+    for consumers in args.consumers:
+        replay_buffer = SharedReplayBuffer(args.name, args.capacity)
+        for transition in transitions:
+            replay_buffer.add(*transition)
+
+        started = context.Event()
+        results = context.SimpleQueue()
+        processes = [context.Process(target=shared_replay_consumer, args=(index, args, started, results))
+                     for index in range(consumers)]
+        for process in processes:
+            process.start()
+
+        # The consumers attach first, then everything runs for the same duration
+        time.sleep(args.attach_time)
+        started.set()
+
+        added = 0
+        start_time = time.perf_counter()
+        while time.perf_counter() - start_time < args.duration:
+            replay_buffer.add(*transitions[added % len(transitions)])
+            added += 1
+        ingest_rate = added / (time.perf_counter() - start_time)
+
+        for process in processes:
+            process.join()
+
+        rates, retries = zip(*[results.get() for _ in processes])
+        replay_buffer.close()
+
+        print(f"{consumers:9d} {ingest_rate:11.1f} {sum(rates):12.1f} {np.mean(rates):13.1f} {sum(retries):8d}")
+
+
+def redis_connector(redis_url):
+    """
+    Returns a function that opens a new connection, to `redis_url` or to an in-process stand-in shared by all of them.
+    """
+    if redis_url:
+        from redis import from_url as redis_from_url
+        return lambda: redis_from_url(redis_url)
+
+    # Without a Redis server, an in-process stand-in keeps the benchmarks runnable, minus the network
+    import fakeredis
+    server = fakeredis.FakeServer()
+    return lambda: fakeredis.FakeRedis(server=server)
+
+
+def publish_synthetic(publisher: ExperiencePublisher, transitions, rate=0):
+    """
+    Feeds transitions to `publisher` the way a worker does, at `rate` transitions/sec or as fast as possible.
+    """
+    start_time = time.perf_counter()
+    episode_start = True
+    for index, (state, action, reward, next_state, done, hidden_state, cell_state) in enumerate(transitions):
+        if episode_start:
+            publisher.start_episode(state[-1])
+
+        publisher.add(next_state[-1], action, reward, done, hidden_state, cell_state)
+        episode_start = done
+
+        # Workers produce transitions at the pace of the environment
+        if rate:
+            time.sleep(max(0.0, start_time + index / rate - time.perf_counter()))
+
+    publisher.flush()
+
+
+def benchmark_publishing(args):
+    recurrent_shape = (3, 1, 256)
+    transitions = list(synthetic_transitions(args.transitions, sequence_length, features, n_actions, recurrent_shape,
+                                             args.seed))
+
+    connect = redis_connector(args.redis_url)
+
+    print(f"{'batch':>6} {'messages/sec':>13} {'transitions/sec':>16} {'kB/sec':>9} {'B/transition':>13} "
+          f"{'latency mean':>13} {'latency p99':>12}")
+
+    for batch_size in args.batch_sizes:
+        replay_buffer = PrioritizedReplayBuffer(args.transitions)
+        stats = IngestionStats()
+
+        stream_name = f"benchmark_replay_buffer_{batch_size}"
+        redis = connect()
+        redis.delete(stream_name)
+        finished = Event()
+
+        # Listener like the node's: whole batches go into the replay buffer at once
+        def listener():
+            stream = ExperienceStream(connect(), stream=stream_name, group="benchmark")
+            decoder = ExperienceDecoder()
+            received = 0
+            while received < len(transitions):
+                messages = stream.read()
+                for _, data in messages:
+                    worker_name, batch, timestamps = decoder.decode(data)
+                    stats.received(len(batch[1]), len(data))
+                    replay_buffer.add_batch(*batch, [worker_name] * len(batch[1]))
+                    stats.visible(timestamps)
+                    received += len(batch[1])
+
+                stream.ack([message_id for message_id, _ in messages])
+
+            finished.set()
+
+        thread = Thread(target=listener)
+        thread.start()
+
+        publisher = ExperiencePublisher(redis, "benchmark-worker", stream=stream_name,
+                                        max_transitions=batch_size, max_delay=args.max_delay,
+                                        window=sequence_length, recurrent_interval=args.recurrent_interval)
+
+        stats.report()
+        publish_synthetic(publisher, transitions, args.rate)
+
+        finished.wait()
+        thread.join()
+        redis.delete(stream_name)
+
+        report = stats.report()
+        print(f"{batch_size:6d} {report['messages_per_second']:13.1f} {report['transitions_per_second']:16.1f} "
+              f"{report['bytes_per_second'] / 1024:9.1f} {report['bytes_per_transition']:13.0f} "
+              f"{report['latency_mean_ms']:10.1f} ms {report['latency_p99_ms']:9.1f} ms")
+
+
+def benchmark_wire(args):
+    recurrent_shape = (3, 1, 256)
+    transitions = list(synthetic_transitions(args.transitions, sequence_length, features, n_actions, recurrent_shape,
+                                             args.seed))
+    expected = tuple(np.stack(column) for column in zip(*transitions))
+
+    # Pickled batches, as workers published them before
+    start_time = time.perf_counter()
+    pickled = []
+    for start in range(0, len(transitions), args.message_size):
+        batch = [Transition(*transition) for transition in transitions[start:start + args.message_size]]
+        pickled.append(pickle.dumps(TransitionBatchMessage(batch, "benchmark-worker", [time.time()] * len(batch))))
+    encode_time = time.perf_counter() - start_time
+    results = [("pickle", pickled, encode_time)]
+
+    for interval in args.recurrent_intervals:
+        redis = redis_connector(None)()
+        publisher = ExperiencePublisher(redis, "benchmark-worker", max_transitions=args.message_size,
+                                        max_delay=float("inf"), window=sequence_length, recurrent_interval=interval,
+                                        max_length=None)
+
+        start_time = time.perf_counter()
+        publish_synthetic(publisher, transitions)
+        encode_time = time.perf_counter() - start_time
+
+        messages = [fields[b"data"] for _, fields in redis.xrange(publisher.stream)]
+        results.append((f"binary, recurrent every {interval}" if interval else "binary, no recurrent", messages,
+                        encode_time))
+
+    print(f"{'format':>28} {'B/transition':>13} {'smaller':>8} {'encode us':>10} {'decode us':>10} "
+          f"{'windows':>8} {'recurrent max error':>20}")
+
+    baseline = None
+    for name, messages, encode_time in results:
+        decoder = ExperienceDecoder()
+
+        start_time = time.perf_counter()
+        batches = [decoder.decode(message)[1] for message in messages]
+        decode_time = time.perf_counter() - start_time
+
+        decoded = tuple(np.concatenate(column) for column in zip(*batches))
+        windows_match = np.array_equal(decoded[0], expected[0]) and np.array_equal(decoded[3], expected[3])
+        recurrent_error = np.abs(decoded[5] - expected[5].squeeze(2)).max()
+
+        size = sum(len(message) for message in messages) / len(transitions)
+        baseline = baseline or size
+        print(f"{name:>28} {size:13.0f} {baseline / size:7.1f}x {encode_time / len(transitions) * 1e6:10.1f} "
+              f"{decode_time / len(transitions) * 1e6:10.1f} {'same' if windows_match else 'DIFFER':>8} "
+              f"{recurrent_error:20.4f}")
+
+
+def benchmark_transport(args):
+    """
+    Workers publish faster than a slow consumer reads, and the consumer crashes without acknowledging what it read.
+        Every message still has to arrive, with the workers held back instead of the stream overflowing.
+    """
+    recurrent_shape = (3, 1, 256)
+    connect = redis_connector(args.redis_url)
+    stream_name = "benchmark_transport"
+    connect().delete(stream_name)
+
+    publishers = [ExperiencePublisher(connect(), f"worker-{worker}", stream=stream_name,
+                                      max_transitions=args.message_size, window=sequence_length,
+                                      max_length=args.max_length, max_backlog=args.max_backlog)
+                  for worker in range(args.workers)]
+    threads = [Thread(target=publish_synthetic, args=(publisher, list(synthetic_transitions(
+        args.transitions, sequence_length, features, n_actions, recurrent_shape, args.seed + worker))))
+        for worker, publisher in enumerate(publishers)]
+
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+
+    stream = ExperienceStream(connect(), stream=stream_name, group="benchmark")
+    processed = set()
+    redelivered = 0
+    recovered = 0
+    crashed = False
+    peak_backlog = 0
+    while any(thread.is_alive() for thread in threads) or len(processed) < sum(p.messages for p in publishers):
+        recovering = stream.recovering
+        messages = stream.read()
+        time.sleep(args.consume_delay * len(messages))
+
+        if crashed and recovering:
+            recovered += len(messages)
+
+        # Crash halfway: what was read is never acknowledged, and a new consumer with the same name takes over
+        if not crashed and messages and len(processed) > args.workers * args.transitions / args.message_size / 2:
+            crashed = True
+            stream = ExperienceStream(connect(), stream=stream_name, group="benchmark")
+            continue
+
+        redelivered += sum(message_id in processed for message_id, _ in messages)
+        processed.update(message_id for message_id, _ in messages)
+        stream.ack([message_id for message_id, _ in messages])
+        peak_backlog = max([peak_backlog] + [publisher.backlog for publisher in publishers])
+
+    elapsed = time.perf_counter() - start_time
+    published = sum(publisher.messages for publisher in publishers)
+
+    print(f"{published} messages published by {args.workers} workers in {elapsed:.1f}s, {len(processed)} processed, "
+          f"{published - len(processed)} lost, {recovered} recovered after the crash, {redelivered} processed twice")
+    print(f"Peak backlog {peak_backlog} messages with a limit of {args.max_backlog}, workers waited "
+          f"{np.mean([publisher.throttled_time for publisher in publishers]):.1f}s on average, stream holds at most "
+          f"about {args.max_length}")
+
+    connect().delete(stream_name)
+
+
+def serve_fake_redis(port):
+    import fakeredis
+
+    server = fakeredis.TcpFakeServer(("127.0.0.1", port), server_type="redis")
+    server.serve_forever()
+
+
+def benchmark_decoders(args):
+    """
+    Ingests the same stream of experience with decoding on a thread of the learner process, and with 1 or more
+        decoder processes, while the learner keeps training.
+    """
+    recurrent_shape = (3, 1, 256)
+
+    # Only this process reads the stream, decoder processes get the messages through shared memory
+    connect = redis_connector(args.redis_url)
+    connect().delete("replay_buffer")
+
+    # Every run reads the same messages, in a consumer group of its own
+    for worker in range(args.workers):
+        publisher = ExperiencePublisher(connect(), f"worker-{worker}", max_transitions=args.message_size,
+                                        window=sequence_length, max_length=None, max_backlog=float("inf"))
+        publish_synthetic(publisher, synthetic_transitions(args.transitions, sequence_length, features, n_actions,
+                                                           recurrent_shape, args.seed + worker))
+    total = args.workers * args.transitions
+
+    agent = make_agent(args.batch_size, fused_learn=True)
+    agent.fill_synthetic(args.batch_size * 8, args.seed)
+
+    def ingest(replay_buffer, staging, ingestion_stats, worker_name, batch, timestamps):
+        replay_buffer.add_batch(*batch, [worker_name] * len(batch[1]))
+
+    print(f"{'decoders':>9} {'transitions/sec':>16} {'learn steps/sec':>16}")
+
+    for decoders in args.decoders:
+        replay_buffer = PrioritizedReplayBuffer(total)
+        ingestion_stats = IngestionStats()
+        group = f"benchmark-{decoders}-{time.time()}"
+        stop = Event()
+
+        if decoders == 0:
+            decoder = ExperienceDecoder()
+
+            def handle(data, replay_buffer=replay_buffer):
+                worker_name, batch, timestamps = decoder.decode(data)
+                ingest(replay_buffer, None, ingestion_stats, worker_name, batch, timestamps)
+
+            thread = Thread(target=consume_stream, args=(ExperienceStream(connect(), group=group), handle, stop))
+            processes = []
+        else:
+            rings, processes, input_ring = start_decoders(decoders, sequence_length, features, recurrent_shape[::2])
+            thread = Thread(target=collect_decoded, args=(rings, replay_buffer, None, ingestion_stats, ingest, stop))
+            reader = Thread(target=fan_out, args=(ExperienceStream(connect(), group=group), input_ring, None, stop))
+            reader.start()
+
+        thread.start()
+
+        # Timed from the first transition, starting the decoder processes takes a while
+        while replay_buffer.total == 0:
+            time.sleep(0.01)
+        start_time = time.perf_counter()
+        start_total = replay_buffer.total
+
+        # The learner trains the whole time, which is what decoding on its own thread competes with
+        learn_steps = 0
+        while replay_buffer.total < total:
+            agent.learn()
+            learn_steps += 1
+
+        elapsed = time.perf_counter() - start_time
+        print(f"{decoders if decoders else 'thread':>9} {(total - start_total) / elapsed:16.1f} "
+              f"{learn_steps / elapsed:16.1f}")
+
+        stop.set()
+        thread.join()
+        for process in processes:
+            process.terminate()
+            process.join()
+
+        if decoders > 0:
+            reader.join()
+            for ring in rings:
+                ring.close()
+            input_ring.close()
+
+    connect().delete("replay_buffer")
+
+
+def transport_producer(worker, transitions, message_size, seed, redis_url, local_transport):
+    recurrent_shape = (3, 1, 256)
+
+    if local_transport is not None:
+        redis, lane = None, TransitionRing.attach(local_transport).claim_lane()
+    else:
+        redis, lane = redis_connector(redis_url)(), None
+
+    publisher = ExperiencePublisher(redis, f"worker-{worker}", stream="benchmark_local", max_transitions=message_size,
+                                    window=sequence_length, max_length=None, max_backlog=float("inf"),
+                                    transport=lane)
+    publish_synthetic(publisher, synthetic_transitions(transitions, sequence_length, features, n_actions,
+                                                       recurrent_shape, seed + worker))
+
+
+def benchmark_local_transport(args):
+    """
+    Experience from worker processes to a decoding node, through Redis and through the local shared-memory ring, then
+        a weights update both ways. Every process runs on this host, Redis included unless --redis-url points
+        elsewhere, so it measures the single-host case the local transport is for.
+    """
+    context = torch.multiprocessing.get_context("spawn")
+
+    redis_url = args.redis_url
+    server = None
+    if redis_url is None:
+        server = context.Process(target=serve_fake_redis, args=(args.port,), daemon=True)
+        server.start()
+        redis_url = f"redis://127.0.0.1:{args.port}"
+
+    connect = redis_connector(redis_url)
+    for _ in range(300):
+        try:
+            connect().ping()
+            break
+        except RedisConnectionError:
+            time.sleep(0.1)
+
+    total = args.workers * args.transitions
+    name = f"benchmark_local_{os.getpid()}"
+
+    print(f"{'transport':>10} {'transitions/sec':>16} {'messages/sec':>13}")
+    for transport in ("redis", "local"):
+        if transport == "local":
+            ring = TransitionRing(name, lanes=args.workers)
+            reader = LaneReader(ring)
+        else:
+            connect().delete("benchmark_local")
+            reader = ExperienceStream(connect(), stream="benchmark_local", group="benchmark", count=8)
+
+        producers = [context.Process(target=transport_producer, args=(
+            worker, args.transitions, args.message_size, args.seed, redis_url, name if transport == "local" else None))
+            for worker in range(args.workers)]
+        for producer in producers:
+            producer.start()
+
+        # Timed from the first message, starting the producers takes a while
+        decoder = ExperienceDecoder()
+        received = 0
+        messages = 0
+        start_time = None
+        while received < total:
+            batch = reader.read()
+            if batch and start_time is None:
+                start_time = time.perf_counter()
+
+            for _, data in batch:
+                received += len(decoder.decode(data)[1][1])
+            reader.ack([message_id for message_id, _ in batch])
+            messages += len(batch)
+
+        elapsed = time.perf_counter() - start_time
+        print(f"{transport:>10} {received / elapsed:16.1f} {messages / elapsed:13.1f}")
+
+        for producer in producers:
+            producer.join()
+
+        if transport == "local":
+            ring.close()
+        else:
+            connect().delete("benchmark_local")
+
+    # Weights
+    model = DeepQNetwork(lr=0, feature_count=features, hidden_dims=256, n_actions=n_actions)
+    worker_model = DeepQNetwork(lr=0, feature_count=features, hidden_dims=256, n_actions=n_actions)
+
+    # The stand-in server can't send replies the size of the weights, without --redis-url they stay in process
+    connect_weights = connect if args.redis_url is not None else redis_connector(None)
+    weight_publisher = WeightPublisher(connect_weights(), prefix="benchmark_weights", half_precision=False,
+                                       compression_level=0)
+    weight_subscriber = WeightSubscriber(connect_weights(), prefix="benchmark_weights")
+    shared_publisher = SharedWeightPublisher(f"{name}_weights", model.state_dict())
+    shared_subscriber = SharedWeightSubscriber(f"{name}_weights")
+
+    print(f"{'weights':>10} {'publish ms':>11} {'load ms':>8}")
+    for transport, publisher, subscriber in (("redis", weight_publisher, weight_subscriber),
+                                             ("local", shared_publisher, shared_subscriber)):
+        publish_times, load_times = [], []
+        for _ in range(args.weight_updates):
+            with torch.no_grad():
+                for parameter in model.parameters():
+                    parameter.add_(0.001)
+
+            start_time = time.perf_counter()
+            publisher.publish(model.state_dict())
+            publish_times.append(time.perf_counter() - start_time)
+
+            start_time = time.perf_counter()
+            subscriber.update(worker_model)
+            load_times.append(time.perf_counter() - start_time)
+
+        matches = all(torch.equal(a, b) for a, b in zip(model.state_dict().values(),
+                                                        worker_model.state_dict().values()))
+        print(f"{transport:>10} {np.mean(publish_times) * 1000:11.2f} {np.mean(load_times) * 1000:8.2f}"
+              f"{'' if matches else '  weights DIFFER'}")
+
+    shared_subscriber.close()
+    shared_publisher.close()
+
+    if server is not None:
+        server.terminate()
+
+
+def benchmark_priorities(args):
+    alpha, beta = 0.6, 0.4
+
+    print(f"{'capacity':>9} {'array sample':>13} {'array update':>13} {'tree sample':>12} {'tree update':>12}")
+
+    for capacity in args.capacities:
+        priorities = np.random.uniform(1e-5, 2.0, capacity)
+        new_priorities = np.random.uniform(1e-5, 2.0, (args.batches, args.batch_size))
+
+        # The previous approach: normalize every priority and draw from the full distribution
+        start_time = time.perf_counter()
+        for _ in range(args.batches):
+            scaled = priorities ** alpha
+            probabilities = scaled / scaled.sum()
+            indices = np.random.choice(capacity, args.batch_size, replace=True, p=probabilities)
+            weights = (capacity * probabilities[indices]) ** (-beta)
+            weights /= weights.max()
+        array_sample = 1000 * (time.perf_counter() - start_time) / args.batches
+
+        start_time = time.perf_counter()
+        for batch in range(args.batches):
+            for index, priority in zip(indices, new_priorities[batch]):
+                priorities[index] = priority
+        array_update = 1000 * (time.perf_counter() - start_time) / args.batches
+
+        tree = SumTree(capacity)
+        tree.update(np.arange(capacity), priorities ** alpha)
+
+        start_time = time.perf_counter()
+        for _ in range(args.batches):
+            indices = tree.sample(args.batch_size)
+            weights = (capacity * tree[indices] / tree.total) ** (-beta)
+            weights /= weights.max()
+        tree_sample = 1000 * (time.perf_counter() - start_time) / args.batches
+
+        start_time = time.perf_counter()
+        for batch in range(args.batches):
+            tree.update(indices, new_priorities[batch] ** alpha)
+        tree_update = 1000 * (time.perf_counter() - start_time) / args.batches
+
+        print(f"{capacity:9d} {array_sample:10.3f} ms {array_update:10.3f} ms "
+              f"{tree_sample:9.3f} ms {tree_update:9.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=0)
+
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    fused_parser = subparsers.add_parser("fused", help="Compare fused and separate forward passes in Agent.learn")
+    fused_parser.add_argument("--steps", type=int, default=50)
+    fused_parser.add_argument("--warmup", type=int, default=3)
+    fused_parser.add_argument("--transitions", type=int, default=5000)
+    fused_parser.add_argument("--tolerance", type=float, default=1e-4)
+    fused_parser.set_defaults(func=benchmark_fused)
+
+    precision_parser = subparsers.add_parser("precision", help="Compare fp32 and bfloat16 autocast training")
+    precision_parser.add_argument("--steps", type=int, default=200)
+    precision_parser.add_argument("--warmup", type=int, default=3)
+    precision_parser.add_argument("--transitions", type=int, default=5000)
+    precision_parser.add_argument("--windows", type=int, default=10)
+    precision_parser.add_argument("--fused-learn", action="store_true", default=False)
+    precision_parser.set_defaults(func=benchmark_precision)
+
+    target_parser = subparsers.add_parser("target-update", help="Time target network updates as the model grows")
+    target_parser.add_argument("--sizes", type=int, nargs="+", default=[64, 128, 256, 512, 1024])
+    target_parser.add_argument("--repeats", type=int, default=100)
+    target_parser.add_argument("--tau", type=float, default=0.005)
+    target_parser.set_defaults(func=benchmark_target_update)
+
+    data_parallel_parser = subparsers.add_parser("data-parallel", help="Scaling of data-parallel learner processes")
+    data_parallel_parser.add_argument("--learners", type=int, nargs="+", default=[1, 2, 4])
+    data_parallel_parser.add_argument("--threads", type=int, default=1, help="Intra-op threads per learner")
+    data_parallel_parser.add_argument("--steps", type=int, default=20)
+    data_parallel_parser.add_argument("--warmup", type=int, default=3)
+    data_parallel_parser.add_argument("--transitions", type=int, default=2000)
+    data_parallel_parser.add_argument("--master-port", type=int, default=29500)
+    data_parallel_parser.add_argument("--fused-learn", action="store_true", default=False)
+    data_parallel_parser.set_defaults(func=benchmark_data_parallel)
+
+    weights_parser = subparsers.add_parser("weights", help="Bytes and fetch latency of weight updates to workers")
+    weights_parser.add_argument("--updates", type=int, default=5)
+    weights_parser.add_argument("--interval", type=int, default=20, help="Learn steps between weight updates")
+    weights_parser.add_argument("--transitions", type=int, default=2000)
+    weights_parser.add_argument("--full-precision", action="store_true", default=False)
+    weights_parser.add_argument("--compression-level", type=int, default=1)
+    weights_parser.add_argument("--redis-url", type=str, default=None,
+                                help="Publish through this Redis to also measure fetch latency")
+    weights_parser.set_defaults(func=benchmark_weights)
+
+    replay_parser = subparsers.add_parser("replay", help="Replay buffer ingest and sample throughput")
+    replay_parser.add_argument("--capacities", type=int, nargs="+", default=[100000, 250000, 1000000])
+    replay_parser.add_argument("--ingest", type=int, default=20000, help="Transitions added for the ingest rate")
+    replay_parser.add_argument("--batches", type=int, default=50)
+    replay_parser.add_argument("--replay", type=str, default="prioritized", choices=["prioritized", "sequence"])
+    replay_parser.add_argument("--burn-in", type=int, default=8)
+    replay_parser.add_argument("--deduplicate-frames", action="store_true", default=False)
+    replay_parser.add_argument("--path", type=str, default=None, help="Directory for memory-mapped buffers")
+    replay_parser.set_defaults(func=benchmark_replay)
+
+    ingestion_parser = subparsers.add_parser("ingestion", help="Concurrent ingest and sampling, direct or staged")
+    ingestion_parser.add_argument("--capacity", type=int, default=100000)
+    ingestion_parser.add_argument("--ingest", type=int, default=20000)
+    ingestion_parser.add_argument("--rate", type=float, default=5000, help="Transitions/sec offered, 0 for unlimited")
+    ingestion_parser.set_defaults(func=benchmark_ingestion)
+
+    prefetch_parser = subparsers.add_parser("prefetch", help="Learner throughput with batches sampled ahead")
+    prefetch_parser.add_argument("--depths", type=int, nargs="+", default=[0, 1, 2, 4],
+                                 help="Batches sampled ahead, 0 samples on the learner thread")
+    prefetch_parser.add_argument("--transitions", type=int, default=20000)
+    prefetch_parser.add_argument("--steps", type=int, default=50)
+    prefetch_parser.add_argument("--warmup", type=int, default=3)
+    prefetch_parser.add_argument("--replay", type=str, default="prioritized", choices=["prioritized", "sequence"])
+    prefetch_parser.set_defaults(func=benchmark_prefetch)
+
+    quantization_parser = subparsers.add_parser("quantization", help="Memory, sample rate and error of stored types")
+    quantization_parser.add_argument("--capacity", type=int, default=50000)
+    quantization_parser.add_argument("--batches", type=int, default=50)
+    quantization_parser.add_argument("--dtypes", type=str, nargs="+", default=["float32", "float16", "int16", "uint8"])
+    quantization_parser.add_argument("--deduplicate-frames", action="store_true", default=False)
+    quantization_parser.set_defaults(func=benchmark_quantization)
+
+    shared_parser = subparsers.add_parser("shared-replay", help="One writer and several sampling processes")
+    shared_parser.add_argument("--consumers", type=int, nargs="+", default=[1, 2, 4])
+    shared_parser.add_argument("--capacity", type=int, default=50000)
+    shared_parser.add_argument("--duration", type=float, default=5.0)
+    shared_parser.add_argument("--attach-time", type=float, default=10.0, help="Seconds given to consumers to start")
+    shared_parser.add_argument("--name", type=str, default="benchmark_replay")
+    shared_parser.set_defaults(func=benchmark_shared_replay)
+
+    publishing_parser = subparsers.add_parser("publishing", help="Transition publishing from workers, by batch size")
+    publishing_parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32, 128])
+    publishing_parser.add_argument("--transitions", type=int, default=5000)
+    publishing_parser.add_argument("--rate", type=float, default=1000, help="Transitions/sec produced, 0 for unlimited")
+    publishing_parser.add_argument("--max-delay", type=float, default=0.5)
+    publishing_parser.add_argument("--redis-url", type=str, default=None,
+                                   help="Redis to publish through, an in-process stand-in if not given")
+    publishing_parser.add_argument("--recurrent-interval", type=int, default=1)
+    publishing_parser.set_defaults(func=benchmark_publishing)
+
+    wire_parser = subparsers.add_parser("wire", help="Size and cost of the experience wire format against pickle")
+    wire_parser.add_argument("--transitions", type=int, default=4096)
+    wire_parser.add_argument("--message-size", type=int, default=32, help="Transitions per message")
+    wire_parser.add_argument("--recurrent-intervals", type=int, nargs="+", default=[1, sequence_length, 0])
+    wire_parser.set_defaults(func=benchmark_wire)
+
+    transport_parser = subparsers.add_parser("transport", help="Experience stream with a slow and crashing consumer")
+    transport_parser.add_argument("--workers", type=int, default=4)
+    transport_parser.add_argument("--transitions", type=int, default=2000, help="Per worker")
+    transport_parser.add_argument("--message-size", type=int, default=8, help="Transitions per message")
+    transport_parser.add_argument("--max-length", type=int, default=400)
+    transport_parser.add_argument("--max-backlog", type=int, default=100)
+    transport_parser.add_argument("--consume-delay", type=float, default=0.002, help="Seconds spent per message")
+    transport_parser.add_argument("--redis-url", type=str, default=None,
+                                  help="Redis to publish through, an in-process stand-in if not given")
+    transport_parser.set_defaults(func=benchmark_transport)
+
+    decoders_parser = subparsers.add_parser("decoders", help="Experience decoding on a thread against in processes")
+    decoders_parser.add_argument("--decoders", type=int, nargs="+", default=[0, 1, 2, 4], help="0 decodes on a thread")
+    decoders_parser.add_argument("--workers", type=int, default=8)
+    decoders_parser.add_argument("--transitions", type=int, default=2000, help="Per worker")
+    decoders_parser.add_argument("--message-size", type=int, default=32, help="Transitions per message")
+    decoders_parser.add_argument("--redis-url", type=str, default=None,
+                                 help="Redis to read experience from, an in-process stand-in if not given")
+    decoders_parser.set_defaults(func=benchmark_decoders)
+
+    local_parser = subparsers.add_parser("local-transport", help="Experience and weights through Redis against shared "
+                                                                 "memory, single host only")
+    local_parser.add_argument("--workers", type=int, default=4)
+    local_parser.add_argument("--transitions", type=int, default=5000, help="Per worker")
+    local_parser.add_argument("--message-size", type=int, default=32, help="Transitions per message")
+    local_parser.add_argument("--weight-updates", type=int, default=20)
+    local_parser.add_argument("--redis-url", type=str, default=None,
+                              help="Redis to compare against, a stand-in server on --port if not given")
+    local_parser.add_argument("--port", type=int, default=6392)
+    local_parser.set_defaults(func=benchmark_local_transport)
+
+    priorities_parser = subparsers.add_parser("priorities", help="Prioritized sampling and update cost per batch")
+    priorities_parser.add_argument("--capacities", type=int, nargs="+", default=[100000, 1000000, 10000000])
+    priorities_parser.add_argument("--batches", type=int, default=20)
+    priorities_parser.set_defaults(func=benchmark_priorities)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 from Agent import Agent
-from ReplayBuffer import EpisodeReplayBuffer
+from ReplayBuffer import EpisodeReplayBuffer, StagingBuffer
+from Experience import IngestionStats, ExperienceDecoder, ExperienceStream, consume_stream, remove_stale_groups
+from Ingestion import start_decoders, collect_decoded, fan_out
 
 from redis import Redis, ConnectionPool
 from redis import from_url as redis_from_url
@@ -17,59 +19,86 @@ import sys
 from threading import Thread, Lock
 
 from learn import update_graph_html
+from Topology import parse_cpu_list, configure_torch_threads, pin_current_thread, autotune_threads
+from WeightChannel import WeightPublisher
+from ControlChannel import ConfigPublisher
+from Metrics import EpisodeMetrics, FleetTelemetry
+from LocalTransport import TransitionRing, LaneReader, SharedWeightPublisher
+from Distributed import init_distributed, broadcast_training_state, all_ranks_ready, shard_for
+
+
+def ingest_transitions(replay_buffer, staging: StagingBuffer, ingestion_stats: IngestionStats, worker_name, batch,
+                       timestamps):
+    # With a staging buffer the learner commits transitions in bulk, the listener never takes the replay buffer's lock
+    if staging is not None:
+        staging.stage_batch(*batch, worker_id=worker_name, created=timestamps)
+    else:
+        replay_buffer.add_batch(*batch, [worker_name] * len(batch[1]))
+        ingestion_stats.visible(timestamps)
 
 
-def listen_for_messages(redis: Redis, replay_buffer: EpisodeReplayBuffer):
-    # Subscribe to the "replay_buffer" channel
-    pubsub = redis.pubsub()
-    pubsub.subscribe("replay_buffer")
+def ingest_message(decoder: ExperienceDecoder, replay_buffer, shard, staging, ingestion_stats, data):
+    worker_name, batch, timestamps = decoder.decode(data)
 
-    # Start listening for messages
-    try:
-        i = 0
-        while True:
-            i += 1
+    # With several learner ranks, each keeps only the transitions of the workers in its shard
+    if shard is not None and shard_for(worker_name, shard[1]) != shard[0]:
+        return
+
+    # Workers publish batches of transitions, a whole batch is added at once
+    ingestion_stats.received(len(batch[1]), len(data))
+    ingest_transitions(replay_buffer, staging, ingestion_stats, worker_name, batch, timestamps)
+
+
+def listen_for_messages(stream: ExperienceStream, replay_buffer: EpisodeReplayBuffer, shard=None,
+                        staging: StagingBuffer = None, ingestion_stats: IngestionStats = None):
+    # Rebuilds each worker's windows from the observations it sends
+    decoder = ExperienceDecoder()
+
+    # Messages are only acknowledged once they're in the replay buffer, or staged for it
+    consume_stream(stream, lambda data: ingest_message(decoder, replay_buffer, shard, staging, ingestion_stats, data))
+
+
+def run_listener(stream: ExperienceStream, replay_buffer: EpisodeReplayBuffer, cpus=None, shard=None, staging=None,
+                 ingestion_stats=None):
+    pin_current_thread(cpus, "listener")
+
+    listen_for_messages(stream, replay_buffer, shard, staging, ingestion_stats)
 
-            messages = []
-            while True:
-                message = pubsub.get_message(ignore_subscribe_messages=True)
 
-                if message is None:
-                    break
+def run_collector(rings, replay_buffer: EpisodeReplayBuffer, cpus=None, staging=None, ingestion_stats=None):
+    pin_current_thread(cpus, "collector")
 
-                messages.append(message)
+    collect_decoded(rings, replay_buffer, staging, ingestion_stats, ingest_transitions)
 
-                if len(messages) > 1000:
-                    print("Flushing messages")
 
-                    while pubsub.get_message(ignore_subscribe_messages=True) is not None:
-                        pass
+def autotune_learner_threads(agent: Agent, candidates):
+    # Tune on a scratch agent with synthetic data so the real model and replay buffer are left untouched
+    scratch = Agent(gamma=agent.gamma, epsilon=agent.epsilon, batch_size=agent.batch_size,
+                    n_actions=len(agent.action_space), input_dims=agent.input_dims, lr=agent.lr,
+                    max_mem_size=agent.batch_size * 8, sequence_length=agent.sequence_length,
+                    fused_learn=agent.fused_learn, mixed_precision=agent.Q_eval.mixed_precision,
+                    target_tau=agent.target_tau, replay=agent.replay, burn_in=agent.burn_in,
+                    deduplicate_frames=agent.deduplicate_frames)
+    scratch.fill_synthetic(agent.batch_size * 8)
 
-                    break
+    best, _ = autotune_threads(scratch.learn, candidates)
 
-            for message in messages:
-                if message["type"] == "message":
-                    # Convert the message to states from bytes
-                    data = message["data"]
-                    data = pickle.loads(data)
-                    transition = data.transition
+    return best
 
-                    replay_buffer.add(
-                        transition.state,
-                        transition.action,
-                        transition.reward,
-                        transition.next_state,
-                        transition.done,
-                        transition.hidden_state,
-                        transition.cell_state,
-                    )
 
-    except Exception as e:
-        print(e)
+def experience_group(name, rank, world_size):
+    return f"{name}-rank{rank}" if world_size > 1 else name
 
-    # Restart ourselves if we get here
-    print("Restarting listener...")
-    listen_for_messages(redis, replay_buffer)
+
+def publish_configuration(config_publisher: ConfigPublisher, agent: Agent, model_version, args):
+    # Workers get everything they run with in one snapshot, pushed to them
+    recurrent_interval, recurrent_phase = agent.replay_buffer.recurrent_schedule() \
+        if args.sparse_recurrent_states else (1, 0)
+
+    config_publisher.publish(epsilon=agent.epsilon, min_epsilon=agent.eps_min, model_version=model_version,
+                             levels=args.levels, episodes_per_level=args.episodes_per_level,
+                             recurrent_interval=recurrent_interval, recurrent_phase=recurrent_phase,
+                             frame_by_frame=agent.frame_by_frame)
 
 
 def save_model(agent: Agent, model_path: str):
@@ -103,9 +132,124 @@ def start():
     args.add_argument("--model", type=str, default=None)
     args.add_argument("--wandb", type=bool, default=False if "pydevd" in sys.modules else True)
     args.add_argument("--commit", type=bool, default=False if "pydevd" in sys.modules else True)
-    args = args.parse_args()
+    args.add_argument("--fused-learn", action="store_true", default=False)
+    args.add_argument("--mixed-precision", action="store_true", default=False,
+                      help="Train with bfloat16 autocast, keeping fp32 weights and losses")
+    args.add_argument("--target-tau", type=float, default=None,
+                      help="Soft-update the target network by this factor every step instead of hard copies")
+    args.add_argument("--torch-threads", type=int, default=None, help="Intra-op threads for the learner")
+    args.add_argument("--torch-interop-threads", type=int, default=None)
+    args.add_argument("--learner-cpus", type=str, default=None, help="CPU list for the learner, e.g. 0-5")
+    args.add_argument("--listener-cpus", type=str, default=None, help="CPU list for the listener, e.g. 6")
+    args.add_argument("--decoders", type=int, default=0,
+                      help="Processes that decode experience for the learner, 0 decodes on the listener thread")
+    args.add_argument("--decoder-cpus", type=str, default=None, help="CPU list for the decoder processes, e.g. 4-5")
+    args.add_argument("--autotune-threads", action="store_true", default=False,
+                      help="Measure learn-steps/sec for several intra-op thread counts at startup and keep the best")
+    args.add_argument("--autotune-candidates", type=str, default=None, help="Thread counts to try, e.g. 1,2,4,8")
+    args.add_argument("--full-precision-weights", action="store_true", default=False,
+                      help="Publish fp32 weights to workers instead of fp16")
+    args.add_argument("--replay", type=str, default="prioritized", choices=["prioritized", "sequence"],
+                      help="Per-transition prioritized replay, or sequence replay with burn-in")
+    args.add_argument("--burn-in", type=int, default=8, help="Burn-in frames for sequence replay")
+    args.add_argument("--sparse-recurrent-states", action="store_true",
+                      help="Workers only send the recurrent states sequence replay keeps as snapshots")
+    args.add_argument("--deduplicate-frames", action="store_true", default=False,
+                      help="Store each observation once and rebuild state windows when sampling")
+    args.add_argument("--replay-path", type=str, default=None,
+                      help="Directory for a memory-mapped prioritized replay buffer that is kept across restarts")
+    args.add_argument("--observation-dtype", type=str, default="float32",
+                      choices=["float32", "float16", "uint8", "int16"],
+                      help="Storage type of observations in prioritized replay, integer types are quantized")
+    args.add_argument("--replay-capacity", type=int, default=100000, help="Transitions kept in the replay buffer")
+    args.add_argument("--shared-replay", type=str, default=None,
+                      help="Keep the replay buffer in shared memory under this name, for replay_consumer.py and "
+                           "learners started with --attach-replay")
+    args.add_argument("--attach-replay", action="store_true", default=False,
+                      help="Learn from the --shared-replay buffer another node fills instead of listening to workers")
+    args.add_argument("--attached-publish", action="store_true", default=False,
+                      help="With --attach-replay, publish weights and configuration to workers and store checkpoints "
+                           "in place of the node that fills the buffer")
+    args.add_argument("--staged-ingestion", action="store_true", default=False,
+                      help="Stage incoming transitions and commit them to the replay buffer in bulk between learn steps")
+    args.add_argument("--prefetch-batches", type=int, default=0,
+                      help="Batches sampled ahead on a background thread, 0 samples on the learner thread")
+    args.add_argument("--pin-memory", action="store_true", default=False,
+                      help="Prefetch batches into pinned memory and copy them to the GPU asynchronously")
+    args.add_argument("--experience-group", type=str, default="learner",
+                      help="Consumer group the node reads experience in, keep it the same across restarts to resume")
+    args.add_argument("--local-transport", type=str, default=None,
+                      help="Name of the shared memory workers on this machine use instead of Redis for experience "
+                           "and weights")
+    args.add_argument("--local-lanes", type=int, default=32, help="Workers the local transport has room for")
+    args.add_argument("--straggler-ratio", type=float, default=0.5,
+                      help="Workers stepping slower than this fraction of the fleet's median are reported")
+    args.add_argument("--levels", type=int, nargs="+", default=None,
+                      help="Levels workers cycle through, all of the environment's if not given")
+    args.add_argument("--episodes-per-level", type=int, default=5, help="Episodes workers play before changing level")
+    args.add_argument("--learners", type=int, default=1, help="Data-parallel learner processes on this machine")
+    args.add_argument("--world-size", type=int, default=None,
+                      help="Learner processes across all machines, defaults to --learners")
+    args.add_argument("--rank-offset", type=int, default=0, help="Rank of the first learner on this machine")
+    args.add_argument("--master-addr", type=str, default="localhost")
+    args.add_argument("--master-port", type=int, default=29500)
+    parser = args
+    args = parser.parse_args()
+
+    if args.episodes_per_level < 1:
+        parser.error("--episodes-per-level must be at least 1")
+
+    if args.sparse_recurrent_states and args.replay != "sequence":
+        parser.error("--sparse-recurrent-states is only supported with --replay sequence")
+
+    if args.replay_path is not None and args.replay != "prioritized":
+        parser.error("--replay-path is only supported with --replay prioritized")
+
+    if args.observation_dtype != "float32" and args.replay != "prioritized":
+        parser.error("--observation-dtype is only supported with --replay prioritized")
+
+    if args.shared_replay is not None and (args.replay != "prioritized" or args.replay_path is not None):
+        parser.error("--shared-replay is only supported with --replay prioritized and without --replay-path")
+
+    if args.attach_replay and args.shared_replay is None:
+        parser.error("--attach-replay needs the --shared-replay name to attach to")
+
+    if args.attached_publish and not args.attach_replay:
+        parser.error("--attached-publish is only for learners started with --attach-replay")
+
+    args.world_size = args.world_size or args.learners
+
+    if args.local_transport is not None and (args.world_size > 1 or args.attach_replay):
+        parser.error("--local-transport is only supported with a single learner that ingests experience")
+
+    if args.world_size > 1:
+        torch.multiprocessing.spawn(train, args=(args,), nprocs=args.learners)
+    else:
+        train(0, args)
+
+
+def train(local_rank, args):
+    rank = args.rank_offset + local_rank
+    world_size = args.world_size
+    is_main = rank == 0
+
+    # A learner attached to another node's replay buffer leaves workers' weights, their configuration and the
+    # checkpoints to that node, unless it's told to take them over
+    publishes = is_main and (not args.attach_replay or args.attached_publish)
+    commit = args.commit and publishes
+
+    learner_cpus = parse_cpu_list(args.learner_cpus)
+    listener_cpus = parse_cpu_list(args.listener_cpus)
+
+    # Local learners split the learner CPUs between them
+    if learner_cpus and args.learners > 1:
+        share = max(1, len(learner_cpus) // args.learners)
+        learner_cpus = learner_cpus[local_rank * share:(local_rank + 1) * share] or learner_cpus
 
-    commit = args.commit
+    # The learner is this thread, pin it before torch starts its thread pool so the pool inherits the mask
+    pin_current_thread(learner_cpus, f"learner {rank}")
+    configure_torch_threads(args.torch_threads or (len(learner_cpus) if learner_cpus else None),
+                            args.torch_interop_threads)
 
     # Hyperparameters
     learning_rate = 2.0e-6
@@ -113,21 +257,41 @@ def start():
     batch_size = 256
     train_frequency = 4
     target_update_frequency = 10000  # How often we update the target network
+    weights_update_frequency = 200  # How often workers are sent new weights
+    checkpoint_frequency = 2000  # How often the full model and optimizer are stored in Redis for restarts
     sequence_length = 8
 
+    # Every rank keeps its own shard of the experience, so each gets its own directory or shared memory
+    replay_path = args.replay_path
+    if replay_path is not None and world_size > 1:
+        replay_path = os.path.join(replay_path, f"rank{rank}")
+
+    shared_replay = args.shared_replay
+    if shared_replay is not None and world_size > 1:
+        shared_replay = f"{shared_replay}_rank{rank}"
+
     redis = redis_from_url(f"redis://{args.redis_host}:{args.redis_port}")
 
+    weight_publisher = WeightPublisher(redis, half_precision=not args.full_precision_weights) \
+        if publishes and args.local_transport is None else None
+    config_publisher = ConfigPublisher(redis) if publishes else None
+
     # Create an agent
     agent = Agent(gamma=0.99, epsilon=1.0, batch_size=batch_size, n_actions=16, eps_end=0.005,
-                  input_dims=features, lr=learning_rate, sequence_length=sequence_length)
+                  input_dims=features, lr=learning_rate, sequence_length=sequence_length,
+                  fused_learn=args.fused_learn, mixed_precision=args.mixed_precision, target_tau=args.target_tau,
+                  distributed=world_size > 1, replay=args.replay, burn_in=args.burn_in,
+                  deduplicate_frames=args.deduplicate_frames, max_mem_size=args.replay_capacity,
+                  replay_path=replay_path, observation_dtype=args.observation_dtype, shared_replay=shared_replay,
+                  attach_replay=args.attach_replay)
 
     # Load existing model if load_model is set
-    if args.model:
+    if args.model and is_main:
         load_model(agent, args.model)
         agent.update_target_network()
         print("Loaded model from file")
 
-    existing_model = redis.get("model") if args.model is None else None
+    existing_model = redis.get("model") if args.model is None and is_main else None
     if existing_model is not None:
         agent.epsilon = float(redis.get("epsilon"))
         agent.Q_eval.load_state_dict(pickle.loads(existing_model))
@@ -143,7 +307,21 @@ def start():
 
         print("Loaded existing model from Redis")
 
-    if args.wandb:
+    if args.autotune_threads:
+        if args.autotune_candidates:
+            candidates = [int(threads) for threads in args.autotune_candidates.split(",")]
+        else:
+            max_threads = len(learner_cpus) if learner_cpus else os.cpu_count()
+            candidates = sorted({min(2 ** i, max_threads) for i in range(max_threads.bit_length())} | {max_threads})
+
+        autotune_learner_threads(agent, candidates)
+
+    # Every rank starts from rank 0's model, and only rank 0 talks to workers, saves and logs
+    if world_size > 1:
+        init_distributed(rank, world_size, args.master_addr, args.master_port)
+        broadcast_training_state(agent)
+
+    if args.wandb and is_main:
         current_run_id = redis.get("wandb_run_id")
         current_run_id = current_run_id.decode() if current_run_id is not None else None
 
@@ -154,14 +332,76 @@ def start():
             "features": features,
             "train_frequency": train_frequency,
             "target_update_frequency": target_update_frequency,
+            "target_tau": args.target_tau,
+            "fused_learn": args.fused_learn,
+            "mixed_precision": args.mixed_precision,
+            "torch_threads": torch.get_num_threads(),
+            "learners": world_size,
+            "replay": args.replay,
+            "burn_in": args.burn_in,
+            "deduplicate_frames": args.deduplicate_frames,
+            "observation_dtype": args.observation_dtype,
         }, resume="must" if current_run_id is not None else None)
 
         update_graph_html(wandb.run.get_url())
 
-    # Start listening for messages on a separate thread
-    thread = Thread(target=listen_for_messages, args=(redis, agent.replay_buffer))
-    thread.daemon = True
-    thread.start()
+    # Workers on this machine send experience and get weights through shared memory. The control plane and metrics
+    # still go through Redis, they're only a few small messages per episode
+    local_ring = None
+    if args.local_transport is not None:
+        local_ring = TransitionRing(args.local_transport, lanes=args.local_lanes)
+        weight_publisher = SharedWeightPublisher(f"{args.local_transport}_weights", agent.Q_eval.state_dict())
+        weight_publisher.publish(agent.Q_eval.state_dict())
+
+    # Rolling statistics of the episodes workers report, and the latest heartbeat of every worker
+    episode_metrics = EpisodeMetrics(redis)
+    fleet = FleetTelemetry(redis, straggler_ratio=args.straggler_ratio)
+    stragglers = {}
+
+    # Workers that are already running switch to this node's epsilon and levels right away
+    if publishes:
+        publish_configuration(config_publisher, agent, weight_publisher.version, args)
+
+    if args.prefetch_batches > 0:
+        agent.start_prefetching(args.prefetch_batches, pin_memory=args.pin_memory)
+
+    # Start listening for messages on a separate thread, each rank keeps the transitions of its own workers. A learner
+    # attached to another node's shared replay buffer only samples from it
+    shard = (rank, world_size) if world_size > 1 else None
+    ingestion_stats = IngestionStats()
+    staging = StagingBuffer(ingestion_stats) if args.staged_ingestion and not args.attach_replay else None
+    if not args.attach_replay:
+        # Every rank reads the whole stream in its own consumer group. Restarting under the same consumer name picks
+        # up whatever it hadn't processed yet
+        group = experience_group(args.experience_group, rank, world_size)
+        consumer = f"node-rank{rank}"
+
+        # Groups of earlier runs under other names or rank counts would hold workers back, no node reads them anymore
+        if is_main:
+            groups = {experience_group(args.experience_group, other, world_size) for other in range(world_size)}
+            for stale_group in remove_stale_groups(redis, "replay_buffer", groups):
+                print(f"Removed consumer group {stale_group} of an earlier run from the experience stream")
+
+        if args.decoders > 0:
+            # Decoding happens in separate processes, this thread only copies finished batches into the replay buffer.
+            # The stream is still read once, by another thread that hands each message to its worker's decoder
+            rings, _, input_ring = start_decoders(args.decoders, sequence_length, features,
+                                                  (agent.Q_eval.num_layers, agent.Q_eval.lstm_units),
+                                                  cpus=parse_cpu_list(args.decoder_cpus),
+                                                  local_transport=args.local_transport)
+            if input_ring is not None:
+                Thread(target=fan_out, args=(ExperienceStream(redis, group=group, consumer=consumer), input_ring,
+                                             shard), daemon=True).start()
+
+            thread = Thread(target=run_collector, args=(rings, agent.replay_buffer, listener_cpus, staging,
+                                                        ingestion_stats))
+        else:
+            stream = LaneReader(local_ring) if local_ring is not None else \
+                ExperienceStream(redis, group=group, consumer=consumer)
+            thread = Thread(target=run_listener, args=(stream, agent.replay_buffer, listener_cpus, shard, staging,
+                                                       ingestion_stats))
+        thread.daemon = True
+        thread.start()
 
     losses = []
 
@@ -170,10 +410,20 @@ def start():
     # For calculating samples per second
     last_time = time.time()
     last_samples = 0
+    last_steps = 0
     samples_history = []
+    learned_history = []
 
     while True:
-        if agent.replay_buffer.total <= 64:
+        # Staged transitions enter the replay buffer here, between learn steps
+        if staging is not None:
+            staging.commit(agent.replay_buffer)
+
+        ready = agent.can_learn()
+        if world_size > 1:
+            ready = all_ranks_ready(ready)
+
+        if not ready:
             time.sleep(0.1)
             continue
 
@@ -187,35 +437,93 @@ def start():
         # Calculate samples per second
         if time.time() - last_time > 1:
             samples_per_second = last_samples / (time.time() - last_time)
+            learned_per_second = (steps - last_steps) * batch_size * world_size / (time.time() - last_time)
             last_time = time.time()
             last_samples = 0
+            last_steps = steps
 
             samples_history.append(samples_per_second)
             samples_history = samples_history[-10:]
+            learned_history.append(learned_per_second)
+            learned_history = learned_history[-10:]
 
-        # Update target network used for calculating the target Q values
-        if steps % target_update_frequency == 0:
+        # Update target network used for calculating the target Q values, soft updates happen in learn()
+        if agent.target_tau is None and steps % target_update_frequency == 0:
             agent.update_target_network()
 
+        # Persist the replay buffer's ring position as often as the model, so a restart resumes both together
+        if replay_path is not None and steps % checkpoint_frequency == 0:
+            agent.replay_buffer.flush()
+
         # Updating model in Redis, log stuff for debub, make backups
-        if steps % 200 == 0:
+        if steps % weights_update_frequency == 0 and is_main:
             if commit:
+                weight_publisher.publish(agent.Q_eval.state_dict())
+                redis.set("epsilon", agent.epsilon)
+
+                publish_configuration(config_publisher, agent, weight_publisher.version, args)
+
+            # The full model and optimizer are only needed to resume the node, workers get the weights above
+            if commit and steps % checkpoint_frequency == 0:
                 model = pickle.dumps(agent.Q_eval.state_dict())
                 optimizer = pickle.dumps(agent.Q_eval.optimizer.state_dict())
 
                 redis.set("model", model)
                 redis.set("optimizer", optimizer)
-                redis.set("model_timestamp", time.time())
 
-                redis.set("epsilon", agent.epsilon)
-
-            # Get the last 100 scores from Redis key "avg_scores" and cast them to floats
-            scores = redis.lrange("avg_scores", -100, -1)
-            scores = [float(score) for score in scores]
+            # Only the episodes reported since the last update are read, the statistics are kept rolling
+            episode_metrics.update()
+            scores = episode_metrics.episodes.summary()
 
             if len(losses) > 0:
-                print('avg loss: %.2f' % np.mean(losses[-100:]), 'avg_score: %.2f' % np.mean(scores),
-                      'epsilon: %.2f' % agent.epsilon, 'samples/sec: %.2f' % np.mean(samples_history))
+                print('avg loss: %.2f' % np.mean(losses[-100:]), 'avg_score: %.2f' % scores["mean"],
+                      'score p10/p50/p90: %.2f/%.2f/%.2f' % (scores["p10"], scores["p50"], scores["p90"]),
+                      'workers: %d' % len(episode_metrics.workers),
+                      'epsilon: %.2f' % agent.epsilon, 'samples/sec: %.2f' % np.mean(samples_history),
+                      'learned samples/sec: %.2f' % np.mean(learned_history))
+
+            # Stragglers are printed when they start and stop straggling, the fleet is stored for queries
+            fleet.update()
+            fleet_summary = fleet.summary()
+            print('fleet: %d workers, %.1f steps/sec, %.1f ms frame wait/step, %.1f ms step p99, %d restarts, '
+                  '%d stragglers' % (fleet_summary["workers"], fleet_summary["steps_per_second"],
+                                     fleet_summary["frame_wait_ms"], fleet_summary["step_p99_ms"],
+                                     fleet_summary["restarts"], fleet_summary["stragglers"]))
+
+            current_stragglers = fleet.stragglers()
+            for worker_name, reasons in current_stragglers.items():
+                if worker_name not in stragglers:
+                    print(f"Straggler {worker_name}: {', '.join(reasons)}")
+            for worker_name in stragglers.keys() - current_stragglers.keys():
+                print(f"{worker_name} caught up")
+            stragglers = current_stragglers
+
+            fleet.publish()
+
+            ingestion = ingestion_stats.report()
+            if not args.attach_replay:
+                print('ingestion: %.1f messages/sec, %.1f transitions/sec, %.1f kB/sec (%.0f B/transition), '
+                      'latency to replay %.1f/%.1f ms mean/p99' % (
+                          ingestion["messages_per_second"], ingestion["transitions_per_second"],
+                          ingestion["bytes_per_second"] / 1024, ingestion["bytes_per_transition"],
+                          ingestion["latency_mean_ms"], ingestion["latency_p99_ms"]))
+
+            if staging is not None:
+                staging_stats = staging.stats()
+                print('staged: %d (peak %d), committed: %d in %d commits, %.2f ms/commit, %.1f us/transition' % (
+                    staging_stats["staged"], staging_stats["peak_staged"], staging_stats["committed"],
+                    staging_stats["commits"], staging_stats["commit_ms"], staging_stats["commit_us_per_transition"]))
+
+            if agent.prefetcher is not None:
+                prefetch_stats = agent.prefetcher.stats()
+                print('prefetch: %d queued, learner stalled %.2f ms/batch (%.1f%% of the time)' % (
+                    prefetch_stats["queued"], prefetch_stats["stall_ms"], 100 * prefetch_stats["stall_fraction"]))
+
+            if commit:
+                print('weights v%d: %d/%d tensors changed, %.1f kB sent (%.1f kB fp32)' % (
+                    weight_publisher.version, weight_publisher.last_changed,
+                    len(agent.Q_eval.state_dict()), weight_publisher.last_bytes / 1024,
+                    weight_publisher.last_raw_bytes / 1024))
 
             # Save the model every 10000 steps
             if commit and steps % 10000 == 0:
@@ -224,10 +532,19 @@ def start():
 
             if args.wandb:
                 wandb.log({
-                    "avg_score": np.mean(scores),
+                    "avg_score": scores["mean"],
+                    **{f"score_{key}": value for key, value in scores.items() if key != "mean"},
+                    **episode_metrics.episodes.component_means(),
                     "loss": np.mean(losses[-100:]),
                     "epsilon": agent.epsilon,
-                    "samples_per_second": np.mean(samples_history)
+                    "samples_per_second": np.mean(samples_history),
+                    "learned_samples_per_second": np.mean(learned_history),
+                    **({"weights_update_bytes": weight_publisher.last_bytes} if weight_publisher is not None else {}),
+                    **{f"ingestion_{key}": value for key, value in ingestion.items()},
+                    **{f"fleet_{key}": value for key, value in fleet_summary.items()},
+                    **({f"staging_{key}": value for key, value in staging_stats.items()} if staging is not None else {}),
+                    **({f"prefetch_{key}": value for key, value in prefetch_stats.items()}
+                       if agent.prefetcher is not None else {}),
                 })
 
         steps += 1
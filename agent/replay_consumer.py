@@ -0,0 +1,110 @@
+from Agent import Agent
+from WeightChannel import WeightSubscriber
+from LocalTransport import SharedWeightSubscriber
+
+from redis import from_url as redis_from_url
+
+import numpy as np
+
+import argparse
+import time
+
+
+features = 44
+sequence_length = 8
+
+
+def run_analytics(agent: Agent, interval: float):
+    """
+    Prints what's in the shared replay buffer every `interval` seconds, only reading it.
+    """
+    replay_buffer = agent.replay_buffer
+
+    last_total = replay_buffer.total
+    last_time = time.time()
+
+    while True:
+        time.sleep(interval)
+
+        total = replay_buffer.total
+        size = len(replay_buffer)
+        ingest_rate = (total - last_total) / (time.time() - last_time)
+        last_total, last_time = total, time.time()
+
+        priorities = replay_buffer.priorities[np.arange(size)]
+        rewards = replay_buffer.arrays["rewards"][:size]
+        dones = replay_buffer.arrays["dones"][:size]
+
+        print(f"size: {size}, ingested: {total} ({ingest_rate:.1f}/sec), "
+              f"priority mean/p99/max: {priorities.mean():.3f}/{np.percentile(priorities, 99):.3f}/"
+              f"{priorities.max():.3f}, reward mean: {rewards.mean():.3f}, episode ends: {int(dones.sum())}, "
+              f"torn sample retries: {replay_buffer.retries}")
+
+
+def run_refresher(agent: Agent, redis_url: str, batch_size: int, local_transport=None):
+    """
+    Walks the whole buffer in order and recomputes every transition's priority with the latest weights, so
+        transitions that haven't been sampled in a while don't keep priorities from a much older model. Weights come
+        through Redis, or from the shared memory of a node started with `local_transport`.
+    """
+    replay_buffer = agent.replay_buffer
+    if local_transport is not None:
+        subscriber = SharedWeightSubscriber(f"{local_transport}_weights")
+    else:
+        subscriber = WeightSubscriber(redis_from_url(redis_url))
+
+    cursor = 0
+    refreshed = 0
+    last_time = time.time()
+
+    while True:
+        if subscriber.update(agent.Q_eval):
+            agent.update_target_network()
+
+        size = len(replay_buffer)
+        if size == 0:
+            time.sleep(0.1)
+            continue
+
+        indices = (cursor + np.arange(min(batch_size, size))) % size
+        cursor = (cursor + len(indices)) % size
+
+        td_error = agent.td_errors(*replay_buffer.gather(indices))
+        replay_buffer.update_priorities(indices, td_error + 1e-5)
+
+        refreshed += len(indices)
+        if time.time() - last_time > 10:
+            print(f"Refreshed {refreshed / (time.time() - last_time):.1f} priorities/sec with weights "
+                  f"v{subscriber.version}")
+            refreshed, last_time = 0, time.time()
+
+
+def start():
+    args = argparse.ArgumentParser(description="Local process reading the node's shared replay buffer")
+    args.add_argument("mode", type=str, choices=["analytics", "refresh"])
+    args.add_argument("--shared-replay", type=str, required=True, help="Name the node was started with")
+    args.add_argument("--redis-host", type=str, default="localhost")
+    args.add_argument("--redis-port", type=int, default=6379)
+    args.add_argument("--interval", type=float, default=10.0, help="Seconds between analytics reports")
+    args.add_argument("--batch-size", type=int, default=256, help="Transitions refreshed at a time")
+    args.add_argument("--local-transport", type=str, default=None,
+                      help="Shared memory name the node was started with, to get weights from instead of Redis")
+    args = args.parse_args()
+
+    agent = Agent(gamma=0.99, epsilon=0.0, batch_size=args.batch_size, n_actions=16, input_dims=features, lr=0,
+                  sequence_length=sequence_length, shared_replay=args.shared_replay, attach_replay=True)
+
+    print(f"Attached to shared replay buffer {args.shared_replay} with {len(agent.replay_buffer)} transitions")
+
+    if args.mode == "analytics":
+        run_analytics(agent, args.interval)
+    else:
+        run_refresher(agent, f"redis://{args.redis_host}:{args.redis_port}", args.batch_size, args.local_transport)
+
+
+if __name__ == "__main__":
+    try:
+        start()
+    except KeyboardInterrupt:
+        print("Exiting...")
+        exit(0)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Modules in agent/ import each other by name, the way the scripts run them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,32 @@
+import pytest
+
+from ControlChannel import ConfigPublisher, ConfigSubscriber
+
+
+def validate(config):
+    if config["episodes_per_level"] < 1:
+        raise ValueError("episodes_per_level must be at least 1")
+
+
+def test_invalid_snapshots_are_not_applied():
+    fakeredis = pytest.importorskip("fakeredis")
+    redis = fakeredis.FakeRedis()
+
+    publisher = ConfigPublisher(redis)
+    subscriber = ConfigSubscriber(redis, defaults={"episodes_per_level": 5}, validate=validate)
+
+    publisher.publish(episodes_per_level=3)
+    assert subscriber.poll()
+    assert subscriber.config["episodes_per_level"] == 3
+
+    publisher.publish(episodes_per_level=0)
+    assert not subscriber.poll()
+    assert subscriber.config["episodes_per_level"] == 3 and subscriber.version == 1
+
+    # Snapshots after the rejected one still apply, and a subscriber that connects later skips the rejected one too
+    publisher.publish(episodes_per_level=0, epsilon=0.5)
+    assert ConfigSubscriber(redis, defaults={"episodes_per_level": 5}, validate=validate).version == 0
+
+    publisher.publish(episodes_per_level=2)
+    assert subscriber.poll()
+    assert subscriber.config == {"episodes_per_level": 2, "epsilon": 0.5, "version": 4}
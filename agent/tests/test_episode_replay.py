@@ -0,0 +1,42 @@
+import numpy as np
+import torch
+
+from ReplayBuffer import EpisodeReplayBuffer
+
+
+def add_episode(replay_buffer, length, value):
+    for step in range(length):
+        state = np.full(4, value + step, dtype=np.float32)
+        replay_buffer.add(state, step + 1, float(value), state + 1, step == length - 1, worker_id=value)
+
+
+def test_padded_episodes_keep_their_dtypes_and_pad_with_zeros():
+    replay_buffer = EpisodeReplayBuffer(100)
+    lengths = {value: value // 10 % 7 + 1 for value in range(10, 100, 10)}
+    for value, length in lengths.items():
+        add_episode(replay_buffer, length, value)
+
+    np.random.seed(0)
+    states, actions, rewards, next_states, dones, episode_lengths = replay_buffer.sample(8, padded=True)
+
+    assert states.dtype == next_states.dtype == rewards.dtype == torch.float32
+    assert actions.dtype == torch.int64
+    assert dones.dtype == torch.bool
+    assert states.shape[::2] == (8, 4) and states.shape[1] == dones.shape[1] == int(episode_lengths.max())
+
+    for episode in range(8):
+        length = int(episode_lengths[episode])
+        value = int(rewards[episode, 0])
+        assert lengths[value] == length
+
+        assert torch.equal(actions[episode, :length], torch.arange(1, length + 1))
+        assert torch.equal(states[episode, :length, 0], torch.arange(value, value + length, dtype=torch.float32))
+        assert torch.equal(dones[episode, :length], torch.arange(length) == length - 1)
+
+        # Padding after the end of the episode is zero, and never a terminal transition
+        for field in (states, actions, rewards, next_states, dones):
+            assert not field[episode, length:].any()
+
+    # Concatenated episodes keep them too
+    _, _, _, _, dones = replay_buffer.sample(2)
+    assert dones.dtype == torch.bool
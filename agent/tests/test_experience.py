@@ -0,0 +1,170 @@
+import numpy as np
+import pytest
+
+from Experience import ExperiencePublisher, ExperienceDecoder, StreamTransport, remove_stale_groups
+from ReplayBuffer import SequenceReplayBuffer, synthetic_transitions
+
+
+features = 44
+sequence_length = 8
+recurrent_shape = (3, 1, 16)
+
+
+class ListTransport:
+    """
+    Keeps sent messages instead of adding them to a stream.
+    """
+    def __init__(self):
+        self.messages = []
+
+    def send(self, data):
+        self.messages.append(data)
+        return 0
+
+    def backlog(self):
+        return 0
+
+
+def publish(transitions, max_transitions=32, **kwargs):
+    transport = ListTransport()
+    publisher = ExperiencePublisher(None, "worker", max_transitions=max_transitions, max_delay=float("inf"),
+                                    window=sequence_length, transport=transport, **kwargs)
+
+    episode_start = True
+    for state, action, reward, next_state, done, hidden_state, cell_state in transitions:
+        if episode_start:
+            publisher.start_episode(state[-1])
+
+        publisher.add(next_state[-1], action, reward, done, hidden_state, cell_state)
+        episode_start = done
+    publisher.flush()
+
+    return transport.messages
+
+
+def decode(messages):
+    decoder = ExperienceDecoder()
+    batches = [decoder.decode(message)[1] for message in messages]
+
+    return tuple(np.concatenate(column) for column in zip(*batches))
+
+
+@pytest.mark.parametrize("max_transitions", [1, 7, 32])
+def test_round_trip_is_exact(max_transitions):
+    transitions = list(synthetic_transitions(450, sequence_length, features, 16, recurrent_shape))
+    decoded = decode(publish(transitions, max_transitions=max_transitions))
+
+    states, actions, rewards, next_states, dones, hidden_states, cell_states = zip(*transitions)
+    assert np.array_equal(decoded[0], np.stack(states))
+    assert np.array_equal(decoded[1], np.array(actions))
+    assert np.array_equal(decoded[2], np.array(rewards, dtype=np.float32))
+    assert np.array_equal(decoded[3], np.stack(next_states))
+    assert np.array_equal(decoded[4], np.array(dones))
+    assert np.array_equal(decoded[5], np.stack([state.squeeze(1).numpy() for state in hidden_states]))
+    assert np.array_equal(decoded[6], np.stack([state.squeeze(1).numpy() for state in cell_states]))
+
+
+@pytest.mark.parametrize("burn_in, period", [(8, 8), (5, 3), (2, 6)])
+def test_sparse_recurrent_states_keep_sequence_snapshots(burn_in, period):
+    # Whole episodes, a sequence is only stored once it's complete
+    transitions = list(synthetic_transitions(400, sequence_length, features, 16, recurrent_shape))
+
+    replay_buffers = []
+    for sparse in (False, True):
+        replay_buffer = SequenceReplayBuffer(1000, sequence_length, burn_in=burn_in, period=period)
+        interval, phase = replay_buffer.recurrent_schedule() if sparse else (1, 0)
+
+        batch = decode(publish(transitions, recurrent_interval=interval, recurrent_phase=phase))
+        replay_buffer.add_batch(*batch, ["worker"] * len(batch[1]))
+        replay_buffers.append(replay_buffer)
+
+    dense, sparse = replay_buffers
+    assert len(dense) == len(sparse) == len(transitions)
+    for name, array in dense.arrays.items():
+        assert np.array_equal(array, sparse.arrays[name]), name
+
+    # Not all zero, the snapshots of sequences past the padding come from the messages
+    assert np.abs(sparse.arrays["hidden_states"]).sum() > 0
+
+
+def test_decodes_messages_with_float16_recurrent_states():
+    transitions = list(synthetic_transitions(20, sequence_length, features, 16, recurrent_shape))
+    message = bytearray(publish(transitions)[0])
+
+    # Version 1 messages carry the same sections, with half precision recurrent states
+    snapshots = np.frombuffer(bytes(message), dtype="<f4", offset=len(message) - 20 * 2 * 3 * 16 * 4)
+    message = message[:len(message) - snapshots.nbytes] + snapshots.astype("<f2").tobytes()
+    message[4] = 1
+
+    decoded = decode([bytes(message)])
+    expected = np.stack([transition[5].squeeze(1).numpy() for transition in transitions])
+    assert np.allclose(decoded[5], expected, atol=1e-3)
+
+
+def test_stale_groups_are_removed():
+    fakeredis = pytest.importorskip("fakeredis")
+    redis = fakeredis.FakeRedis()
+
+    assert remove_stale_groups(redis, "replay_buffer", {"learner"}) == []
+
+    for group in ("learner", "learner-rank1", "renamed"):
+        redis.xgroup_create("replay_buffer", group, id="0", mkstream=True)
+    redis.xadd("replay_buffer", {"data": b""})
+
+    assert sorted(remove_stale_groups(redis, "replay_buffer", {"learner"})) == ["learner-rank1", "renamed"]
+    assert [group["name"] for group in redis.xinfo_groups("replay_buffer")] in ([b"learner"], ["learner"])
+
+
+class RedisWithoutLag:
+    """
+    Redis before 7, whose consumer groups don't report their lag.
+    """
+    def __init__(self, redis):
+        self.redis = redis
+
+    def __getattr__(self, name):
+        return getattr(self.redis, name)
+
+    def pipeline(self, transaction=True):
+        pipeline = self.redis.pipeline(transaction=transaction)
+        execute = pipeline.execute
+
+        def execute_without_lag():
+            return [[{key: value for key, value in group.items() if key != "lag"} for group in result]
+                    if isinstance(result, list) and result and isinstance(result[0], dict) else result
+                    for result in execute()]
+
+        pipeline.execute = execute_without_lag
+        return pipeline
+
+
+def test_backlog_without_lag_counts_undelivered_messages():
+    fakeredis = pytest.importorskip("fakeredis")
+    redis = RedisWithoutLag(fakeredis.FakeRedis())
+
+    transport = StreamTransport(redis, max_length=None, max_backlog=50)
+    redis.xgroup_create(transport.stream, "learner", id="0", mkstream=True)
+    for _ in range(120):
+        transport.send(b"message")
+
+    # Nothing read yet, counting stops past the point where publishers wait
+    assert 50 < transport.backlog() <= 52
+
+    delivered = redis.xreadgroup("learner", "node", {transport.stream: ">"}, count=100)[0][1]
+    assert transport.backlog() == 20 + 100
+    redis.xack(transport.stream, "learner", *[message_id for message_id, _ in delivered[:90]])
+    assert transport.backlog() == 20 + 10
+
+    # A group that caught up has no backlog, however long the stream is
+    delivered += redis.xreadgroup("learner", "node", {transport.stream: ">"})[0][1]
+    redis.xack(transport.stream, "learner", *[message_id for message_id, _ in delivered[90:]])
+    assert redis.xlen(transport.stream) == 120 and transport.backlog() == 0
+
+    # So publishing goes on without waiting for it
+    transition = next(synthetic_transitions(1, sequence_length, features, 16, recurrent_shape))
+    publisher = ExperiencePublisher(None, "worker", max_transitions=1, window=sequence_length, max_backlog=50,
+                                    transport=transport)
+    publisher.wait_for_readers = None
+    publisher.start_episode(transition[0][-1])
+    publisher.add(transition[3][-1], *transition[1:3], False, *transition[5:])
+    assert publisher.backlog == 1
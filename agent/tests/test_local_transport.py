@@ -0,0 +1,133 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+import torch
+
+from LocalTransport import process_alive, TransitionRing, LaneReader, SharedWeightPublisher, SharedWeightSubscriber
+
+
+@pytest.fixture
+def ring():
+    ring = TransitionRing(f"test_ring_{os.getpid()}", lanes=2, slots=4, slot_size=64)
+    yield ring
+    ring.close()
+
+
+def test_lanes_deliver_in_order_and_wait_for_acks(ring):
+    lane = ring.claim_lane()
+    other_lane = ring.claim_lane()
+    assert (lane.lane, other_lane.lane) == (0, 1)
+    assert other_lane.send(b"other") == 1
+
+    reader = LaneReader(ring, owns=lambda index: index == lane.lane, block=0.0)
+
+    # Messages of different sizes, wrapping around the lane's slots several times
+    sent = []
+    for count in range(1, 41):
+        message = bytes([count]) * count
+        assert lane.send(message) == len(sent) % ring.slots + 1
+        sent.append(message)
+
+        if len(sent) % ring.slots == 0:
+            # Only as many messages as there are slots are in flight, the rest wait for the reader
+            assert lane.send(b"full") is None
+
+            messages = reader.read()
+            assert [data for _, data in messages] == sent[-ring.slots:]
+            assert reader.read() == []
+            assert lane.send(b"full") is None
+
+            reader.ack([message_id for message_id, _ in messages[:2]])
+            assert lane.backlog() == ring.slots - 2
+            reader.ack([message_id for message_id, _ in messages])
+            assert lane.backlog() == 0
+
+    # Messages of the lanes the reader doesn't own are left to other readers
+    assert [data for _, data in LaneReader(ring, owns=lambda index: index == 1, block=0.0).read()] == [b"other"]
+
+    with pytest.raises(ValueError):
+        lane.send(bytes(ring.slot_size + 1))
+
+
+def test_lanes_of_exited_workers_are_reused(ring):
+    exited = subprocess.Popen([sys.executable, "-c", "pass"])
+    exited.wait()
+
+    assert process_alive(os.getpid())
+    assert not process_alive(exited.pid)
+
+    ring.counters[0, ring.OWNER] = exited.pid
+    ring.counters[1, ring.OWNER] = os.getpid()
+    assert ring.claim_lane().lane == 0
+    assert process_alive(os.getpid())
+
+    with pytest.raises(RuntimeError):
+        ring.claim_lane()
+
+
+def state_dict_of(model, value):
+    return {name: torch.full_like(tensor, value) for name, tensor in model.state_dict().items()}
+
+
+def loaded_values(model):
+    return {float(value) for tensor in model.state_dict().values() for value in tensor.flatten()}
+
+
+class InterruptedViews(dict):
+    """
+    Runs `interrupt` once, after the first tensor was copied, like a publisher writing in the middle of a read.
+    """
+    def __init__(self, views, interrupt):
+        super().__init__(views)
+        self.interrupt = interrupt
+
+    def items(self):
+        for index, item in enumerate(super().items()):
+            yield item
+            if index == 0 and self.interrupt is not None:
+                self.interrupt()
+                self.interrupt = None
+
+
+def test_shared_weights_are_never_read_torn():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.Linear(8, 3))
+
+    name = f"test_weights_{os.getpid()}"
+    publisher = SharedWeightPublisher(name, model.state_dict())
+    subscriber = SharedWeightSubscriber(name)
+
+    try:
+        publisher.publish(state_dict_of(model, 1.0))
+
+        # A publish between copying the first tensor and the rest makes the subscriber copy everything again
+        subscriber.views = InterruptedViews(subscriber.views,
+                                            lambda: publisher.publish(state_dict_of(model, 2.0)))
+        assert subscriber.update(model)
+        assert loaded_values(model) == {2.0} and subscriber.version == 2
+
+        # While a write is in progress, here one tensor into it, the subscriber waits for it to finish
+        publisher.header[0] += 1
+        publisher.header[1] = 3
+        tensor_name, tensor = next(iter(state_dict_of(model, 3.0).items()))
+        publisher.views[tensor_name][...] = tensor.numpy()
+
+        reading = threading.Thread(target=subscriber.update, args=(model,))
+        reading.start()
+        time.sleep(0.05)
+        assert reading.is_alive() and loaded_values(model) == {2.0}
+
+        for tensor_name, tensor in state_dict_of(model, 3.0).items():
+            publisher.views[tensor_name][...] = tensor.numpy()
+        publisher.header[0] += 1
+
+        reading.join(timeout=5)
+        assert not reading.is_alive()
+        assert loaded_values(model) == {3.0} and subscriber.version == 3
+    finally:
+        subscriber.close()
+        publisher.close()
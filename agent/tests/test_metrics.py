@@ -0,0 +1,99 @@
+import random
+import time
+
+import pytest
+
+from Metrics import EpisodeMetrics, FleetTelemetry, RollingWindow, WorkerTelemetry, publish_episode
+
+
+def brute_force_summary(scores):
+    ordered = sorted(scores)
+
+    return {
+        "count": len(scores),
+        "mean": sum(scores) / len(scores),
+        "p10": ordered[min(len(ordered) - 1, int(0.1 * len(ordered)))],
+        "p50": ordered[min(len(ordered) - 1, int(0.5 * len(ordered)))],
+        "p90": ordered[min(len(ordered) - 1, int(0.9 * len(ordered)))],
+        "max": ordered[-1],
+    }
+
+
+def test_rolling_window_matches_the_last_episodes():
+    rng = random.Random(0)
+    window = RollingWindow(size=50)
+    added = []
+
+    # Repeated scores, so removal has to find the right one among equal neighbours, and components that come and go
+    for step in range(437):
+        score = float(rng.randint(-20, 20)) if step % 3 else rng.uniform(-1e4, 1e4)
+        components = {name: rng.uniform(-10.0, 10.0) for name in ("progress", "rings", "damage") if rng.random() < 0.7}
+        window.add(score, components)
+        added.append((score, components))
+
+        last = added[-window.size:]
+        summary = window.summary()
+        expected = brute_force_summary([score for score, _ in last])
+        assert summary == pytest.approx(expected, rel=1e-9, abs=1e-9)
+        assert sorted(window.sorted_scores) == window.sorted_scores
+
+        names = {name for _, episode in added for name in episode}
+        expected_components = {name: sum(episode.get(name, 0.0) for _, episode in last) / len(last) for name in names}
+        assert window.component_means() == pytest.approx(expected_components, rel=1e-9, abs=1e-9)
+
+    assert len(window) == 50
+
+
+def test_silent_workers_are_forgotten(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    redis = fakeredis.FakeRedis()
+
+    metrics = EpisodeMetrics(redis, window=10, worker_window=4, worker_timeout=60)
+    scores = {"worker 1": [], "worker 2": []}
+    for step in range(15):
+        worker_name = "worker 1" if step % 3 else "worker 2"
+        publish_episode(redis, worker_name, float(step), 100, {"progress": step / 2})
+        scores[worker_name].append(float(step))
+    assert metrics.update() == 15
+
+    assert metrics.steps == 1500
+    assert metrics.episodes.summary() == pytest.approx(brute_force_summary([float(step) for step in range(5, 15)]))
+    assert metrics.worker_means() == pytest.approx({name: sum(worker[-4:]) / 4 for name, worker in scores.items()})
+
+    # Only one of the workers keeps reporting
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    publish_episode(redis, "worker 1", 15.0, 100)
+    assert metrics.update() == 1
+    assert set(metrics.workers) == {"worker 1"}
+
+    # A restarted node starts from the most recent episodes
+    restarted = EpisodeMetrics(redis, window=10, worker_window=4, worker_timeout=60)
+    assert restarted.episodes.summary() == pytest.approx(brute_force_summary([float(step) for step in range(6, 16)]))
+
+
+def test_silence_is_measured_from_when_heartbeats_were_sent(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    redis = fakeredis.FakeRedis()
+
+    fleet = FleetTelemetry(redis, silence=60)
+    telemetry = WorkerTelemetry(redis, "worker")
+    telemetry.step(0.01, 0.002)
+    telemetry.heartbeat(episodes=1, model_version=3, restarts=0, level=2)
+
+    # Heartbeats from workers that don't send the time are dated by their entry ID
+    redis.xadd(fleet.stream, {"worker": "old worker", "steps_per_second": 100.0, "frame_wait_ms": 0.0,
+                              "step_p99_ms": 0.0, "episodes": 1, "model_version": 3, "restarts": 0, "level": 2})
+
+    # The node only gets to them two minutes later
+    sent = time.time()
+    monkeypatch.setattr(time, "time", lambda: sent + 120)
+
+    assert fleet.update() == 2
+    assert fleet.workers["worker"]["time"] == pytest.approx(sent, abs=5)
+    assert fleet.workers["old worker"]["time"] == pytest.approx(sent, abs=5)
+
+    stragglers = fleet.stragglers()
+    assert stragglers["worker"] == ["silent for 120s"]
+    assert stragglers["old worker"] == ["silent for 120s"]
+    assert fleet.summary()["workers"] == 0
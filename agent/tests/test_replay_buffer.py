@@ -0,0 +1,167 @@
+import numpy as np
+import pytest
+import torch
+
+from ReplayBuffer import BatchPrefetcher, PrioritizedReplayBuffer, synthetic_transitions
+
+
+sequence_length = 4
+features = 8
+
+
+def transitions(count, seed=0):
+    return list(synthetic_transitions(count, sequence_length, features, 4, (2, 1, 16), seed=seed))
+
+
+def windows(replay_buffer, indices):
+    states, _, _, next_states, *_ = replay_buffer.gather(indices)
+
+    return states.cpu().numpy(), next_states.cpu().numpy()
+
+
+@pytest.mark.parametrize("observation_dtype", ["float32", "float16", "int16", "uint8"])
+def test_deduplicated_windows_match_stored_windows(observation_dtype):
+    stream = transitions(450)
+
+    # Large enough that no frame is overwritten, windows cross episode ends
+    plain = PrioritizedReplayBuffer(1000)
+    deduplicated = PrioritizedReplayBuffer(1000, deduplicate_frames=True, observation_dtype=observation_dtype)
+    for transition in stream:
+        plain.add(*transition)
+        deduplicated.add(*transition)
+
+    indices = np.arange(len(stream))
+    states, next_states = windows(plain, indices)
+    deduplicated_states, deduplicated_next_states = windows(deduplicated, indices)
+
+    tolerance = {"float32": 0.0, "float16": 1e-3, "int16": 1 / 65535, "uint8": 1 / 255}[observation_dtype]
+    assert np.abs(deduplicated_states - states).max() <= tolerance
+    assert np.abs(deduplicated_next_states - next_states).max() <= tolerance
+
+    # Padding before an episode's first observation stays exactly zero
+    assert np.all(deduplicated_states[states == 0] == 0)
+
+    # Everything besides the windows is stored the same way
+    for stored, rebuilt in zip(plain.gather(indices), deduplicated.gather(indices)):
+        if stored.shape == states.shape:
+            continue
+        assert torch.equal(stored, rebuilt)
+
+
+def test_transitions_with_overwritten_frames_are_dropped():
+    rng = np.random.default_rng(0)
+
+    # Every transition restarts its stream, writing its whole window, so frames run out before transitions do
+    replay_buffer = PrioritizedReplayBuffer(8, deduplicate_frames=True)
+    added = []
+    for step in range(8):
+        state = rng.uniform(-1.0, 1.0, (sequence_length, features)).astype(np.float32)
+        next_state = np.concatenate((state[1:], rng.uniform(-1.0, 1.0, (1, features)).astype(np.float32)))
+        *_, hidden_state, cell_state = transitions(1)[0]
+        replay_buffer.add(state, 0, 0.0, next_state, False, hidden_state, cell_state, worker_id=f"worker {step}")
+        added.append((state, next_state))
+
+    frames_per_transition = sequence_length + 1
+    kept = replay_buffer.frame_capacity // frames_per_transition
+    indices = np.arange(8)
+
+    intact = replay_buffer.intact(indices)
+    assert not intact[:-kept].any() and intact[-kept:].all()
+    assert np.all(replay_buffer.priorities[indices[:-kept]] == 0)
+    assert np.all(replay_buffer.priorities[indices[-kept:]] > 0)
+
+    # Windows are never rebuilt from frames that belong to other transitions
+    assert np.all(replay_buffer.window_slots(indices[:-kept]) == -1)
+
+    states, next_states = windows(replay_buffer, indices[-kept:])
+    for (state, next_state), rebuilt_state, rebuilt_next_state in zip(added[-kept:], states, next_states):
+        assert np.array_equal(rebuilt_state, state)
+        assert np.array_equal(rebuilt_next_state, next_state)
+
+    # Priority updates from a batch sampled before the frames were overwritten don't bring them back
+    replay_buffer.update_priorities(indices, np.ones(8))
+    assert np.all(replay_buffer.priorities[indices[:-kept]] == 0)
+
+    for _ in range(20):
+        sampled = replay_buffer.sample(4)[5]
+        assert replay_buffer.intact(sampled).all()
+
+
+# The thread still reports its exception when it ends
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_prefetching_errors_reach_the_learner():
+    replay_buffer = PrioritizedReplayBuffer(1000)
+    for transition in transitions(100):
+        replay_buffer.add(*transition)
+
+    sample = replay_buffer.sample
+    samples = []
+
+    def sample_once(*args, **kwargs):
+        if samples:
+            raise RuntimeError("Could not sample a consistent batch")
+        samples.append(sample(*args, **kwargs))
+        return samples[-1]
+
+    replay_buffer.sample = sample_once
+    prefetcher = BatchPrefetcher(replay_buffer, 16)
+
+    # Batches sampled before the error are still handed out
+    assert prefetcher.get() is samples[0]
+    with pytest.raises(RuntimeError, match="prefetching thread") as error:
+        prefetcher.get()
+    assert str(error.value.__cause__) == "Could not sample a consistent batch"
+
+    prefetcher.stop()
+
+
+def test_flushed_buffer_reopens_where_it_left_off(tmp_path):
+    path = str(tmp_path / "replay")
+    stream = transitions(250)
+
+    replay_buffer = PrioritizedReplayBuffer(256, deduplicate_frames=True, path=path, observation_dtype="uint8")
+    for transition in stream[:200]:
+        replay_buffer.add(*transition)
+    replay_buffer.update_priorities(np.arange(10), np.full(10, 5.0))
+    replay_buffer.flush()
+
+    # Added after the last flush, into slots that weren't used yet, so not part of the reopened buffer
+    for transition in stream[200:]:
+        replay_buffer.add(*transition)
+
+    reopened = PrioritizedReplayBuffer(256, deduplicate_frames=True, path=path, observation_dtype="uint8")
+    assert len(reopened) == 200 and reopened.position == 200
+    assert reopened.max_priority == 5.0
+    assert np.allclose(reopened.priorities[np.arange(200)], np.where(np.arange(200) < 10, 5.0, 1.0) ** 0.6)
+    assert np.all(reopened.priorities[np.arange(200, 256)] == 0)
+
+    reference = PrioritizedReplayBuffer(256, deduplicate_frames=True, observation_dtype="uint8")
+    for transition in stream[:200]:
+        reference.add(*transition)
+
+    indices = np.arange(200)
+    for stored, rebuilt in zip(reference.gather(indices), reopened.gather(indices)):
+        assert torch.equal(stored, rebuilt)
+
+    # Adding continues the ring, and the streams of the workers start over
+    reopened.add(*stream[200])
+    assert len(reopened) == 201
+
+
+def test_reopening_with_other_settings_fails(tmp_path):
+    path = str(tmp_path / "replay")
+    replay_buffer = PrioritizedReplayBuffer(64, path=path, observation_dtype="int16")
+    for transition in transitions(10):
+        replay_buffer.add(*transition)
+    replay_buffer.flush()
+
+    with pytest.raises(ValueError, match="observation_range"):
+        PrioritizedReplayBuffer(64, path=path, observation_dtype="int16", observation_range=(-2.0, 2.0))
+
+    with pytest.raises(ValueError, match="observation_dtype"):
+        PrioritizedReplayBuffer(64, path=path, observation_dtype="uint8")
+
+    reopened = PrioritizedReplayBuffer(64, path=path, observation_dtype="int16")
+    state, action, reward, next_state, done, hidden_state, cell_state = transitions(1)[0]
+    with pytest.raises(ValueError, match="state shape"):
+        reopened.add(state[1:], action, reward, next_state[1:], done, hidden_state, cell_state)
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+import torch
+
+from Agent import Agent
+from ReplayBuffer import SequenceReplayBuffer
+
+
+features = 44
+
+
+def act(agent, windows):
+    """
+    Lets the agent act on every window of an episode like the worker does, returning its recurrent state before the
+        first step and after each one.
+    """
+    agent.start_new_episode()
+
+    hidden_state, cell_state = agent.Q_eval.initial_state(1)
+    states = [(hidden_state, cell_state)]
+    for window in windows:
+        agent.choose_action(window)
+        states.append((agent.hidden_state.clone(), agent.cell_state.clone()))
+
+    return states
+
+
+@pytest.mark.parametrize("sequence_length, burn_in, period", [(4, 4, 4), (4, 5, 3), (3, 2, 6)])
+def test_burn_in_reaches_the_state_before_the_window(sequence_length, burn_in, period):
+    torch.manual_seed(0)
+    np.random.seed(0)
+    rng = np.random.default_rng(0)
+
+    # About half the steps are random, the recurrent state has to advance on those too
+    agent = Agent(gamma=0.99, epsilon=0.5, lr=0, input_dims=features, batch_size=0, n_actions=16, max_mem_size=64,
+                  sequence_length=sequence_length, replay="sequence", burn_in=burn_in)
+    network = agent.Q_eval
+
+    episode_length = 30
+    observations = rng.normal(size=(episode_length + 1, features)).astype(np.float32)
+
+    # Windows are zero-padded before the episode's first observation, like the worker's
+    padded = np.concatenate((np.zeros((sequence_length - 1, features), dtype=np.float32), observations))
+    states = act(agent, [padded[step:step + sequence_length] for step in range(episode_length)])
+
+    replay_buffer = SequenceReplayBuffer(1000, sequence_length, burn_in=burn_in, period=period)
+    for step in range(episode_length):
+        hidden_state, cell_state = states[step + 1]
+        replay_buffer.add_batch([padded[step:step + sequence_length]], [0], [0.0],
+                                [padded[step + 1:step + 1 + sequence_length]], [step == episode_length - 1],
+                                [hidden_state.squeeze(1).numpy()], [cell_state.squeeze(1).numpy()], ["worker"])
+
+    assert len(replay_buffer) == episode_length
+
+    np.random.seed(0)
+    (windows, _, _, _, _, _, _, burn_in_frames, burn_in_lengths, hidden_states,
+     cell_states) = replay_buffer.sample(256)
+
+    with torch.no_grad():
+        burnt_hidden, burnt_cell = network.burn_in(burn_in_frames, burn_in_lengths, hidden_states, cell_states)
+
+    checked = set()
+    for index in range(len(windows)):
+        step = int(np.argmax((observations == windows[index, -1].numpy()).all(axis=1)))
+        window_start = max(0, step - sequence_length + 1)
+
+        expected_hidden, expected_cell = states[window_start]
+        assert torch.allclose(burnt_hidden[:, index], expected_hidden[:, 0], atol=1e-5), step
+        assert torch.allclose(burnt_cell[:, index], expected_cell[:, 0], atol=1e-5), step
+        checked.add(step)
+
+    # Every transition was sampled, those of the first sequence included
+    assert checked == set(range(episode_length))
+
+
+def test_sequence_priorities_mix_their_transitions_td_errors():
+    rng = np.random.default_rng(0)
+    sequence_length, period = 4, 4
+
+    replay_buffer = SequenceReplayBuffer(1000, sequence_length, burn_in=2, period=period, alpha=1.0,
+                                         priority_eta=0.9)
+    window = np.zeros((sequence_length, features), dtype=np.float32)
+    recurrent_state = np.zeros((2, 16), dtype=np.float32)
+    for step in range(10):
+        next_window = np.concatenate((window[1:], rng.normal(size=(1, features)).astype(np.float32)))
+        replay_buffer.add_batch([window], [0], [0.0], [next_window], [step == 9], [recurrent_state],
+                                [recurrent_state], ["worker"])
+        window = next_window
+
+    # Sequences of 4, 4 and the last 2 transitions, each starting at the highest priority seen so far
+    assert list(replay_buffer.arrays["lengths"][:3]) == [4, 4, 2]
+    assert np.allclose(replay_buffer.priorities[np.arange(3)], 1.0)
+
+    # Transitions are sequence * period + offset, and updating one keeps what's known about the others
+    replay_buffer.update_priorities(np.array([1 * period + 0, 1 * period + 2]), [0.5, 3.0])
+    assert replay_buffer.priorities[1] == pytest.approx(0.9 * 3.0 + 0.1 * (0.5 + 1.0 + 3.0 + 1.0) / 4)
+
+    replay_buffer.update_priorities(np.array([1 * period + 1, 1 * period + 3, 2 * period + 1]), [0.5, 0.5, 0.2])
+    assert replay_buffer.priorities[1] == pytest.approx(0.9 * 3.0 + 0.1 * (0.5 + 0.5 + 3.0 + 0.5) / 4)
+    assert replay_buffer.priorities[2] == pytest.approx(0.9 * 1.0 + 0.1 * (1.0 + 0.2) / 2)
+
+    indices = replay_buffer.sample(64)[5]
+    assert np.all(indices % period < replay_buffer.arrays["lengths"][indices // period])
@@ -0,0 +1,116 @@
+import time
+
+import pytest
+import torch
+
+from WeightChannel import WeightPublisher, WeightSubscriber, WeightRefresher
+
+
+def make_model():
+    torch.manual_seed(0)
+    return torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.Linear(8, 3))
+
+
+def changed(state_dict, value, names):
+    return {name: torch.full_like(tensor, value) if name in names else tensor.clone()
+            for name, tensor in state_dict.items()}
+
+
+def assert_same_state(model, state_dict):
+    for name, tensor in model.state_dict().items():
+        assert torch.equal(tensor, state_dict[name]), name
+
+
+class PublishingDuringFetch:
+    """
+    Redis where `publish` runs right after the subscriber's first read of a fetch, before it reads the tensors.
+    """
+    def __init__(self, redis, publish):
+        self.redis = redis
+        self.publish = publish
+
+    def __getattr__(self, name):
+        return getattr(self.redis, name)
+
+    def pipeline(self, transaction=True):
+        pipeline = self.redis.pipeline(transaction=transaction)
+        execute = pipeline.execute
+
+        def execute_then_publish():
+            result = execute()
+            if self.publish is not None:
+                self.publish()
+                self.publish = None
+            return result
+
+        pipeline.execute = execute_then_publish
+        return pipeline
+
+
+def test_fetch_never_mixes_versions():
+    fakeredis = pytest.importorskip("fakeredis")
+    redis = fakeredis.FakeRedis()
+
+    model = make_model()
+    publisher = WeightPublisher(redis, half_precision=False)
+    subscriber = WeightSubscriber(redis)
+
+    first = model.state_dict()
+    publisher.publish(first)
+    loaded = make_model()
+    assert subscriber.update(loaded)
+
+    # Version 2 changes the first layer, and version 3, published while version 2 is fetched, both
+    second = changed(first, 2.0, {"0.weight", "0.bias"})
+    third = changed(second, 3.0, {"0.weight", "0.bias", "1.weight", "1.bias"})
+    publisher.publish(second)
+
+    subscriber.redis = PublishingDuringFetch(redis, lambda: publisher.publish(third))
+    assert subscriber.update(loaded)
+    assert subscriber.version == 3
+    assert_same_state(loaded, third)
+
+    assert subscriber.fetch() is None
+
+
+def swap_when_ready(refresher, model, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        swapped = refresher.swap(model)
+        if swapped is not model:
+            return swapped
+        time.sleep(0.01)
+
+    raise TimeoutError("No new weights were swapped in")
+
+
+def test_refresher_swaps_in_every_update_between_steps():
+    fakeredis = pytest.importorskip("fakeredis")
+    redis = fakeredis.FakeRedis()
+
+    publisher = WeightPublisher(redis, half_precision=False)
+    subscriber = WeightSubscriber(redis)
+
+    first = make_model().state_dict()
+    publisher.publish(first)
+    acting = make_model()
+    subscriber.update(acting)
+
+    refresher = WeightRefresher(subscriber, acting, interval=0.01)
+    assert refresher.swap(acting) is acting
+
+    # Each update only carries the tensors it changed, the second one none of those of the first
+    second = changed(first, 2.0, {"0.weight", "0.bias"})
+    publisher.publish(second)
+    previous, acting = acting, swap_when_ready(refresher, acting)
+    assert refresher.version == 2
+    assert_same_state(acting, second)
+
+    # The model that acted before is the standby now, and is caught up with the first update before the second
+    third = changed(second, 3.0, {"1.weight", "1.bias"})
+    publisher.publish(third)
+    acting = swap_when_ready(refresher, acting)
+    assert acting is previous and refresher.version == 3
+    assert_same_state(acting, third)
+
+    assert refresher.swap(acting) is acting
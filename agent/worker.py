@@ -1,28 +1,48 @@
 from Agent import Agent
 from Watchdog import Watchdog
 from RatchetEnvironment import RatchetEnvironment
-from ReplayBuffer import Transition, TransitionMessage
+from Experience import ExperiencePublisher
+from WeightChannel import WeightSubscriber, WeightRefresher
+from ControlChannel import ConfigSubscriber
+from LocalTransport import TransitionRing, SharedWeightSubscriber
+from Metrics import publish_episode, WorkerTelemetry
+from Topology import parse_cpu_list, configure_torch_threads, pin_current_process
+
+import time
 
-import pickle
 import numpy as np
 
-from redis import Redis
 from redis import from_url as redis_from_url
 
 
 features = 44
 sequence_length = 8
 
-configuration = {
-    "model": None,
-    "epsilon": 0.005,
+# Used until the node has published a configuration
+default_configuration = {
+    "epsilon": 1.0,
     "min_epsilon": 0.005,
+    "model_version": 0,
+    "levels": None,
+    "episodes_per_level": 5,
+    "recurrent_interval": 1,
+    "recurrent_phase": 0,
+    "frame_by_frame": False,
 }
 
 
-def update_configuration(redis: Redis):
-    configuration["epsilon"] = float(redis.get("epsilon")) if redis.get("epsilon") is not None else 1.0
-    configuration["min_epsilon"] = float(redis.get("min_epsilon")) if redis.get("min_epsilon") is not None else 0.005
+def validate_configuration(config):
+    if config["episodes_per_level"] < 1:
+        raise ValueError(f"episodes_per_level must be at least 1, not {config['episodes_per_level']}")
+
+    if config["recurrent_interval"] < 1 or not 0 <= config["recurrent_phase"] < config["recurrent_interval"]:
+        raise ValueError(f"recurrent_phase {config['recurrent_phase']} isn't a step of recurrent_interval "
+                         f"{config['recurrent_interval']}")
+
+
+def apply_configuration(agent: Agent, config, epsilon_override=None):
+    agent.epsilon = config["epsilon"] if epsilon_override is None else float(epsilon_override)
+    agent.eps_min = config["min_epsilon"] if epsilon_override is None else float(epsilon_override)
 
 
 def start_worker():
@@ -36,8 +56,24 @@ def start_worker():
     parser.add_argument("--render", action="store_true", default=True)
     parser.add_argument("--force-watchdog", action="store_false")
     parser.add_argument("--epsilon", type=float, default=None)
+    parser.add_argument("--cpus", type=str, default=None, help="CPU list to pin this worker to, e.g. 8-9")
+    parser.add_argument("--torch-threads", type=int, default=None,
+                        help="Intra-op threads used for inference, 1 is usually enough next to emulators")
+    parser.add_argument("--publish-batch", type=int, default=32,
+                        help="Transitions published to the node together, 1 publishes every step")
+    parser.add_argument("--publish-interval", type=float, default=0.5,
+                        help="Longest a transition waits to be published, in seconds")
+    parser.add_argument("--max-backlog", type=int, default=5000,
+                        help="Messages the node may fall behind before this worker waits for it")
+    parser.add_argument("--local-transport", type=str, default=None,
+                        help="Shared memory name of a node on this machine, used instead of Redis for experience "
+                             "and weights")
+    parser.add_argument("--heartbeat-interval", type=float, default=10.0,
+                        help="Seconds between heartbeats with this worker's step rate and timings to the node")
     args = parser.parse_args()
 
+    configure_torch_threads(args.torch_threads)
+
     rpcs3_path = args.rpcs3_path
     process_name = args.process_name
     render = args.render
@@ -51,25 +87,49 @@ def start_worker():
     worker_id = np.random.randint(0, 999999)
     worker_id = f"worker-{worker_id}"
 
-    # Watchdog starts RPCS3 and the game for us if it's not already running
+    # Watchdog starts RPCS3 and the game for us if it's not already running. Pinned afterwards, so the emulator
+    # doesn't share the CPUs meant for inference
     watchdog.start()
+    pin_current_process(parse_cpu_list(args.cpus), "worker")
     env.start()
 
     # Connect to Redis
     redis = redis_from_url(f"redis://{args.redis_host}:{args.redis_port}")
 
-    if epsilon_override is None:
-        update_configuration(redis)
-    else:
+    # The node pushes configuration snapshots, they're applied between steps without asking Redis for them
+    control = ConfigSubscriber(redis, defaults=default_configuration, validate=validate_configuration)
+    if epsilon_override is not None:
         print("Running with epsilon override:", epsilon_override)
-        configuration["epsilon"] = float(epsilon_override)
-        configuration["min_epsilon"] = float(epsilon_override)
 
     # Agent that we will use only for inference
-    agent = Agent(gamma=0.99, epsilon=configuration["epsilon"], batch_size=0, n_actions=16, eps_end=configuration["min_epsilon"],
-                  input_dims=features, lr=0, sequence_length=8)
+    agent = Agent(gamma=0.99, epsilon=control.config["epsilon"], batch_size=0, n_actions=16,
+                  eps_end=control.config["min_epsilon"], input_dims=features, lr=0, sequence_length=8)
+    apply_configuration(agent, control.config, epsilon_override)
+
+    # A node on the same machine can take experience and give weights through shared memory
+    lane = None
+    if args.local_transport is not None:
+        print(f"Waiting for a node with local transport {args.local_transport}...")
+        lane = TransitionRing.attach(args.local_transport, timeout=None).claim_lane()
+        weight_subscriber = SharedWeightSubscriber(f"{args.local_transport}_weights")
+    else:
+        # New weights are announced over pub/sub, so checking for them doesn't cost a request to Redis
+        weight_subscriber = WeightSubscriber(redis)
+
+    if weight_subscriber.update(agent.Q_eval):
+        print(f"Loaded model version {weight_subscriber.version}")
 
-    last_model_fetch_time = 0
+    # Later weights are fetched and loaded into a standby model in the background, and swapped in between steps
+    refresher = WeightRefresher(weight_subscriber, agent.Q_eval)
+
+    # Transitions go to the node in batches, and always at the end of an episode
+    publisher = ExperiencePublisher(redis, worker_id, max_transitions=args.publish_batch,
+                                    max_delay=args.publish_interval, window=sequence_length,
+                                    max_backlog=args.max_backlog,
+                                    transport=lane)
+
+    # Step rate and timings go to the node in periodic heartbeats
+    telemetry = WorkerTelemetry(redis, worker_id, interval=args.heartbeat_interval)
 
     total_steps = 0
     episodes = 0
@@ -77,41 +137,59 @@ def start_worker():
 
     # Start stepping through the environment
     while True:
-        if float(redis.get("model_timestamp")) > last_model_fetch_time:
-            # Load the latest model from Redis
-            configuration["model"] = redis.get("model")
-            if configuration["model"] is not None:
-                agent.Q_eval.load_state_dict(pickle.loads(configuration["model"]))
-                last_model_fetch_time = float(redis.get("model_timestamp"))
-
-        if epsilon_override is None:
-            update_configuration(redis)
-            agent.epsilon = configuration["epsilon"]
-            agent.eps_min = configuration["min_epsilon"]
-
-        if episodes > 0 and episodes % 5 == 0:
+        # Levels only change between episodes
+        levels = control.config["levels"] or RatchetEnvironment.levels
+        if list(levels) != env.levels:
+            print(f"Switching to levels {levels}")
+            env.set_levels(levels)
+        elif episodes > 0 and episodes % control.config["episodes_per_level"] == 0:
             env.cycle_level()
 
+        # Steps whose recurrent state is sent are counted from the start of an episode, the node decides which
+        publisher.recurrent_interval = control.config["recurrent_interval"]
+        publisher.recurrent_phase = control.config["recurrent_phase"]
+        agent.frame_by_frame = control.config["frame_by_frame"]
+
         agent.start_new_episode()
         state, _, _ = env.reset()
 
         state_sequence = np.zeros((sequence_length, features), dtype=np.float32)
         state_sequence[-1] = state
 
+        publisher.start_episode(state)
+
         accumulated_reward = 0
         steps = 0
         while True:
+            model = refresher.swap(agent.Q_eval)
+            if model is not agent.Q_eval:
+                agent.Q_eval = model
+                print(f"Switched to model version {refresher.version}: %.1f kB loaded in %.1f ms" % (
+                    weight_subscriber.last_bytes / 1024, weight_subscriber.last_latency * 1000))
+
             action = agent.choose_action(state_sequence)
+
+            step_start = time.perf_counter()
+            frame_wait_time = env.game.frame_wait_time
             state, reward, done = env.step(action)
+            telemetry.step(time.perf_counter() - step_start, env.game.frame_wait_time - frame_wait_time)
 
             new_state_sequence = np.concatenate((state_sequence[1:], [state]))
 
-            transition = Transition(state_sequence, action, reward, new_state_sequence, done, agent.hidden_state, agent.cell_state)
-            message = TransitionMessage(transition, worker_id)
+            # Only the new observation is sent, the node keeps the window
+            publisher.add(state, action, reward, done, agent.hidden_state, agent.cell_state)
+
+            if control.poll():
+                apply_configuration(agent, control.config, epsilon_override)
+
+                # A model version newer than the loaded one also comes with the configuration, in case the
+                # announcement was missed while disconnected
+                if control.config["model_version"] > refresher.version:
+                    refresher.request()
 
-            # Pickle the transition and publish it to the "replay_buffer" channel
-            data = pickle.dumps(message)
-            redis.publish("replay_buffer", data)
+            if telemetry.due():
+                telemetry.heartbeat(episodes, refresher.version, watchdog.restarts,
+                                    env.levels[env.current_level_index])
 
             state_sequence = new_state_sequence
 
@@ -136,11 +214,13 @@ def start_worker():
         avg_score = np.mean(scores[-100:])
 
         print('episode:', episodes, 'steps:', total_steps, 'score: %.2f' % accumulated_reward,
-              'avg score: %.2f' % avg_score, 'chkpt update time: %.0f' % last_model_fetch_time,
+              'avg score: %.2f' % avg_score, 'model version: %d' % refresher.version,
+              'published: %d messages, %.1f kB' % (publisher.messages, publisher.bytes / 1024),
+              'waited for node: %.1fs' % publisher.throttled_time,
               'eps: %.2f' % agent.epsilon if agent.epsilon > agent.eps_min else '')
 
-        # Append score to Redis key "scores"
-        redis.rpush("avg_scores", accumulated_reward)
+        # The node keeps the rolling statistics, the stream of episodes is capped
+        publish_episode(redis, worker_id, accumulated_reward, steps, env.reward_counters)
 
         episodes += 1
 